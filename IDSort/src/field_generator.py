@@ -18,10 +18,14 @@ Created on 5 Dec 2013
 @author: ssg37927
 '''
 
+import random
 import threading
+import concurrent.futures
 import numpy as np
 import h5py
 import json
+import scipy.fft
+from scipy.stats import spearmanr
 
 from .magnets import Magnets, MagLists
 
@@ -126,18 +130,94 @@ def generate_availability(info, maglist, masks):
 
     return available
 
-def compare_magnet_arrays(mag_array_a, mag_array_b, lookup):
+def generate_magnet_slots(info):
+    # Result dict mapping each magnet type to the (beam, column, flip matrix) of the slots in the order they are filled
+    slots = {}
+
+    # Process each beam in the ID json data in the same order as generate_per_magnet_array
+    for b, beam in enumerate(info['beams']):
+        for a, mag in enumerate(beam['mags']):
+            slots.setdefault(mag['type'], []).append((beam['name'], a, mag['flip_matrix']))
+
+    return slots
+
+def generate_per_magnet_array_differences(maglist, magnets, mutation_list, mag_array, slots):
+    # Compute (mag_array - mutated_mag_array) for only the columns touched by the mutations without
+    # copying the full magnet lists, returns a dict of (columns, difference) tuples for each beam
+
+    # Copies of the touched magnet list entries keyed on (set_name, index)
+    touched = {}
+
+    def entry(set_name, index):
+        if (set_name, index) not in touched:
+            touched[(set_name, index)] = list(maglist.magnet_lists[set_name][index])
+        return touched[(set_name, index)]
+
+    # Replay the mutations in the same way as MagLists::mutate_from_list
+    for mutation in mutation_list:
+        if mutation[0] == 'S':
+            set_name, mag_a, mag_b = mutation[1:4]
+            entry_a, entry_b = entry(set_name, mag_a), entry(set_name, mag_b)
+            touched[(set_name, mag_a)], touched[(set_name, mag_b)] = entry_b, entry_a
+
+        else:
+            set_name, mag = mutation[1:3]
+            entry(set_name, mag)[1] *= -1
+
+    # Gather the new magnet values for touched positions that fill a slot in the device (others are spares)
+    columns = { beam : {} for beam in mag_array.keys() }
+    for (set_name, index), magnet in touched.items():
+        if index >= len(slots.get(set_name, [])): continue
+
+        beam, column, flip_matrix = slots[set_name][index]
+        field_vector = magnets.magnet_sets[set_name][magnet[0]]
+
+        # Same as MagLists::get_magnet_vals
+        columns[beam][column] = np.dot(field_vector, flip_matrix) if (magnet[1] < 0) else field_vector
+
+    differences = {}
+    for beam, beam_columns in columns.items():
+
+        # Keep columns in ascending order and drop any that did not change to match compare_magnet_arrays
+        column_indices = np.array(sorted(beam_columns.keys()), dtype=np.int64)
+        difference     = np.zeros((mag_array[beam].shape[0], len(column_indices)))
+        for c, column in enumerate(column_indices):
+            difference[:, c] = mag_array[beam][:, column] - beam_columns[column]
+
+        diff_slice = (np.sum(np.abs(difference), axis=0) > 0)
+        differences[beam] = (column_indices[diff_slice], difference[:, diff_slice])
+
+    return differences
+
+def contract_lookup_columns(beam_lookup, columns, difference):
+    # Bfield (x, z, s, 3) contributed by the given lookup columns for the magnet values (3, n)
+    if not isinstance(beam_lookup, np.ndarray):
+        return beam_lookup.contract_columns(columns, difference)
+
+    field_diff = np.sum((beam_lookup[..., columns] * difference), axis=4)
+
+    return np.sum(field_diff, axis=4)
+
+def compare_magnet_differences(differences, lookup):
     difference_map = {}
 
+    for beam, (columns, difference) in differences.items():
+
+        difference_map[beam] = contract_lookup_columns(lookup[beam], columns, difference)
+
+    return difference_map
+
+def compare_magnet_arrays(mag_array_a, mag_array_b, lookup):
+    differences = {}
+
     for beam in mag_array_a.keys():
 
         difference = (mag_array_a[beam] - mag_array_b[beam])
-        diff_slice = (np.sum(np.abs(difference), axis=0) > 0)
-        field_diff = np.sum((lookup[beam][..., diff_slice] * difference[:,diff_slice]), axis=4)
+        columns    = np.flatnonzero(np.sum(np.abs(difference), axis=0) > 0)
 
-        difference_map[beam] = np.sum(field_diff, axis=4)
+        differences[beam] = (columns, difference[:, columns])
 
-    return difference_map
+    return compare_magnet_differences(differences, lookup)
 
 
 def generate_per_beam_bfield(info, maglist, mags, lookup, nthreads=8):
@@ -152,6 +232,11 @@ def generate_per_beam_bfield(info, maglist, mags, lookup, nthreads=8):
     bfields = {}
     for beam, beam_array in beam_arrays.items():
 
+        # Compact lookup formats implement their own contraction over all of their columns
+        if not isinstance(lookup[beam], np.ndarray):
+            bfields[beam] = lookup[beam].contract(beam_array)
+            continue
+
         indexes = range(lookup[beam].shape[5])
         length  = len(indexes) // nthreads
         chunks  = [indexes[x : x+length] for x in range(0, len(indexes), length)]
@@ -249,7 +334,7 @@ def calculate_trajectory_loss(trajectories, ref_trajectories):
 def calculate_cached_trajectory_loss(info, lookup, magnets, maglist, ref_trajectories):
     # Calculate bfield loss and also return reference array to reuse later
     bfield = generate_bfield(info, maglist, magnets, lookup)
-    phase_error, trajectories = calculate_bfield_phase_error(info, bfield)
+    trajectories = calculate_trajectories(info, bfield)
     trajectory_loss = calculate_trajectory_loss(trajectories, ref_trajectories)
     return bfield, trajectory_loss
 
@@ -257,6 +342,700 @@ def calculate_trajectory_loss_from_array(info, bfield, ref_trajectories):
     trajectories = calculate_trajectories(info, bfield)
     return calculate_trajectory_loss(trajectories, ref_trajectories)
 
+class TrajectorySurrogate(object):
+    '''
+    Cheap approximation of the trajectory loss used to pre-screen child genomes before an exact evaluation.
+    The loss is evaluated on the central eval line only, sub-sampled every stride steps along the S axis.
+    A random calibration sample of the children, drawn before selection, is also evaluated exactly to measure how well
+    the surrogate ranks them, and children are not pre-screened while that rank correlation is below min_correlation.
+    '''
+    def __init__(self, info, lookup, ref_bfield, stride=4, fraction=0.2, calibration=0.1, min_correlation=None):
+        self.stride = stride
+        self.init_selection(fraction, calibration, min_correlation)
+
+        # Indices of the central eval line matching calculate_normalized_trajectory
+        self.i = ((ref_bfield.shape[0] + 1) // 2) - 1
+        self.j = ((ref_bfield.shape[1] + 1) // 2) - 1
+
+        # Trapezium integration along the sub-sampled S axis uses a proportionally larger step size
+        self.info = dict(info, sstep=(info['sstep'] * stride))
+
+        # Contiguous copy of the sub-sampled lookup so per child column gathers stay cheap
+        self.lookup = { beam : (np.ascontiguousarray(self.project_bfield(beam_lookup))
+                                if isinstance(beam_lookup, np.ndarray) else
+                                beam_lookup.project(self.i, self.j, self.stride))
+                        for beam, beam_lookup in lookup.items() }
+
+        self.ref_trajectories = calculate_trajectories(self.info, self.project_bfield(ref_bfield))
+
+    def init_selection(self, fraction, calibration, min_correlation):
+        self.fraction        = fraction
+        self.calibration     = calibration
+        self.min_correlation = min_correlation
+
+        # Children are only pre-screened while the surrogate ranks the calibration sample well enough
+        self.trusted = True
+
+        # Pairs of (surrogate loss, exact loss) for the calibration sample of children
+        self.samples = []
+
+    def project_bfield(self, bfield):
+        # Works for both bfields (x, z, s, 3) and lookups (x, z, s, 3, 3, n) as the leading axes match
+        return bfield[self.i:(self.i + 1), self.j:(self.j + 1), ::self.stride]
+
+    def calculate_loss(self, parent_bfield, differences):
+        # Apply the child's magnet differences to the sub-sampled parent bfield
+        per_beam_bfield_updates = compare_magnet_differences(differences, self.lookup)
+        child_bfield = parent_bfield - sum(per_beam_bfield_updates.values())
+        return calculate_trajectory_loss_from_array(self.info, child_bfield, self.ref_trajectories)
+
+    def num_selected(self, number_of_children):
+        # Always fully evaluate at least one child so every parent produces offspring
+        return max(1, int(np.ceil(self.fraction * number_of_children)))
+
+    def sample_calibration(self, number_of_children):
+        # Random children to evaluate exactly whether or not they are selected, ranking only the selected children
+        # would measure the correlation over the range the surrogate already ranks best
+        num_calibration = min(number_of_children, int(np.ceil(self.calibration * number_of_children)))
+        return sorted(random.sample(range(number_of_children), num_calibration))
+
+    def add_samples(self, surrogate_losses, exact_losses):
+        self.samples += list(zip(surrogate_losses, exact_losses))
+
+    def rank_correlation(self, reset=True):
+        # Spearman rank correlation between surrogate and exact losses of the calibration sample of children,
+        # stop pre-screening while it is below the minimum and start again once it recovers
+        correlation = np.nan
+        if len(self.samples) > 2:
+            correlation = spearmanr(*zip(*self.samples))[0]
+
+            if (self.min_correlation is not None) and not np.isnan(correlation):
+                trusted = bool(correlation >= self.min_correlation)
+                if trusted != self.trusted:
+                    logger.info('Surrogate rank correlation %0.4f is %s the minimum %0.4f, %s pre-screening children',
+                                correlation, ('above' if trusted else 'below'), self.min_correlation,
+                                ('resuming' if trusted else 'suspending'))
+                self.trusted = trusted
+
+        num_samples = len(self.samples)
+        if reset:
+            self.samples = []
+
+        return correlation, num_samples
+
+
+class IntegralSurrogate(TrajectorySurrogate):
+    '''
+    Cheap approximation of the trajectory loss from a field integral lookup, which holds the first and second field
+    integrals of every magnet at the ends of a few blocks of the S axis. The loss is evaluated on the trajectory at the
+    block ends only, so screening a child costs O(n) lookup values instead of O(s * n).
+    '''
+    def __init__(self, info, integral_lookup, block_ends, ref_bfield, fraction=0.2, calibration=0.1, min_correlation=None):
+        self.init_selection(fraction, calibration, min_correlation)
+        self.lookup = integral_lookup
+
+        # The block ends stored with the field integrals must lie on the S axis of the bfields being screened
+        num_s = ref_bfield.shape[2]
+        if (len(block_ends) == 0) or np.any(np.diff(block_ends) <= 0) or (block_ends[0] < 0) or (block_ends[-1] != (num_s - 1)):
+            error_message = f'Field integral block ends {list(block_ends)} do not match the {num_s} S steps of the reference bfield'
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        for beam, beam_lookup in integral_lookup.items():
+            if (tuple(beam_lookup.shape[:2]) != tuple(ref_bfield.shape[:2])) or (beam_lookup.shape[2] != (2 * len(block_ends))):
+                error_message = f'Field integrals of beam [{beam}] with shape [{beam_lookup.shape}] do not match ' \
+                                f'{len(block_ends)} block ends and the reference bfield with shape [{ref_bfield.shape}]'
+                logger.error(error_message)
+                raise Exception(error_message)
+
+        self.weights = calculate_integral_weights(info, num_s, block_ends)
+
+        self.ref_trajectories = integrals_to_trajectories(self.project_bfield(ref_bfield))
+
+    def project_bfield(self, bfield):
+        # Field integrals (x, z, 2 * k, 3) of a bfield (x, z, s, 3) at the block ends
+        return np.moveaxis(np.tensordot(bfield, self.weights, axes=([2], [1])), -1, 2)
+
+    def calculate_loss(self, parent_integrals, differences):
+        # Apply the child's magnet differences to the parent's field integrals
+        per_beam_integral_updates = compare_magnet_differences(differences, self.lookup)
+        child_integrals = parent_integrals - sum(per_beam_integral_updates.values())
+        return calculate_trajectory_loss(integrals_to_trajectories(child_integrals), self.ref_trajectories)
+
+
+class BandedLookup(object):
+    '''
+    Lookup table for a single beam that only stores the window along the S axis where each magnet's contribution
+    exceeds a tolerance. Each column keeps its own S offset and window width and the windows are packed one after the
+    other along S (x, z, sum of widths, 3, 3), so a wide or all-zero column does not grow the storage of the others.
+    '''
+
+    def __init__(self, data, offsets, widths, num_s, truncation_error=0.0, truncation_bound=0.0):
+        self.data    = data
+        self.offsets = offsets
+        self.widths  = widths
+        self.starts  = np.concatenate(([0], np.cumsum(widths)[:-1])).astype(np.int64)
+        self.shape   = (*data.shape[:2], num_s, *data.shape[3:], len(widths))
+
+        # Largest lookup value that was discarded, and a bound on the bfield error per unit of magnetisation
+        self.truncation_error = truncation_error
+        self.truncation_bound = truncation_bound
+
+    @classmethod
+    def from_dense(cls, lookup, tolerance):
+        # Works on any array like supporting column slicing, so a beam can be converted straight from an HDF5 dataset
+        num_s, num_magnets = lookup.shape[2], lookup.shape[5]
+
+        # Find the window along S where each column's contribution exceeds the tolerance relative to its peak,
+        # columns that contribute nothing anywhere are stored with an empty window
+        envelopes = [np.max(np.abs(lookup[..., m]), axis=(0, 1, 3, 4)) for m in range(num_magnets)]
+        windows   = [np.flatnonzero(envelope >= (tolerance * np.max(envelope))) if np.max(envelope) > 0 else []
+                     for envelope in envelopes]
+        offsets   = np.array([(window[0] if len(window) > 0 else 0) for window in windows], dtype=np.int64)
+        widths    = np.array([(((window[-1] - window[0]) + 1) if len(window) > 0 else 0) for window in windows],
+                             dtype=np.int64)
+
+        data = np.zeros((*lookup.shape[:2], np.sum(widths), *lookup.shape[3:5]))
+        truncated = np.zeros(num_magnets)
+        start = 0
+        for m, (envelope, offset, width) in enumerate(zip(envelopes, offsets, widths)):
+            data[:, :, start:(start + width)] = lookup[..., m][:, :, offset:(offset + width)]
+            truncated[m] = max(np.max(envelope[:offset], initial=0), np.max(envelope[(offset + width):], initial=0))
+            start += width
+
+        # Each magnet contributes through 3 field components so the bfield error is bounded by the sum over columns
+        return cls(data, offsets, widths, num_s, truncation_error=np.max(truncated),
+                   truncation_bound=(3 * np.sum(truncated)))
+
+    @classmethod
+    def read(cls, group):
+        return cls(group['data'][...], group['offsets'][...], group['widths'][...], int(group.attrs['num_s']),
+                   truncation_error=group.attrs['truncation_error'], truncation_bound=group.attrs['truncation_bound'])
+
+    def write(self, group):
+        group.attrs['format']           = 'banded'
+        group.attrs['num_s']            = self.shape[2]
+        group.attrs['truncation_error'] = self.truncation_error
+        group.attrs['truncation_bound'] = self.truncation_bound
+        group.create_dataset('data', data=self.data)
+        group.create_dataset('offsets', data=self.offsets)
+        group.create_dataset('widths', data=self.widths)
+
+    def contract_columns(self, columns, difference):
+        # Contract the windows of the given columns with the magnet values (3, n) and add them into the full bfield
+        bfield = np.zeros(self.shape[:4])
+
+        for column, values in zip(np.arange(self.shape[5])[columns], difference.T):
+            offset, width, start = self.offsets[column], self.widths[column], self.starts[column]
+            bfield[:, :, offset:(offset + width)] += np.dot(self.data[:, :, start:(start + width)], values)
+
+        return bfield
+
+    def contract(self, beam_array):
+        return self.contract_columns(slice(None), beam_array)
+
+    def project(self, i, j, stride):
+        # Dense lookup (1, 1, s / stride, 3, 3, n) of a single eval line sub-sampled along S
+        steps  = np.arange(0, self.shape[2], stride)
+        dense  = np.zeros((1, 1, len(steps), *self.shape[3:]))
+
+        for m, (offset, width, start) in enumerate(zip(self.offsets, self.widths, self.starts)):
+            in_window = (steps >= offset) & (steps < (offset + width))
+            dense[0, 0, in_window, ..., m] = self.data[i, j, (start + steps[in_window] - offset)]
+
+        return dense
+
+    def transverse(self):
+        # Only keep the rows of the X and Z field components
+        return BandedLookup(np.ascontiguousarray(self.data[..., :2, :]), self.offsets, self.widths, self.shape[2],
+                            truncation_error=self.truncation_error, truncation_bound=self.truncation_bound)
+
+
+class MagnetMajorLookup(object):
+    '''
+    Lookup table for a single beam stored magnet-major as an (n * 3, points * 3) matrix. The rows of the magnets that
+    change in a delta evaluation are contiguous in memory and evaluating a whole beam is a single matrix product.
+    '''
+
+    def __init__(self, matrix, shape):
+        self.matrix = matrix
+        self.shape  = shape
+
+    @classmethod
+    def from_dense(cls, lookup):
+        # Transpose the point-major (x, z, s, 3, 3, n) lookup so each magnet's (3, x, z, s, 3) block is contiguous
+        *points, rows, columns, num_magnets = lookup.shape
+        matrix = np.ascontiguousarray(np.transpose(lookup, (5, 4, 0, 1, 2, 3)))
+        return cls(matrix.reshape((num_magnets * columns), -1), lookup.shape)
+
+    @classmethod
+    def read(cls, dataset):
+        # Magnet-major datasets are stored as (n, 3, x, z, s, 3)
+        num_magnets, columns, *points, rows = dataset.shape
+        return cls(dataset[...].reshape((num_magnets * columns), -1), (*points, rows, columns, num_magnets))
+
+    def contract_columns(self, columns, difference):
+        # Gather the rows of the given magnets and contract them with the magnet values (3, n)
+        rows = self.matrix.reshape(self.shape[5], self.shape[4], -1)[columns]
+        bfield = np.tensordot(difference.T, rows, axes=2)
+        return bfield.reshape(*self.shape[:4])
+
+    def contract(self, beam_array):
+        # Magnet values (3, n) ordered to match the rows of the matrix
+        bfield = np.dot(beam_array.T.reshape(-1), self.matrix)
+        return bfield.reshape(*self.shape[:4])
+
+    def project(self, i, j, stride):
+        # Dense lookup (1, 1, s / stride, 3, 3, n) of a single eval line sub-sampled along S
+        blocks = self.matrix.reshape(self.shape[5], self.shape[4], *self.shape[:4])
+        line   = blocks[:, :, i, j, ::stride]
+        return np.ascontiguousarray(np.transpose(line, (2, 3, 1, 0)))[np.newaxis, np.newaxis]
+
+    def transverse(self):
+        # Only keep the rows of the X and Z field components
+        num_magnets, columns = self.shape[5], self.shape[4]
+        matrix = self.matrix.reshape((num_magnets * columns), -1, self.shape[3])[..., :2]
+        return MagnetMajorLookup(np.ascontiguousarray(matrix).reshape((num_magnets * columns), -1),
+                                 (*self.shape[:3], 2, *self.shape[4:]))
+
+    def decimate(self, stride):
+        # Only keep the rows of every stride'th S sample
+        num_magnets, columns = self.shape[5], self.shape[4]
+        matrix = self.matrix.reshape((num_magnets * columns), *self.shape[:4])[:, :, :, ::stride]
+        return MagnetMajorLookup(np.ascontiguousarray(matrix).reshape((num_magnets * columns), -1),
+                                 (*self.shape[:2], matrix.shape[3], *self.shape[3:]))
+
+
+def calculate_randomized_svd(matrix, rank, power_iterations=2, rng=None):
+    # Truncated SVD (u, s, vt) of a matrix from a random sample of its range, refined by a few power iterations
+    rng   = np.random.default_rng(0) if rng is None else rng
+    basis = np.linalg.qr(np.dot(matrix, rng.standard_normal((matrix.shape[1], rank))))[0]
+
+    for _ in range(power_iterations):
+        basis = np.linalg.qr(np.dot(matrix.T, basis))[0]
+        basis = np.linalg.qr(np.dot(matrix, basis))[0]
+
+    u, s, vt = np.linalg.svd(np.dot(basis.T, matrix), full_matrices=False)
+    return np.dot(basis, u), s, vt
+
+
+class LowRankLookup(object):
+    '''
+    Lookup table for a single beam stored as a rank r factorisation of its magnet-major (n * 3, points * 3) matrix,
+    a (n * 3, r) matrix of magnet factors and a (r, points * 3) matrix of point factors. Neighbouring magnets have
+    near identical shifted fields so r is small, and contracting a beam costs O(r * (points + n)) instead of O(points * n).
+    '''
+
+    def __init__(self, magnets, points, shape, approximation_error=0.0, approximation_bound=0.0):
+        self.magnets = magnets
+        self.points  = points
+        self.shape   = shape
+
+        # Largest lookup value error, and a bound on the bfield error per unit of magnetisation
+        self.approximation_error = approximation_error
+        self.approximation_bound = approximation_bound
+
+    @property
+    def rank(self):
+        return self.magnets.shape[1]
+
+    @classmethod
+    def from_dense(cls, lookup, tolerance, oversampling=8, power_iterations=2, chunk_size=256):
+        # Keep the singular values larger than the tolerance relative to the largest one, doubling the size of the
+        # random sample until it holds all of them plus some oversampling
+        matrix   = MagnetMajorLookup.from_dense(lookup).matrix
+        max_rank = min(matrix.shape)
+        rng      = np.random.default_rng(0)
+
+        sample = min(max_rank, 32)
+        while True:
+            u, s, vt = calculate_randomized_svd(matrix, sample, power_iterations, rng)
+            rank = max(1, int(np.count_nonzero(s >= (tolerance * s[0]))))
+            if ((rank + oversampling) <= sample) or (sample == max_rank):
+                break
+            sample = min(max_rank, (2 * sample))
+
+        magnets, points = (u[:, :rank] * s[:rank]), vt[:rank]
+
+        # Each magnet contributes through 3 field components so the bfield error is bounded by the sum over rows
+        error, bound = 0.0, np.zeros(matrix.shape[1])
+        for start in range(0, matrix.shape[0], chunk_size):
+            residual = matrix[start:(start + chunk_size)] - np.dot(magnets[start:(start + chunk_size)], points)
+            error    = max(error, np.max(np.abs(residual)))
+            bound   += np.sum(np.abs(residual), axis=0)
+
+        return cls(magnets, points, lookup.shape, approximation_error=error, approximation_bound=np.max(bound))
+
+    @classmethod
+    def read(cls, group):
+        return cls(group['magnets'][...], group['points'][...], tuple(group.attrs['shape']),
+                   approximation_error=group.attrs['approximation_error'],
+                   approximation_bound=group.attrs['approximation_bound'])
+
+    def write(self, group):
+        group.attrs['format']              = 'low-rank'
+        group.attrs['shape']               = self.shape
+        group.attrs['approximation_error'] = self.approximation_error
+        group.attrs['approximation_bound'] = self.approximation_bound
+        group.create_dataset('magnets', data=self.magnets)
+        group.create_dataset('points', data=self.points)
+
+    def contract_columns(self, columns, difference):
+        # Project the magnet values (3, n) of the given magnets onto the rank r basis before expanding to the points
+        factors = self.magnets.reshape(self.shape[5], self.shape[4], -1)[columns]
+        bfield  = np.dot(np.tensordot(difference.T, factors, axes=2), self.points)
+        return bfield.reshape(*self.shape[:4])
+
+    def contract(self, beam_array):
+        # Magnet values (3, n) ordered to match the rows of the magnet factors
+        bfield = np.dot(np.dot(beam_array.T.reshape(-1), self.magnets), self.points)
+        return bfield.reshape(*self.shape[:4])
+
+    def project(self, i, j, stride):
+        # Dense lookup (1, 1, s / stride, 3, 3, n) of a single eval line sub-sampled along S
+        line    = self.points.reshape(self.rank, *self.shape[:4])[:, i, j, ::stride]
+        factors = self.magnets.reshape(self.shape[5], self.shape[4], self.rank)
+        return np.einsum('rsw,ncr->swcn', line, factors)[np.newaxis, np.newaxis]
+
+    def transverse(self):
+        # Only keep the point factors of the X and Z field components
+        points = self.points.reshape(self.rank, -1, self.shape[3])[..., :2]
+        return LowRankLookup(self.magnets, np.ascontiguousarray(points).reshape(self.rank, -1),
+                             (*self.shape[:3], 2, *self.shape[4:]),
+                             approximation_error=self.approximation_error, approximation_bound=self.approximation_bound)
+
+    def decimate(self, stride):
+        # Only keep the point factors of every stride'th S sample
+        points = self.points.reshape(self.rank, *self.shape[:4])[:, :, :, ::stride]
+        return LowRankLookup(self.magnets, np.ascontiguousarray(points).reshape(self.rank, -1),
+                             (*self.shape[:2], points.shape[3], *self.shape[3:]),
+                             approximation_error=self.approximation_error, approximation_bound=self.approximation_bound)
+
+
+class ConvolutionLookup(object):
+    '''
+    Lookup table for a single beam that holds the periodic interior of the device as one kernel per group of magnets
+    sharing dimensions and X/Z position, translated along S by whole eval point steps. The bfield of a group is the
+    convolution along S of its kernel with the sequence of rotated magnet values, evaluated with FFTs in O(s log s)
+    instead of O(s * n). Magnets that fit no group, such as the ends of the device, are held as explicit columns.
+    '''
+
+    def __init__(self, kernels, groups, explicit, explicit_magnets, shape, convolution_error=0.0):
+        # Kernels (x, z, s + max shift, 3, 3) with groups of (magnets, shifts, direction matrices) they are applied to
+        self.kernels  = kernels
+        self.groups   = groups
+        self.explicit = explicit
+        self.shape    = shape
+        self.convolution_error = convolution_error
+
+        # Group index and position within the group of every magnet, or the explicit column of ungrouped magnets
+        self.columns = {}
+        for g, (magnets, shifts, directions) in enumerate(groups):
+            for index, a in enumerate(magnets):
+                self.columns[a] = (g, index)
+        for index, a in enumerate(explicit_magnets):
+            self.columns[a] = (None, index)
+        self.explicit_magnets = np.asarray(explicit_magnets, dtype=np.int64)
+
+        # Every kernel is zero padded to a common FFT length and rolled by its max shift, so the bfields of all groups
+        # start at the first S step and can be summed before a single inverse FFT
+        num_s = shape[2]
+        self.fft_size = scipy.fft.next_fast_len(max([kernel.shape[2] for kernel in kernels], default=num_s), real=True)
+        self.kernel_spectra = np.stack([scipy.fft.rfft(np.roll(np.pad(kernel, ((0, 0), (0, 0), (0, (self.fft_size - kernel.shape[2])), (0, 0), (0, 0))),
+                                                               -np.max(shifts), axis=2), axis=2)
+                                        for kernel, (magnets, shifts, directions) in zip(kernels, groups)]) if len(kernels) > 0 else None
+
+    @classmethod
+    def from_dense(cls, lookup, beam, sstep, offsets=None, tolerance=1e-6, min_magnets=8):
+        # Group the magnets of the beam by dimensions, X/Z position, and position along S within an eval point step,
+        # magnets moved by shim or random offsets are not translated copies of the others so they are kept explicit
+        num_s, num_magnets = lookup.shape[2], lookup.shape[5]
+
+        positions  = np.array([mag['position'] for mag in beam['mags']], dtype=np.float64)
+        dimensions = np.array([mag['dimensions'] for mag in beam['mags']], dtype=np.float64)
+        directions = np.array([mag['direction_matrix'] for mag in beam['mags']], dtype=np.float64)
+
+        candidates = {}
+        for a in range(num_magnets):
+            if (offsets is not None) and np.any(offsets[a] != 0): continue
+
+            steps = positions[a, 2] / sstep
+            phase = int(np.round((steps - np.floor(steps)) * 1e6)) % 1000000
+            candidates.setdefault((*dimensions[a], positions[a, 0], positions[a, 1], phase), []).append(a)
+
+        # Kernels are only worthwhile for the long runs of magnets in the periodic interior of the device
+        kernels, groups, error = [], [], 0.0
+        scale = np.max(np.abs(lookup))
+        for magnets in candidates.values():
+            if len(magnets) < min_magnets: continue
+
+            magnets = np.array(magnets, dtype=np.int64)
+            shifts  = np.round((positions[magnets, 2] - positions[magnets[0], 2]) / sstep).astype(np.int64)
+            shifts -= np.min(shifts)
+
+            # Column a is the kernel from S step (max shift - shift a) rotated into the magnet's coordinate system
+            max_shift = np.max(shifts)
+            kernel = np.zeros((*lookup.shape[:2], (num_s + max_shift), *lookup.shape[3:5]))
+            for a, shift in zip(magnets, shifts):
+                start = max_shift - shift
+                kernel[:, :, start:(start + num_s)] = np.dot(lookup[..., a], np.linalg.inv(directions[a]))
+
+            # Only keep the magnets whose columns the kernel reproduces
+            errors = np.array([np.max(np.abs(np.dot(kernel[:, :, (max_shift - shift):(max_shift - shift + num_s)], directions[a]) - lookup[..., a]))
+                               for a, shift in zip(magnets, shifts)])
+            matched = (errors <= (tolerance * scale))
+            if np.count_nonzero(matched) < min_magnets: continue
+
+            kernels += [kernel]
+            groups  += [(magnets[matched], shifts[matched], directions[magnets[matched]])]
+            error    = max(error, np.max(errors[matched]))
+
+        grouped  = set(np.concatenate([magnets for magnets, _, _ in groups]).tolist()) if len(groups) > 0 else set()
+        explicit_magnets = [a for a in range(num_magnets) if a not in grouped]
+
+        return cls(kernels, groups, np.ascontiguousarray(lookup[..., explicit_magnets]), explicit_magnets, lookup.shape,
+                   convolution_error=error)
+
+    def column(self, a, steps=slice(None)):
+        # Lookup column (x, z, s, 3, 3) of a single magnet
+        g, index = self.columns[a]
+        if g is None:
+            return self.explicit[:, :, steps, ..., index]
+
+        magnets, shifts, directions = self.groups[g]
+        start = np.max(shifts) - shifts[index]
+        return np.dot(self.kernels[g][:, :, start:(start + self.shape[2])][:, :, steps], directions[index])
+
+    def contract_columns(self, columns, difference):
+        # Delta evaluations only touch a few magnets so their columns are contracted directly
+        bfield = np.zeros(self.shape[:4])
+        for a, values in zip(columns, difference.T):
+            bfield += np.dot(self.column(a), values)
+        return bfield
+
+    def contract(self, beam_array):
+        bfield = np.zeros(self.shape[:4])
+
+        if len(self.explicit_magnets) > 0:
+            bfield += np.tensordot(self.explicit, beam_array[:, self.explicit_magnets], axes=([4, 5], [0, 1]))
+
+        if self.kernel_spectra is not None:
+            # Sequence (fft size, 3) of the magnet values rotated by their direction matrices at the shift of each magnet
+            sequences = np.zeros((len(self.groups), self.fft_size, 3))
+            for g, (magnets, shifts, directions) in enumerate(self.groups):
+                sequences[g, shifts] = np.einsum('nrc,cn->nr', directions, beam_array[:, magnets])
+
+            spectrum = np.einsum('gxzfrc,gfc->xzfr', self.kernel_spectra, scipy.fft.rfft(sequences, axis=1))
+            bfield  += scipy.fft.irfft(spectrum, n=self.fft_size, axis=2)[:, :, :self.shape[2]]
+
+        return bfield
+
+    def project(self, i, j, stride):
+        # Dense lookup (1, 1, s / stride, 3, 3, n) of a single eval line sub-sampled along S
+        line = np.stack([self.column(a, slice(None, None, stride))[i, j] for a in range(self.shape[5])], axis=-1)
+        return line[np.newaxis, np.newaxis]
+
+    def transverse(self):
+        # Only keep the rows of the X and Z field components
+        return ConvolutionLookup([kernel[..., :2, :] for kernel in self.kernels], self.groups,
+                                 np.ascontiguousarray(self.explicit[..., :2, :, :]), self.explicit_magnets,
+                                 (*self.shape[:3], 2, *self.shape[4:]), convolution_error=self.convolution_error)
+
+
+class TiledLookup(object):
+    '''
+    Lookup table for a single beam that stays on disk and is contracted one tile of the S axis at a time, so bfields
+    can be evaluated for lookups larger than memory. The next tile is read while the current one is contracted.
+    '''
+
+    def __init__(self, dataset, memory_budget=256):
+        self.dataset = dataset
+
+        self.magnet_major = (dataset.attrs.get('layout', 'point-major') == 'magnet-major')
+        if self.magnet_major:
+            num_magnets, columns, *points, rows = dataset.shape
+            self.shape = (*points, rows, columns, num_magnets)
+        else:
+            self.shape = dataset.shape
+
+        # Two tiles are held at once, the one being contracted and the one being read ahead
+        step_bytes = (np.prod(self.shape) // self.shape[2]) * dataset.dtype.itemsize
+        self.tile_size = max(1, int((memory_budget * (1024 ** 2)) // (2 * step_bytes)))
+
+    def read_tile(self, start, end, columns):
+        # Read a tile (x, z, end - start, 3, 3, k) of the given columns
+        if self.magnet_major:
+            return np.transpose(self.dataset[columns, :, :, :, start:end], (2, 3, 4, 5, 1, 0))
+        return self.dataset[:, :, start:end, ..., columns]
+
+    def contract_columns(self, columns, difference):
+        # HDF5 selections must be in increasing order so sort the columns along with their magnet values
+        if not isinstance(columns, slice):
+            order      = np.argsort(columns)
+            columns    = np.asarray(columns)[order]
+            difference = difference[:, order]
+
+        bfield = np.zeros(self.shape[:4])
+        tiles  = [(start, min((start + self.tile_size), self.shape[2])) for start in range(0, self.shape[2], self.tile_size)]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.read_tile, *tiles[0], columns)
+
+            for index, (start, end) in enumerate(tiles):
+                tile = pending.result()
+
+                # Read ahead the next tile while this one is contracted
+                if (index + 1) < len(tiles):
+                    pending = executor.submit(self.read_tile, *tiles[index + 1], columns)
+
+                bfield[:, :, start:end] = np.tensordot(tile, difference, axes=([4, 5], [0, 1]))
+
+        return bfield
+
+    def contract(self, beam_array):
+        return self.contract_columns(slice(None), beam_array)
+
+
+def read_lookup(node, magnet_major=False, transverse=False):
+    # Dense lookups are stored as plain datasets, compact formats as groups tagged with their format
+    if isinstance(node, h5py.Group):
+        lookup_format = node.attrs.get('format', None)
+
+        if lookup_format == 'banded':
+            lookup = BandedLookup.read(node)
+            return lookup.transverse() if transverse else lookup
+
+        if lookup_format == 'low-rank':
+            lookup = LowRankLookup.read(node)
+            return lookup.transverse() if transverse else lookup
+
+        error_message = f'Unknown lookup format [{lookup_format}] for [{node.name}]'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    if node.attrs.get('layout', 'point-major') == 'magnet-major':
+        lookup = MagnetMajorLookup.read(node)
+        return lookup.transverse() if transverse else lookup
+
+    # Only read the rows of the X and Z field components from disk
+    lookup = node[..., :2, :, :] if transverse else node[...]
+
+    # Point-major lookups can be transposed in memory to be evaluated magnet-major
+    if magnet_major:
+        return MagnetMajorLookup.from_dense(lookup)
+
+    return lookup
+
+def decimate_lookup(beam_lookup, stride):
+    # Lookup of every stride'th S sample, evaluating it with an S step size stride times larger gives a coarse bfield
+    if isinstance(beam_lookup, np.ndarray):
+        return np.ascontiguousarray(beam_lookup[:, :, ::stride])
+
+    if isinstance(beam_lookup, (MagnetMajorLookup, LowRankLookup)):
+        return beam_lookup.decimate(stride)
+
+    error_message = f'Cannot decimate lookups of type [{type(beam_lookup).__name__}] along the S axis'
+    logger.error(error_message)
+    raise Exception(error_message)
+
+def select_lookup_gap(fp, gap=None):
+    # Groups holding the beams of the lookup with the weight of each, gap scans hold the lookup of every gap in its own
+    # group and a gap between two scanned gaps is linearly interpolated from the lookups either side of it
+    if 'gaps' not in fp.attrs:
+        if gap is not None:
+            error_message = f'Lookup [{fp.filename}] is not a gap scan to select gap [{gap}] from'
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        return [(fp, 1.0)]
+
+    gaps = fp.attrs['gaps']
+    if gap is None:
+        error_message = f'Lookup [{fp.filename}] is a gap scan of gaps {gaps.tolist()}, select one of them'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    upper = int(np.searchsorted(gaps, gap))
+    if (upper < len(gaps)) and np.isclose(gaps[upper], gap, rtol=0, atol=1e-6):
+        return [(fp[f'gap-{upper}'], 1.0)]
+
+    if (upper > 0) and np.isclose(gaps[upper - 1], gap, rtol=0, atol=1e-6):
+        return [(fp[f'gap-{upper - 1}'], 1.0)]
+
+    if (upper == 0) or (upper == len(gaps)):
+        error_message = f'Gap [{gap}] is outside of the gaps {gaps.tolist()} in lookup [{fp.filename}]'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    weight = (gap - gaps[upper - 1]) / (gaps[upper] - gaps[upper - 1])
+    logger.info('Interpolating gap [%f] between gaps [%f] and [%f]', gap, gaps[upper - 1], gaps[upper])
+    return [(fp[f'gap-{upper - 1}'], (1.0 - weight)), (fp[f'gap-{upper}'], weight)]
+
+def interpolate_lookups(lookups):
+    # Weighted sum of the lookups of a beam at several gaps
+    (lookup, weight), *lookups = lookups
+    if len(lookups) == 0:
+        return lookup
+
+    if isinstance(lookup, MagnetMajorLookup):
+        matrix = weight * lookup.matrix
+        for other, other_weight in lookups:
+            matrix += other_weight * other.matrix
+        return MagnetMajorLookup(matrix, lookup.shape)
+
+    if isinstance(lookup, np.ndarray):
+        lookup = weight * lookup
+        for other, other_weight in lookups:
+            lookup += other_weight * other
+        return lookup
+
+    error_message = f'Cannot interpolate lookups of type [{type(lookup).__name__}] between gaps'
+    logger.error(error_message)
+    raise Exception(error_message)
+
+def load_lookup(filename, info, magnet_major=False, transverse=False, gap=None, convolution=False):
+    # Load the lookup table of every beam in the device, in whichever format each beam was stored
+    # Optimisation only needs the X and Z field components, so transverse lookups drop the rows of the S component
+    # Convolution lookups evaluate the periodic interior of each beam with FFTs along S and the rest as explicit columns
+    with h5py.File(filename, 'r') as fp:
+        groups = select_lookup_gap(fp, gap)
+
+        lookup = {}
+        for beam in info['beams']:
+            lookup[beam['name']] = interpolate_lookups([(read_lookup(group[beam['name']], magnet_major=(magnet_major and not convolution), transverse=transverse), weight)
+                                                        for group, weight in groups])
+
+            if convolution:
+                if not isinstance(lookup[beam['name']], np.ndarray):
+                    error_message = f'Beam [{beam["name"]}] in [{filename}] must be a dense lookup to be evaluated by convolution'
+                    logger.error(error_message)
+                    raise Exception(error_message)
+
+                # Magnets with shim or random offsets are not translated copies of their neighbours
+                offsets = groups[0][0][beam['name']].attrs.get('offsets', None)
+                lookup[beam['name']] = ConvolutionLookup.from_dense(lookup[beam['name']], beam, info['sstep'], offsets=offsets)
+
+                logger.info('Beam [%s] %d of %d magnets evaluated by convolution with %d kernels, max error [%E]',
+                            beam['name'], (lookup[beam['name']].shape[5] - len(lookup[beam['name']].explicit_magnets)),
+                            lookup[beam['name']].shape[5], len(lookup[beam['name']].kernels), lookup[beam['name']].convolution_error)
+
+            logger.debug('Loaded beam [%s] with shape [%s]', beam['name'], lookup[beam['name']].shape)
+
+    return lookup
+
+def load_integral_block_ends(filename, info, gap=None):
+    # Block ends of the S axis that the field integrals in a companion lookup were summed up to
+    with h5py.File(filename, 'r') as fp:
+        block_ends = [group[beam['name']].attrs['block_ends'] for group, weight in select_lookup_gap(fp, gap)
+                                                              for beam in info['beams']]
+
+    if any(not np.array_equal(block_ends[0], beam_block_ends) for beam_block_ends in block_ends):
+        error_message = f'Field integrals in [{filename}] were summed up to different block ends for different beams'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    return block_ends[0]
+
 def calculate_trajectories(info, bfield, energy=3.0):
     # Diamond synchrotron 3 GeV storage ring
     const = (0.03 / energy) * 1e-2 # Unknown constant... evaluates to 1e-4 for 3 GeV storage ring
@@ -286,6 +1065,38 @@ def calculate_trajectories(info, bfield, energy=3.0):
 
     return trajectories
 
+def calculate_block_ends(num_s, num_blocks):
+    # Last S step of each of num_blocks equal blocks of the S axis, every S step is a block if there are fewer
+    num_blocks = min(num_blocks, num_s)
+    return ((np.arange(1, (num_blocks + 1)) * num_s) // num_blocks) - 1
+
+def calculate_integral_weights(info, num_s, block_ends, energy=3.0):
+    # Weights (2 * k, s) giving the first and second field integrals that calculate_trajectories accumulates with the
+    # trapezium rule, at the k block ends of the S axis, as both are linear in the bfield
+    const = (0.03 / energy) * 1e-2 # Same constant as calculate_trajectories
+    h     = info['sstep']
+
+    ends  = np.asarray(block_ends)[:, np.newaxis]
+    steps = np.arange(num_s)[np.newaxis, :]
+
+    # Samples before a block end have their full step size and the sample at the end half of it
+    first  = const * h * np.where((steps < ends), 1.0, np.where((steps == ends), 0.5, 0.0))
+    second = const * (h ** 2) * np.where((steps < ends), (ends - steps), np.where((steps == ends), 0.25, 0.0))
+
+    return np.concatenate([first, second], axis=0)
+
+def integrals_to_trajectories(integrals):
+    # Trajectories (x, z, k, 4) at the block ends from the first and second field integrals (x, z, 2 * k, 3),
+    # ordered and signed to match calculate_trajectories
+    num_blocks = integrals.shape[2] // 2
+    first, second = integrals[..., :num_blocks, :2], integrals[..., num_blocks:, :2]
+    return np.concatenate([second[..., ::-1], first[..., ::-1]], axis=-1) * np.array([-1, 1, -1, 1])
+
+def calculate_integral_loss(info, integral_lookup, magnets, maglist, ref_trajectories):
+    # Trajectory loss at the block ends of a field integral lookup
+    integrals = generate_bfield(info, maglist, magnets, integral_lookup)
+    return calculate_trajectory_loss(integrals_to_trajectories(integrals), ref_trajectories)
+
 def calculate_bfield_phase_error(info, bfield):
     # TODO move ring energy into device JSON file as devices are tied to specific facilities
     energy             = 3.0                           # Diamond synchrotron 3 GeV storage ring
@@ -373,24 +1184,34 @@ def calculate_trajectory_straightness(info, trajectories):
     strz   = np.max(zabs)
     return strx, strz
 
-def write_bfields(filename, id_filename, lookup_filename, magnets_filename, maglist):
+def write_bfields(filename, id_filename, lookup_filename, magnets_filename, maglist, memory_budget=None, gap=None):
 
     # Load JSON configuration for a given device describing magnet types and positions and dimensions
     with open(id_filename, 'r') as fp:
         info = json.load(fp)
 
-    # Load lookup table for a given device configuration measured at a grid of sample locations along the device gap
-    with h5py.File(lookup_filename, 'r') as fp:
-        lookup = {}
-        for beam in info['beams']:
-            lookup[beam['name']] = fp[beam['name']][...]
-
     # Load a set of real magnets and generate a set of perfect reference magnets mimicking the real magnets
     mags = Magnets()
     mags.load(magnets_filename)
     ref_mags = generate_reference_magnets(mags)
 
-    with h5py.File(filename, 'w') as fp:
+    with h5py.File(lookup_filename, 'r') as lookup_fp, h5py.File(filename, 'w') as fp:
+
+        # Load lookup table for a given device configuration measured at a grid of sample locations along the device gap
+        # With a memory budget the lookup stays on disk and is contracted in tiles along the S axis instead
+        groups = select_lookup_gap(lookup_fp, gap)
+        if memory_budget is not None:
+
+            if len(groups) > 1:
+                error_message = f'Cannot interpolate gap [{gap}] of lookup [{lookup_filename}] in tiles, select one of the scanned gaps'
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            logger.info('Evaluating lookup [%s] in tiles using at most %d MB', lookup_filename, memory_budget)
+            lookup = { beam['name'] : TiledLookup(groups[0][0][beam['name']], memory_budget) for beam in info['beams'] }
+        else:
+            lookup = { beam['name'] : interpolate_lookups([(read_lookup(group[beam['name']]), weight) for group, weight in groups])
+                       for beam in info['beams'] }
 
         # Compute the bfield data for the real magnets
         bfield, per_beam_bfield = generate_bfield(info, maglist, mags, lookup, return_per_beam_bfield=True)
@@ -27,9 +27,14 @@ import copy
 import random
 import numpy as np
 
-from .field_generator import calculate_trajectory_loss_from_array, \
-                             calculate_cached_trajectory_loss,     \
-                             generate_per_magnet_array,            \
+from .magnets import MagLists
+
+from .field_generator import calculate_trajectory_loss_from_array,  \
+                             calculate_cached_trajectory_loss,      \
+                             generate_per_magnet_array,             \
+                             generate_magnet_slots,                 \
+                             generate_per_magnet_array_differences, \
+                             compare_magnet_differences,            \
                              compare_magnet_arrays
 
 from .logging_utils import logging, getLogger
@@ -80,48 +85,370 @@ class ID_BCell(BCell):
         super().__init__(available=available)
         self.mutations = 0
 
+        # Lazy children only hold a reference to their parent and the mutations applied to it until
+        # their genome is needed, most children are discarded without ever being materialised
+        self.parent = None
+        self.mutation_list = None
+
+        # Cached bfield of the genome and the number of incremental updates applied to it since it was last computed in full
+        self.bfield = None
+        self.bfield_updates = 0
+
+    @property
+    def genome(self):
+        if (self._genome is None) and (self.parent is not None):
+            self.materialise()
+        return self._genome
+
+    @genome.setter
+    def genome(self, genome):
+        self._genome = genome
+
+    def materialise(self):
+        # Apply the mutation list to a copy of the parent genome and drop the reference to the parent
+        if self.parent is not None:
+            self._genome = copy.deepcopy(self.parent.genome)
+            self._genome.mutate_from_list(self.mutation_list)
+            self.parent, self.mutation_list = None, None
+        return self
+
     def create(self, info, lookup, magnets, maglist, ref_trajectories):
         self.genome = maglist
-        _, self.fitness = calculate_cached_trajectory_loss(info, lookup, magnets, self.genome, ref_trajectories)
+        self.bfield, self.fitness = calculate_cached_trajectory_loss(info, lookup, magnets, self.genome, ref_trajectories)
+        self.bfield_updates = 0
 
-    def generate_children(self, number_of_children, number_of_mutations, info, lookup, magnets, ref_trajectories):
+    def generate_children(self, number_of_children, number_of_mutations, info, lookup, magnets, ref_trajectories,
+                          surrogate=None, bfield_resync=None):
         # Increment the age of the parent genome
         self.age_bcell()
 
-        # Evaluate the parent genome and calculate its bfield
-        # TODO this can be cached on genome creation incase this genome lives through multiple generations
-        parent_bfield, trajectory_loss = calculate_cached_trajectory_loss(info, lookup, magnets, self.genome, ref_trajectories)
-        parent_per_magnet_array        = generate_per_magnet_array(info, self.genome, magnets)
+        if (bfield_resync is None) or bfield_resync.needs_resync(self):
+            # Evaluate the parent genome and calculate its bfield
+            parent_bfield, trajectory_loss = calculate_cached_trajectory_loss(info, lookup, magnets, self.genome, ref_trajectories)
 
-        logger.debug('Estimated fitness to real fitness error %1.8E', abs(self.fitness - trajectory_loss))
-        self.fitness = trajectory_loss
+            logger.debug('Estimated fitness to real fitness error %1.8E', abs(self.fitness - trajectory_loss))
 
-        # Sample a set of child genomes mutated from the current parent
-        children = []
+            # Measure how far the incrementally updated bfield drifted from the exact one
+            if (bfield_resync is not None) and (self.bfield is not None):
+                bfield_resync.add_drift(self.bfield, parent_bfield, self.bfield_updates)
+
+            self.fitness = trajectory_loss
+            if bfield_resync is not None:
+                self.bfield, self.bfield_updates = parent_bfield, 0
+
+        else:
+            # Reuse the bfield accumulated from the differences applied by this genome's ancestors
+            parent_bfield = self.bfield
+
+        parent_per_magnet_array = generate_per_magnet_array(info, self.genome, magnets)
+        slots                   = generate_magnet_slots(info)
+
+        # Sample a set of child mutation lists from the current parent and the per beam magnet differences they cause
+        candidates = []
         for genome_index in range(number_of_children):
+            mutation_list = self.genome.sample_mutations(number_of_mutations, available=self.available)
+            differences   = generate_per_magnet_array_differences(self.genome, magnets, mutation_list,
+                                                                  parent_per_magnet_array, slots)
+            candidates.append((mutation_list, differences))
+
+        # Pre-screen the children with the cheap surrogate and only keep the most promising ones for exact evaluation
+        selected    = range(len(candidates))
+        calibration = []
+        if surrogate is not None:
+            surrogate_bfield = surrogate.project_bfield(parent_bfield)
+            surrogate_losses = [surrogate.calculate_loss(surrogate_bfield, differences)
+                                for _, differences in candidates]
+
+            # Random children evaluated exactly to measure the surrogate's rank correlation, drawn before selection
+            calibration = surrogate.sample_calibration(len(candidates))
+
+            if surrogate.trusted:
+                # Stable sort keeps the sampling order between children with equal surrogate losses
+                selected = sorted(range(len(candidates)), key=(lambda index : surrogate_losses[index]))
+                selected = sorted(selected[:surrogate.num_selected(len(candidates))])
+
+            logger.debug('Surrogate selected %d of %d children for exact evaluation, calibrating on %d children',
+                         len(selected), len(candidates), len(calibration))
 
-            # Clone the current genome and apply a number of random mutations
-            child_magnet_lists = copy.deepcopy(self.genome)
-            child_magnet_lists.mutate(number_of_mutations, available=self.available)
+        children = []
+        exact_losses = {}
+        for genome_index in sorted(set(selected) | set(calibration)):
+            mutation_list, differences = candidates[genome_index]
 
             # Calculate the bfield of the child genome w.r.t to the parent one for efficiency
-            child_per_magnet_array  = generate_per_magnet_array(info, child_magnet_lists, magnets)
-            per_beam_bfield_updates = compare_magnet_arrays(parent_per_magnet_array, child_per_magnet_array, lookup)
+            per_beam_bfield_updates = compare_magnet_differences(differences, lookup)
             child_bfield  = parent_bfield - sum(per_beam_bfield_updates.values())
             child_fitness = calculate_trajectory_loss_from_array(info, child_bfield, ref_trajectories)
 
-            # Create the child genome object
+            exact_losses[genome_index] = child_fitness
+
+            # Children in the calibration sample that the surrogate rejected are only evaluated to measure it
+            if genome_index not in selected:
+                continue
+
+            # Create the lazy child genome object, its magnet lists are only built if it is used later
             genome = ID_BCell(available=self.available)
-            genome.mutations = number_of_mutations
-            genome.genome    = child_magnet_lists
-            genome.fitness   = child_fitness
+            genome.mutations     = number_of_mutations
+            genome.parent        = self
+            genome.mutation_list = mutation_list
+            genome.fitness       = child_fitness
+
+            # Keep the child bfield so it does not need to be recomputed if the child survives to be a parent
+            if bfield_resync is not None:
+                genome.bfield, genome.bfield_updates = child_bfield, (self.bfield_updates + 1)
+
             children.append(genome)
 
             logger.debug('Created child genome %d of %d with fitness %1.8E',
-                         genome_index, number_of_children, genome.fitness)
+                         genome_index, len(candidates), genome.fitness)
+
+        if surrogate is not None:
+            surrogate.add_samples([surrogate_losses[index] for index in calibration],
+                                  [exact_losses[index] for index in calibration])
 
         return children
 
+class BfieldResync(object):
+    '''
+    Decides when a genome's cached bfield, accumulated from the differences applied by its ancestors, is recomputed in full.
+    A full recompute happens every interval incremental updates, and the interval is halved whenever the drift measured
+    at a recompute exceeds the tolerance.
+    '''
+    def __init__(self, interval, tolerance=1e-9):
+        self.interval  = interval
+        self.tolerance = tolerance
+
+        # Maximum absolute bfield error of each measured recompute
+        self.drifts = []
+
+    def needs_resync(self, genome):
+        return (genome.bfield is None) or (genome.bfield_updates >= self.interval)
+
+    def add_drift(self, cached_bfield, exact_bfield, num_updates):
+        drift = float(np.max(np.abs(cached_bfield - exact_bfield)))
+        self.drifts.append(drift)
+
+        logger.debug('Cached bfield drifted by %1.8E after %d updates', drift, num_updates)
+
+        if (drift > self.tolerance) and (self.interval > 1):
+            self.interval = max(1, self.interval // 2)
+            logger.info('Cached bfield drift %1.8E exceeded tolerance %1.8E, resynchronising every %d updates',
+                        drift, self.tolerance, self.interval)
+
+    def drift_statistics(self, reset=True):
+        # Min, max, and average drift of the recomputes measured since the last call
+        drifts = self.drifts
+        if reset:
+            self.drifts = []
+
+        if len(drifts) == 0:
+            return 0.0, 0.0, 0.0, 0
+
+        return np.min(drifts), np.max(drifts), np.mean(drifts), len(drifts)
+
+
+class ResolutionSchedule(object):
+    '''
+    Coarse to fine schedule of the S axis resolution that genomes are evaluated at. Each coarse level evaluates every
+    stride'th S sample and moves on to the next finer level after a number of iterations, or once the best fitness has
+    not improved for a number of iterations, finishing at full resolution.
+    '''
+    def __init__(self, strides, iterations=0, patience=0):
+        self.strides    = sorted(set(stride for stride in strides if stride > 1), reverse=True) + [1]
+        self.iterations = iterations
+        self.patience   = patience
+
+        self.level = 0
+        self.reset_level()
+
+    def reset_level(self):
+        self.level_iterations   = 0
+        self.stalled_iterations = 0
+        self.best_fitness       = None
+
+    @property
+    def stride(self):
+        return self.strides[self.level]
+
+    def next_level(self):
+        self.level = min((self.level + 1), (len(self.strides) - 1))
+        self.reset_level()
+        return self.stride
+
+    def finish(self):
+        # Skip straight to full resolution
+        self.level = len(self.strides) - 1
+        self.reset_level()
+        return self.stride
+
+    def update(self, best_fitness):
+        # Record the best fitness after an iteration at this level and decide whether to move to the next finer level
+        if self.stride == 1:
+            return False
+
+        self.level_iterations += 1
+
+        if best_fitness is not None:
+            if (self.best_fitness is None) or (best_fitness < self.best_fitness):
+                self.best_fitness, self.stalled_iterations = best_fitness, 0
+            else:
+                self.stalled_iterations += 1
+
+        return ((self.iterations > 0) and (self.level_iterations >= self.iterations)) or \
+               ((self.patience > 0) and (self.stalled_iterations >= self.patience))
+
+
+class ID_BCell_Codec(object):
+    '''
+    Encodes populations of ID_BCell genomes as compact int64 arrays for buffer based MPI communication.
+    Genomes already known by every node are sent by reference, lazy children as their parent's uid plus
+    their mutation list, and full snapshots of the magnet lists are only sent when no base genome is shared.
+    '''
+
+    # Record kinds
+    SHARED, DELTA, SNAPSHOT = 0, 1, 2
+
+    # Mutation opcodes
+    SWAP, FLIP = 0, 1
+
+    def __init__(self, magnets, available=None):
+        self.magnets   = magnets
+        self.available = available
+
+        # Magnet names are encoded as their index within the magnet set, every node loads the same .mag file
+        self.set_names   = sorted(magnets.magnet_sets.keys())
+        self.set_indices = { set_name : index for index, set_name in enumerate(self.set_names) }
+        self.mag_names   = { set_name : list(magnets.magnet_sets[set_name].keys()) for set_name in self.set_names }
+        self.mag_indices = { set_name : { mag : index for index, mag in enumerate(mag_names) }
+                             for set_name, mag_names in self.mag_names.items() }
+
+    @staticmethod
+    def encode_uid(uid):
+        # Length prefixed list of 8 byte words so any uid string (not only hex) survives the round trip
+        data  = uid.encode()
+        words = [int.from_bytes(data[index:(index + 8)].ljust(8, b'\0'), 'little', signed=True)
+                 for index in range(0, len(data), 8)]
+        return [len(data)] + words
+
+    @staticmethod
+    def decode_uid(data, cursor):
+        length    = int(data[cursor])
+        num_words = (length + 7) // 8
+        words     = b''.join(int(word).to_bytes(8, 'little', signed=True) for word in data[(cursor + 1):(cursor + 1 + num_words)])
+        return words[:length].decode(), (cursor + 1 + num_words)
+
+    def encode_mutation_list(self, mutation_list):
+        rows = []
+        for mutation in mutation_list:
+            if mutation[0] == 'S':
+                rows += [self.SWAP, self.set_indices[mutation[1]], mutation[2], mutation[3]]
+            else:
+                rows += [self.FLIP, self.set_indices[mutation[1]], mutation[2], 0]
+        return [len(mutation_list)] + rows
+
+    def decode_mutation_list(self, data, cursor):
+        length = int(data[cursor])
+        rows   = np.reshape(data[(cursor + 1):(cursor + 1 + (4 * length))], (length, 4))
+        mutation_list = [('S', self.set_names[row[1]], int(row[2]), int(row[3])) if (row[0] == self.SWAP) else
+                         ('F', self.set_names[row[1]], int(row[2])) for row in rows]
+        return mutation_list, (cursor + 1 + (4 * length))
+
+    def encode_snapshot(self, maglist):
+        # Each magnet list entry is the magnet name index and whether it is flipped
+        words = []
+        for set_name in self.set_names:
+            entries = maglist.magnet_lists[set_name]
+            words  += [len(entries)] + [((self.mag_indices[set_name][mag[0]] * 2) + (1 if (mag[1] < 0) else 0))
+                                        for mag in entries]
+        return words
+
+    def decode_snapshot(self, data, cursor):
+        maglist = MagLists(self.magnets)
+        for set_name in self.set_names:
+            length  = int(data[cursor])
+            entries = data[(cursor + 1):(cursor + 1 + length)]
+            maglist.magnet_lists[set_name] = [[self.mag_names[set_name][entry // 2], (-1 if (entry % 2) else 1), 0]
+                                              for entry in entries.tolist()]
+            cursor += 1 + length
+        return maglist, cursor
+
+    def snapshot_record_size(self, uid_length=12):
+        # Words of the SNAPSHOT record of a genome with a uid of the given length, the largest record a genome is sent as
+        uid_words = 1 + ((uid_length + 7) // 8)
+        return 1 + 4 + (2 * uid_words) + sum((1 + len(self.mag_names[set_name])) for set_name in self.set_names)
+
+    def encode(self, population, shared_genomes):
+        words = []
+        for genome in population:
+
+            if genome.uid in shared_genomes:
+                # Every node already holds this genome so only its updated fitness and age need to be sent
+                kind, base_uid, payload = self.SHARED, genome.uid, []
+
+            elif (genome.parent is not None) and (genome.parent.uid in shared_genomes):
+                # Lazy child of a genome every node holds
+                kind, base_uid, payload = self.DELTA, genome.parent.uid, self.encode_mutation_list(genome.mutation_list)
+
+            else:
+                kind, base_uid, payload = self.SNAPSHOT, genome.uid, self.encode_snapshot(genome.genome)
+
+            fitness = int(np.array([genome.fitness], dtype=np.float64).view(np.int64)[0])
+            record  = [kind, genome.age, genome.mutations, fitness] + \
+                      self.encode_uid(genome.uid) + self.encode_uid(base_uid) + payload
+            words  += [len(record)] + record
+
+        return np.array(words, dtype=np.int64)
+
+    def derive(self, base, mutation_list):
+        # Build a lazy genome from a base, flattening through lazy bases so a genome is never more than one step
+        # away from a materialised one
+        genome = ID_BCell(available=self.available)
+        if base.parent is not None:
+            genome.parent, genome.mutation_list = base.parent, (base.mutation_list + mutation_list)
+        elif len(mutation_list) > 0:
+            genome.parent, genome.mutation_list = base, mutation_list
+        else:
+            # Magnet lists are never mutated in place so an unmodified genome and its cached bfield can be shared
+            genome.genome = base.genome
+            genome.bfield, genome.bfield_updates = base.bfield, base.bfield_updates
+        return genome
+
+    def decode(self, data, shared_genomes):
+        population = []
+        cursor = 0
+        while cursor < len(data):
+            end = cursor + 1 + int(data[cursor])
+            kind, age, mutations, fitness = data[(cursor + 1):(cursor + 5)].tolist()
+            uid, record_cursor      = self.decode_uid(data, (cursor + 5))
+            base_uid, record_cursor = self.decode_uid(data, record_cursor)
+
+            if kind == self.SNAPSHOT:
+                genome = ID_BCell(available=self.available)
+                genome.genome, _ = self.decode_snapshot(data, record_cursor)
+
+            else:
+                if base_uid not in shared_genomes:
+                    error_message = f'Cannot decode genome {uid} as its base genome {base_uid} is not shared'
+                    logger.error(error_message)
+                    raise Exception(error_message)
+
+                mutation_list = []
+                if kind == self.DELTA:
+                    mutation_list, _ = self.decode_mutation_list(data, record_cursor)
+
+                genome = self.derive(shared_genomes[base_uid], mutation_list)
+
+            genome.uid       = uid
+            genome.age       = age
+            genome.mutations = mutations
+            genome.fitness   = float(np.array([fitness], dtype=np.int64).view(np.float64)[0])
+            population.append(genome)
+
+            cursor = end
+
+        return population
+
+
 # TODO ID_Shim_BCell is marked for deprecation and removal along with the mpi_runner_for_shim_opt.py script
 #      due to data dependency on the initial parent genome (due to reference holding) and required determinism
 #      of the RNG and function call order
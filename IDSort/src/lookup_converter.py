@@ -0,0 +1,127 @@
+# Copyright 2017 Diamond Light Source
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+'''
+Converts a dense lookup table produced by the lookup_generator into a compact storage format or another layout.
+'''
+
+
+import h5py
+import numpy as np
+
+from .field_generator import BandedLookup, LowRankLookup
+from .lookup_generator import create_beam_dataset, beam_dataset_layout, beam_dataset_shape, \
+                              read_beam_columns, write_beam_columns
+
+from .logging_utils import logging, getLogger, setLoggerLevel
+logger = getLogger(__name__)
+
+
+def process(options, args):
+
+    if hasattr(options, 'verbose'):
+        setLoggerLevel(logger, options.verbose)
+
+    logger.debug('Starting')
+
+    input_path, output_path = args[0], args[1]
+
+    lookup_format = options.format if hasattr(options, 'format') else 'banded'
+    if lookup_format not in ('banded', 'low-rank', 'point-major', 'magnet-major'):
+        error_message = f'Unknown lookup format [{lookup_format}]'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    # Bfields of all beams are summed so the device bfield error is bounded by the sum of the beam bounds
+    device_bound = 0.0
+
+    with h5py.File(input_path, 'r') as input_fp, h5py.File(output_path, 'w') as output_fp:
+        for beam_name, dense in input_fp.items():
+
+            if not isinstance(dense, h5py.Dataset):
+                error_message = f'Beam [{beam_name}] in [{input_path}] is not a dense lookup'
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            logger.info('Converting %s beam [%s] with shape [%s] to %s',
+                        beam_dataset_layout(dense), beam_name, dense.shape, lookup_format)
+
+            if lookup_format == 'banded':
+
+                if beam_dataset_layout(dense) != 'point-major':
+                    error_message = f'Beam [{beam_name}] in [{input_path}] must be point-major to be converted to banded'
+                    logger.error(error_message)
+                    raise Exception(error_message)
+
+                banded = BandedLookup.from_dense(dense, options.tolerance)
+                banded.write(output_fp.create_group(beam_name))
+
+                logger.info('Beam [%s] stored with windows of up to [%d] of [%d] S steps in [%d] of [%d] values, max truncated value [%E], bfield error bound [%E] per unit magnetisation',
+                            beam_name, np.max(banded.widths), banded.shape[2], banded.data.size, np.prod(banded.shape),
+                            banded.truncation_error, banded.truncation_bound)
+
+            elif lookup_format == 'low-rank':
+
+                # Either dense layout is read point-major and factorised magnet-major
+                *shape, num_magnets = beam_dataset_shape(dense)
+                low_rank = LowRankLookup.from_dense(read_beam_columns(dense, 0, num_magnets), options.tolerance)
+                low_rank.write(output_fp.create_group(beam_name))
+                device_bound += low_rank.approximation_bound
+
+                logger.info('Beam [%s] stored with rank [%d] of [%d], max approximation error [%E], bfield error bound [%E] per unit magnetisation',
+                            beam_name, low_rank.rank, min(low_rank.magnets.shape[0], low_rank.points.shape[1]),
+                            low_rank.approximation_error, low_rank.approximation_bound)
+
+                if (low_rank.rank * (low_rank.magnets.shape[0] + low_rank.points.shape[1])) >= (low_rank.magnets.shape[0] * low_rank.points.shape[1]):
+                    logger.warning('Beam [%s] has rank [%d] which is too high for the factors to be cheaper to contract than the dense lookup',
+                                   beam_name, low_rank.rank)
+
+            else:
+
+                # Dense layouts are lossless so they are converted one magnet at a time, keeping the per slot offsets
+                *shape, num_magnets = beam_dataset_shape(dense)
+                converted = create_beam_dataset(output_fp, beam_name, shape, num_magnets, lookup_format)
+                for a in range(num_magnets):
+                    write_beam_columns(converted, a, (a + 1), read_beam_columns(dense, a, (a + 1)))
+
+                if 'offsets' in dense.attrs:
+                    converted.attrs['offsets'] = dense.attrs['offsets']
+
+                logger.info('Beam [%s] stored with shape [%s]', beam_name, converted.shape)
+
+    if lookup_format == 'low-rank':
+        logger.info('Device bfield error bound [%E] per unit magnetisation', device_bound)
+
+    logger.debug('Halting')
+
+
+if __name__ == "__main__":
+    import optparse
+    usage = "%prog [options] Input_lookup_filename Output_lookup_filename"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-v', '--verbose', dest='verbose', help='Set the verbosity level [0-4]', default=0, type='int')
+
+    parser.add_option('--format', dest='format', help='Storage format of the output lookup [banded, low-rank, point-major, magnet-major]',
+                      default='banded', type='string')
+
+    parser.add_option('--tolerance', dest='tolerance', help='Discard lookup values smaller than this fraction of each magnet\'s peak contribution, or singular values smaller than this fraction of the largest one',
+                      default=1e-4, type='float')
+
+    (options, args) = parser.parse_args()
+
+    try:
+        process(options, args)
+    except Exception as ex:
+        logger.critical('Fatal exception in lookup_converter::process', exc_info=ex)
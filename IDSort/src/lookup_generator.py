@@ -20,26 +20,47 @@ Created on 3 Dec 2013
 '''
 
 
+import os
+import time
+import contextlib
 import h5py
 import json
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 from scipy.stats import truncnorm
 import pandas as pd
 
+from .field_generator import calculate_block_ends, calculate_integral_weights
+
 from .logging_utils import logging, getLogger, setLoggerLevel
 logger = getLogger(__name__)
 
 
+def generate_bfield_eval_points(data):
+    #meshgrid modified 18/02/19 ZP+MB to calculate no of points in each direction properly (avoid floating point errors)
+    # TODO refactor to use np.linspace for step creation
+    return np.mgrid[data['xmin']:data['xmax']-(data['xstep']/100.0):data['xstep'],
+                    data['zmin']:data['zmax']-(data['zstep']/100.0):data['zstep'],
+                    data['smin']:data['smax']-(data['sstep']/100.0):data['sstep']]
+
 def calculate_bfield_axis_contribution(bfield_eval_points, major_axis, minor_axis, dimensions, position):
     # This function calculates the bfield in a single orientation according to the calling function
+    # Position and dimensions can have leading batch axes (..., 3) to evaluate multiple magnets at once
 
     # Accumulate the bfield strength at each eval point
-    bfield = np.zeros(bfield_eval_points.shape[1:])
+    batch_shape = np.shape(position)[:-1]
+    bfield = np.zeros((*batch_shape, *bfield_eval_points.shape[1:]))
 
     # Transform eval points into the reference frame of the current magnet (spatial region)
-    shape = (-1,) + (1,) * (bfield_eval_points.ndim - 1)
-    r1 = bfield_eval_points - np.reshape(position, shape)
-    r2 = bfield_eval_points - np.reshape(position + dimensions, shape)
+    points = np.reshape(bfield_eval_points, (3, *((1,) * len(batch_shape)), *bfield_eval_points.shape[1:]))
+    shape  = (1,) * (bfield_eval_points.ndim - 1)
+    r1 = points - np.reshape(np.moveaxis(position, -1, 0), (3, *batch_shape, *shape))
+    r2 = points - np.reshape(np.moveaxis(position + dimensions, -1, 0), (3, *batch_shape, *shape))
+
+    # Axes of the eval points, used to test the signs separately for each magnet in a batch
+    eval_axes = tuple(range(len(batch_shape), r1.ndim - 1))
 
     # Process each combination of axes ijk where i is the minor axis and jk are the other two
     # axes if we use the same handedness for all the coordinate systems
@@ -60,8 +81,9 @@ def calculate_bfield_axis_contribution(bfield_eval_points, major_axis, minor_axi
         # If any values in the k axis are negative in either the bottom-left-near or upper-right-far tensors
         # then swap the k axis components between the two and negate their values
         # TODO marked for removal, does not change the resulting field values in tests for all device types
-        if not (np.all(r1k > 0) and np.all(r2k > 0)):
-            r1k, r2k = -r2k, -r1k
+        flip = ~(np.all(r1k > 0, axis=eval_axes, keepdims=True) & np.all(r2k > 0, axis=eval_axes, keepdims=True))
+        if np.any(flip):
+            r1k, r2k = np.where(flip, -r2k, r1k), np.where(flip, -r1k, r2k)
 
         # Compute the norms multiple field vectors at each eval point
         a1 = np.sqrt(r2i * r2i + r2j * r2j + r2k * r2k)
@@ -111,8 +133,10 @@ def generate_bfield(bfield_eval_points, dimensions, position):
     # Bz = Bz(x)*Mx + Bz(z)*Mz + Bz(s)*Ms
     # Bs = Bs(x)*Mx + Bs(z)*Mz + Bs(s)*Ms
 
+    # Position and dimensions can have leading batch axes (..., 3) in which case the result has the same leading axes
+
     # Allocate a tensor for the resulting bfield to be calculated into
-    bfield = np.zeros((*bfield_eval_points.shape[1:], 3, 3))
+    bfield = np.zeros((*np.shape(position)[:-1], *bfield_eval_points.shape[1:], 3, 3))
 
     # For each major axis compute the bfield contribution w.r.t the other (minor) axes
     for major_axis in range(3):
@@ -130,6 +154,684 @@ def generate_bfield(bfield_eval_points, dimensions, position):
 
     return bfield
 
+def generate_bfield_fused(bfield_eval_points, dimensions, position, out=None):
+    # Calculates the same 3x3 bfield tensor for each evaluation point as generate_bfield, but the corner offsets, the
+    # sign swaps of the k axis, and the corner norms are computed once per magnet and shared by all six tensor entries
+    # Position and dimensions can have leading batch axes (..., 3) in which case the result has the same leading axes
+    batch_shape = np.shape(position)[:-1]
+
+    # Allocate a tensor for the resulting bfield to be calculated into unless one was provided
+    if out is None:
+        out = np.empty((*batch_shape, *bfield_eval_points.shape[1:], 3, 3))
+
+    # Transform eval points into the reference frame of the current magnet (spatial region)
+    points = np.reshape(bfield_eval_points, (3, *((1,) * len(batch_shape)), *bfield_eval_points.shape[1:]))
+    shape  = (1,) * (bfield_eval_points.ndim - 1)
+    r1 = points - np.reshape(np.moveaxis(position, -1, 0), (3, *batch_shape, *shape))
+    r2 = points - np.reshape(np.moveaxis(position + dimensions, -1, 0), (3, *batch_shape, *shape))
+
+    # Axes of the eval points, used to test the signs separately for each magnet in a batch
+    eval_axes = tuple(range(len(batch_shape), r1.ndim - 1))
+
+    # Swap the k axis components when any values along it are negative in either the bottom-left-near or
+    # upper-right-far tensors, only the off diagonal contributions depend on this as the diagonal is symmetric in k
+    # TODO marked for removal, does not change the resulting field values in tests for all device types
+    flips = [~(np.all(r1[k] > 0, axis=eval_axes, keepdims=True) & np.all(r2[k] > 0, axis=eval_axes, keepdims=True))
+             for k in range(3)]
+
+    # Offsets and squared offsets to the bottom-left-near (0) and upper-right-far (1) corners along each axis
+    r = (r1, r2)
+    squares = (r1 * r1, r2 * r2)
+
+    # Norms of the offsets to the 8 corners of the region, indexed by the corner taken along each axis
+    norms = { corner : np.sqrt(squares[corner[0]][0] + squares[corner[1]][1] + squares[corner[2]][2])
+              for corner in itertools.product(range(2), repeat=3) }
+
+    for minor_axis in range(3):
+        i = minor_axis
+        j, k = [axis for axis in range(3) if axis != minor_axis]
+
+        # Calculate the field contributions on the diagonal of the 3x3 bfield matrix, the terms of the two orderings
+        # of the j and k axes for the same corner are paired using atan(x) + atan(y) = atan((x + y) / (1 - xy)) as
+        # xy < 1, which halves the number of arctan evaluations
+        bfield = np.zeros(r1.shape[1:])
+        for corner in itertools.product(range(2), repeat=3):
+            term = np.arctan((r[corner[i]][i] * norms[corner]) / (r[corner[j]][j] * r[corner[k]][k]))
+
+            # Corners with an odd number of upper-right-far offsets are subtracted
+            if (sum(corner) % 2) == 0:
+                bfield += term
+            else:
+                bfield -= term
+
+        out[..., i, i] = bfield / (4 * np.pi)
+
+        # Calculate the field contributions off the diagonal of the 3x3 bfield matrix and copy them over the diagonal
+        for major_axis in range(minor_axis):
+            j = major_axis
+            k = (3 - minor_axis) - j
+
+            # Corner offsets along the k axis and the norms of the corners, after the k axis components are swapped
+            def k_offset(ck):
+                if not np.any(flips[k]): return r[ck][k]
+                return np.where(flips[k], -r[1 - ck][k], r[ck][k])
+
+            def k_norm(ci, cj, ck):
+                corner, swapped = [0] * 3, [0] * 3
+                corner[i], corner[j], corner[k]    = ci, cj, ck
+                swapped[i], swapped[j], swapped[k] = ci, cj, (1 - ck)
+                if not np.any(flips[k]): return norms[tuple(corner)]
+                if np.all(flips[k]): return norms[tuple(swapped)]
+                return np.where(flips[k], norms[tuple(swapped)], norms[tuple(corner)])
+
+            rk1, rk2 = k_offset(0), k_offset(1)
+
+            c1 = k_norm(1, 1, 1) + rk2
+            c2 = k_norm(0, 0, 1) + rk2
+            c3 = k_norm(0, 1, 0) + rk1
+            c4 = k_norm(1, 0, 0) + rk1
+            c5 = k_norm(0, 1, 1) + rk2
+            c6 = k_norm(1, 0, 1) + rk2
+            c7 = k_norm(1, 1, 0) + rk1
+            c8 = k_norm(0, 0, 0) + rk1
+            out[..., major_axis, minor_axis] = -np.log((c1 * c2 * c3 * c4) / (c5 * c6 * c7 * c8)) / (4 * np.pi)
+            out[..., minor_axis, major_axis] = out[..., major_axis, minor_axis]
+
+    return out
+
+def generate_magnet_offsets(options, beam_index, beam, rng_state, df_shim):
+    # Sample the random offsets of every magnet in the beam, in the same order of RNG calls as magnets are processed
+    offsets = np.zeros((len(beam['mags']), 3), dtype=np.float64)
+
+    for a in range(len(beam['mags'])):
+
+        rpx, rpz, rps = 0, 0, 0
+
+        if hasattr(options, 'rsx') and (options.rsx > 0):
+
+            rpx = rng_state.uniform(low=-options.rsx, high=options.rsx)
+            logger.debug('Beam %d [%s] Magnet %3d random X shim [%f]', beam_index, beam['name'], a, rpx)
+
+        if hasattr(options, 'rsz') and (options.rsz > 0):
+
+            rpz = rng_state.uniform(low=-options.rsz, high=options.rsz)
+            logger.debug('Beam %d [%s] Magnet %3d random Z shim [%f]', beam_index, beam['name'], a, rpz)
+
+        if hasattr(options, 'rss') and (options.rss > 0):
+
+            rps = rng_state.uniform(low=-options.rss, high=options.rss)
+            logger.debug('Beam %d [%s] Magnet %3d random S shim [%f]', beam_index, beam['name'], a, rps)
+
+        offsets[a] = (rpx, rpz, rps)
+
+    if df_shim is not None:
+        # Shim CSV is indexed by (beam, slot) so every slot of the beam is looked up at once
+        shim_offsets = df_shim.reindex(pd.MultiIndex.from_product([[beam['name']], range(len(beam['mags']))]))
+        shim_offsets = shim_offsets[['x', 'z', 's']].to_numpy(dtype=np.float64)
+
+        if np.any(np.isnan(shim_offsets)):
+            error_message = f'Shim CSV is missing offsets for slots {np.flatnonzero(np.any(np.isnan(shim_offsets), axis=1)).tolist()} of beam [{beam["name"]}]'
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        offsets += shim_offsets
+
+    return offsets
+
+def create_beam_dataset(outfile, beam_name, shape, num_magnets, layout, tile_size=None):
+    # Point-major datasets (x, z, s, 3, 3, n) are chunked one magnet at a time along their last axis, while magnet-major
+    # datasets (n, 3, x, z, s, 3) store each magnet's rows of the (n * 3, points * 3) lookup matrix contiguously
+    # When the S axis is calculated in tiles the chunks are aligned to the tiles
+    num_x, num_z, num_s, rows, columns = shape
+    tile_size = num_s if (tile_size is None) else tile_size
+
+    if layout == 'magnet-major':
+        beam_dataset = outfile.create_dataset(beam_name, shape=(num_magnets, columns, num_x, num_z, num_s, rows),
+                                              chunks=(1, columns, num_x, num_z, tile_size, rows), dtype=np.float64)
+    else:
+        beam_dataset = outfile.create_dataset(beam_name, shape=(*shape, num_magnets),
+                                              chunks=(num_x, num_z, tile_size, rows, columns, 1), dtype=np.float64)
+
+    beam_dataset.attrs['layout'] = layout
+    return beam_dataset
+
+def beam_dataset_layout(beam_dataset):
+    # Lookups written before the layout was recorded are always point-major
+    return beam_dataset.attrs.get('layout', 'point-major')
+
+def beam_dataset_shape(beam_dataset):
+    # Point-major (x, z, s, 3, 3, n) shape of the lookup regardless of the layout it is stored in
+    if beam_dataset_layout(beam_dataset) == 'magnet-major':
+        num_magnets, columns, *points, rows = beam_dataset.shape
+        return (*points, rows, columns, num_magnets)
+    return beam_dataset.shape
+
+def read_beam_columns(beam_dataset, start, end):
+    # Read the point-major (x, z, s, 3, 3, end - start) bfields of a range of magnets
+    if beam_dataset_layout(beam_dataset) == 'magnet-major':
+        return np.transpose(beam_dataset[start:end], (2, 3, 4, 5, 1, 0))
+    return beam_dataset[..., start:end]
+
+def write_beam_columns(beam_dataset, start, end, bfield, steps=slice(None)):
+    # Write the point-major (x, z, s, 3, 3, end - start) bfields of a range of magnets, optionally for a range of S steps
+    if beam_dataset_layout(beam_dataset) == 'magnet-major':
+        beam_dataset[start:end, :, :, :, steps] = np.transpose(bfield, (5, 4, 0, 1, 2, 3))
+    else:
+        beam_dataset[:, :, steps, :, :, start:end] = bfield
+
+def open_beam_dataset(outfile, beam_name, shape):
+    # Open the dataset of a beam in an existing lookup so that the columns of magnets with changed offsets can be replaced
+    if beam_name not in outfile:
+        error_message = f'Lookup [{outfile.filename}] has no beam [{beam_name}] to update'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    beam_dataset = outfile[beam_name]
+
+    if beam_dataset_shape(beam_dataset) != shape:
+        error_message = f'Lookup [{outfile.filename}] beam [{beam_name}] has shape {beam_dataset_shape(beam_dataset)} but the device needs {shape}'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    if 'offsets' not in beam_dataset.attrs:
+        error_message = f'Lookup [{outfile.filename}] beam [{beam_name}] has no per slot offsets to compare against, regenerate it in full'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    return beam_dataset
+
+def calculate_chunk_size(bfield_eval_points, memory_budget):
+    # Each magnet in a chunk needs its 3x3 bfield tensor for the magnet and both clampcut regions,
+    # plus roughly 40 temporary arrays over the eval points while a single axis contribution is being calculated
+    num_points = np.prod(bfield_eval_points.shape[1:])
+    magnet_bytes = ((3 * 9) + 40) * num_points * np.dtype(np.float64).itemsize
+    return max(1, int((memory_budget * (1024 ** 2)) // magnet_bytes))
+
+def hash_lookup_config(data, influence_window):
+    # Hash of everything that determines the lookup values apart from the per slot offsets, which are checked per beam,
+    # the layout, translation templates, and mirror beams only change how the same values are calculated and stored
+    config = { 'data' : data, 'influence_window' : influence_window }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def calculate_tile_size(bfield_eval_points, memory_budget):
+    # Number of S steps per tile so a single magnet fits in the memory budget, which is the whole S axis when it already does
+    step_points = np.prod(bfield_eval_points.shape[1:3])
+    step_bytes  = ((3 * 9) + 40) * step_points * np.dtype(np.float64).itemsize
+    return int(np.clip(((memory_budget * (1024 ** 2)) // step_bytes), 1, bfield_eval_points.shape[3]))
+
+def calculate_tile_distance(bfield_eval_points, s_start, s_end, positions, dimensions):
+    # Distance along S between a tile of eval points and the nearest magnet of a chunk, zero when they overlap
+    tile_min, tile_max = bfield_eval_points[2, 0, 0, s_start], bfield_eval_points[2, 0, 0, (s_end - 1)]
+    magnet_min = positions[:, 2]
+    magnet_max = positions[:, 2] + dimensions[:, 2]
+    return np.min(np.maximum(0, np.maximum((tile_min - magnet_max), (magnet_min - tile_max))))
+
+def generate_beam_bfield_chunk(data, beam_name, bfield_eval_points, positions, dimensions, direction_matrices):
+    # Calculate the ideal bfield contribution of a chunk of perfect magnets in these positions
+    per_magnet_bfield = generate_bfield_fused(bfield_eval_points, dimensions, positions)
+
+    # APPLE Symmetric devices have clampcut corners to facilitate holding them in the device
+    # we need to compensate for the field strengths contributed by the regions that would be removed
+    if data['type'] == 'APPLE_Symmetric':
+
+        # Find the size of the region that would be cut out of each magnet
+        clampcut = data['clampcut']
+        clampcut_dimensions = np.stack([np.full(len(dimensions), clampcut), np.full(len(dimensions), clampcut),
+                                        dimensions[:, 2]], axis=-1)
+
+        # Place clampcut regions over the current magnets depending on what beam they are in
+        zeros = np.zeros(len(dimensions))
+        if beam_name in ['Q2 Beam', 'Q4 Beam']:
+            positions_c1 = positions
+            positions_c2 = positions + np.stack([dimensions[:, 0] - clampcut, dimensions[:, 1] - clampcut, zeros], axis=-1)
+        elif beam_name in ['Q1 Beam', 'Q3 Beam']:
+            positions_c1 = positions + np.stack([dimensions[:, 0] - clampcut, zeros, zeros], axis=-1)
+            positions_c2 = positions + np.stack([zeros, dimensions[:, 1] - clampcut, zeros], axis=-1)
+
+        # Calculate the ideal bfield contribution of the clamp regions of the perfect magnets
+        bfield_c1 = generate_bfield_fused(bfield_eval_points, clampcut_dimensions, positions_c1)
+        bfield_c2 = generate_bfield_fused(bfield_eval_points, clampcut_dimensions, positions_c2)
+
+        # Bfield of clampcut magnets is the bfield of an uncut magnet minus bfield of the regions to be cut out
+        per_magnet_bfield -= (bfield_c1 + bfield_c2)
+
+    # Rotate the calculated bfield for each magnet into the coordinate system the magnet is placed in
+    shape = (len(direction_matrices),) + (1,) * (bfield_eval_points.ndim - 1) + (3, 3)
+    per_magnet_bfield = np.matmul(per_magnet_bfield, np.reshape(direction_matrices, shape))
+
+    # Move the magnet axis last to match the layout of the lookup table
+    return np.moveaxis(per_magnet_bfield, 0, -1)
+
+def group_translated_magnets(data, positions, dimensions, offsets):
+    # Group the magnets of a beam that share dimensions and X/Z position and are only translated along S by a whole number
+    # of eval point steps, so the bfield of every magnet in a group is a shifted copy of the same template
+    groups = {}
+    for a in range(len(positions)):
+
+        # Magnets moved by shim or random offsets are evaluated exactly
+        if np.any(offsets[a] != 0): continue
+
+        groups.setdefault((*dimensions[a], positions[a, 0], positions[a, 1]), []).append(a)
+
+    translation_groups = []
+    for magnets in groups.values():
+
+        # Number of S steps each magnet is translated by w.r.t the first magnet in the group
+        translations = positions[magnets, 2] - positions[magnets[0], 2]
+        shifts       = np.round(translations / data['sstep']).astype(np.int64)
+        on_grid      = np.abs(translations - (shifts * data['sstep'])) < (1e-6 * data['sstep'])
+
+        # A template is only worthwhile if it is shared by multiple magnets
+        if np.count_nonzero(on_grid) < 2: continue
+
+        translation_groups += [(np.array(magnets)[on_grid], shifts[on_grid])]
+
+    return translation_groups
+
+def generate_translation_template(data, beam_name, bfield_eval_points, position, dimensions, shifts):
+    # Evaluate the unrotated bfield of a magnet on the eval points padded along S so that it covers every shifted copy
+    num_s = bfield_eval_points.shape[3]
+    first = -np.max(shifts)
+    steps = np.arange(first, num_s - np.min(shifts))
+
+    padded_eval_points = np.stack(np.meshgrid(bfield_eval_points[0, :, 0, 0], bfield_eval_points[1, 0, :, 0],
+                                              data['smin'] + (steps * data['sstep']), indexing='ij'))
+
+    template = generate_beam_bfield_chunk(data, beam_name, padded_eval_points, position[np.newaxis],
+                                          dimensions[np.newaxis], np.eye(3)[np.newaxis])[..., 0]
+
+    # Slice of the template that gives the bfield of a copy of the magnet translated by a given number of S steps
+    def translated_bfield(shift):
+        return template[:, :, (-shift - first):(-shift - first + num_s)]
+
+    return translated_bfield
+
+def find_mirrored_beam(data, beam_name, bfield_eval_points, positions, dimensions, offsets, beam_geometries):
+    # Find a previously generated beam that this beam is an exact mirror image of in the X or Z axis
+    if np.any(offsets != 0): return None
+
+    for axis in [0, 1]:
+
+        # The mirror image of every eval point must also be an eval point
+        axis_points = np.moveaxis(bfield_eval_points[axis], axis, 0)[:, 0, 0]
+        if not np.allclose(axis_points, -axis_points[::-1], rtol=0, atol=1e-9): continue
+
+        for source_name, (source_positions, source_dimensions, source_offsets, _) in beam_geometries.items():
+
+            if (len(source_positions) != len(positions)) or np.any(source_offsets != 0): continue
+
+            # Mirroring an APPLE magnet moves its clampcuts to the corners used by the opposite pair of quadrants
+            if data['type'] == 'APPLE_Symmetric':
+                if (beam_name in ['Q1 Beam', 'Q3 Beam']) == (source_name in ['Q1 Beam', 'Q3 Beam']): continue
+
+            mirrored_positions = source_positions.copy()
+            mirrored_positions[:, axis] = -(source_positions[:, axis] + source_dimensions[:, axis])
+
+            if np.allclose(mirrored_positions, positions, rtol=0, atol=1e-6) and \
+               np.allclose(source_dimensions, dimensions, rtol=0, atol=1e-6):
+                return source_name, axis
+
+    return None
+
+def generate_mirrored_bfield_chunk(source_bfield, axis, source_direction_matrices, direction_matrices):
+    # For a magnet mirrored by the reflection P the unrotated bfield tensor is T'(r) = P T(Pr) P, with rotated lookups
+    # L = T D this gives L'(r) = P L(Pr) D^T P D'
+    reflection = np.ones(3)
+    reflection[axis] = -1
+
+    # Reflect the eval points, the grid is symmetric so this reverses the mirrored axis
+    source_bfield = np.flip(np.moveaxis(source_bfield, -1, 0), axis=(axis + 1))
+
+    rotations = np.matmul(np.swapaxes(source_direction_matrices, -1, -2) * reflection[np.newaxis, np.newaxis, :],
+                          direction_matrices)
+
+    shape = (len(rotations),) + (1,) * (source_bfield.ndim - 3) + (3, 3)
+    per_magnet_bfield = np.matmul(source_bfield * reflection[:, np.newaxis], np.reshape(rotations, shape))
+
+    # Move the magnet axis last to match the layout of the lookup table
+    return np.moveaxis(per_magnet_bfield, 0, -1)
+
+def parse_gaps(gaps):
+    # Gaps are given as a list in a config file or as a comma separated string on the command line
+    if isinstance(gaps, str):
+        gaps = [gap for gap in gaps.split(',') if gap.strip() != '']
+    return np.array(sorted(set(float(gap) for gap in gaps)), dtype=np.float64)
+
+def group_aligned_gaps(data, gaps):
+    # Group the sorted gaps whose beams are moved in Z by a whole number of Z steps w.r.t the smallest gap in the group,
+    # opening the gap by two Z steps moves each beam one Z step further from the axis
+    groups = []
+    for g, gap in enumerate(gaps):
+        for group in groups:
+            steps = (gap - gaps[group[0]]) / (2 * data['zstep'])
+            if abs(steps - np.round(steps)) < 1e-6:
+                group.append(g)
+                break
+        else:
+            groups.append([g])
+
+    return [(np.array(group), np.round((gaps[group] - gaps[group[0]]) / (2 * data['zstep'])).astype(np.int64))
+            for group in groups]
+
+def beam_gap_side(positions, dimensions):
+    # Beams above the axis (+1) move up as the gap opens and beams below it (-1) move down
+    sides = np.sign(positions[:, 1] + (dimensions[:, 1] / 2))
+    if np.any(sides == 0) or np.any(sides != sides[0]):
+        return 0
+    return int(sides[0])
+
+def generate_gap_eval_points(data, bfield_eval_points, side, max_steps):
+    # Eval points padded along Z so that they cover the eval points of every gap in a group, relative to the magnets at
+    # the smallest gap the eval points of a beam moved by k Z steps are k steps closer to the axis
+    num_z = bfield_eval_points.shape[2]
+    first = -max_steps if (side > 0) else 0
+    steps = np.arange(first, num_z + (max_steps if (side < 0) else 0))
+
+    padded_eval_points = np.stack(np.meshgrid(bfield_eval_points[0, :, 0, 0], data['zmin'] + (steps * data['zstep']),
+                                              bfield_eval_points[2, 0, 0, :], indexing='ij'))
+
+    # Slice of the padded Z axis that gives the bfield of the beam moved by a given number of Z steps
+    def gap_slice(step):
+        return slice(((-side * step) - first), ((-side * step) - first + num_z))
+
+    return padded_eval_points, gap_slice
+
+def contiguous_runs(magnets):
+    # Split a sorted list of magnet indices into (start, end) ranges of consecutive magnets
+    runs = []
+    for a in magnets:
+        if (len(runs) > 0) and (runs[-1][1] == a):
+            runs[-1][1] = a + 1
+        else:
+            runs.append([a, a + 1])
+    return runs
+
+# Device data and eval points shared by every chunk, set once per worker process instead of being sent with each chunk
+worker_state = {}
+
+def initialise_worker(data, bfield_eval_points):
+    worker_state['data'] = data
+    worker_state['bfield_eval_points'] = bfield_eval_points
+
+def generate_beam_bfield_chunk_task(task):
+    start, end, s_start, s_end, beam_name, positions, dimensions, direction_matrices = task
+    return start, end, s_start, s_end, generate_beam_bfield_chunk(worker_state['data'], beam_name,
+                                                                  worker_state['bfield_eval_points'][..., s_start:s_end],
+                                                                  positions, dimensions, direction_matrices)
+
+def generate_rank_chunks(comm, tasks, parallel_hdf5):
+    # Every rank calculates every comm.size'th block in rounds, with parallel HDF5 each rank writes its own blocks to the
+    # shared file, otherwise the blocks of each round are gathered to rank 0 which is the only one with the file open
+    for round_start in range(0, len(tasks), comm.size):
+        task_index = round_start + comm.rank
+        chunk = generate_beam_bfield_chunk_task(tasks[task_index]) if (task_index < len(tasks)) else None
+
+        if parallel_hdf5:
+            if chunk is not None:
+                yield chunk
+        else:
+            chunks = comm.gather(chunk, root=0)
+            if comm.rank == 0:
+                yield from (chunk for chunk in chunks if chunk is not None)
+
+def generate_integral_lookup(lookup_path, integrals_path, data, num_blocks, memory_budget):
+    # Companion of a lookup holding the first and second field integrals (x, z, 2 * k, 3, 3, n) of every magnet at the
+    # ends of k blocks of the S axis, summed along S from the lookup a chunk of magnets at a time
+    with h5py.File(lookup_path, 'r') as lookup_fp, h5py.File(integrals_path, 'w') as integrals_fp:
+
+        # Gap scans get the integrals of every gap in matching groups
+        groups = [(lookup_fp, integrals_fp)]
+        if 'gaps' in lookup_fp.attrs:
+            integrals_fp.attrs['gaps'] = lookup_fp.attrs['gaps']
+            groups = [(lookup_fp[f'gap-{g}'], integrals_fp.create_group(f'gap-{g}')) for g in range(len(lookup_fp.attrs['gaps']))]
+            for lookup_group, integrals_group in groups:
+                integrals_group.attrs['gap'] = lookup_group.attrs['gap']
+
+        for lookup_group, integrals_group in groups:
+            for beam in data['beams']:
+
+                beam_dataset = lookup_group[beam['name']]
+                num_x, num_z, num_s, rows, columns, num_magnets = beam_dataset_shape(beam_dataset)
+                block_ends = calculate_block_ends(num_s, num_blocks)
+                weights    = calculate_integral_weights(data, num_s, block_ends)
+
+                integral_dataset = integrals_group.create_dataset(beam['name'], dtype=np.float64,
+                                                                  shape=(num_x, num_z, len(weights), rows, columns, num_magnets))
+                integral_dataset.attrs['block_ends'] = block_ends
+
+                magnet_bytes = (num_x * num_z * num_s * rows * columns) * np.dtype(np.float64).itemsize
+                chunk_size   = max(1, int((memory_budget * (1024 ** 2)) // magnet_bytes))
+
+                for start in range(0, num_magnets, chunk_size):
+                    end = min((start + chunk_size), num_magnets)
+                    integral_dataset[..., start:end] = np.moveaxis(np.tensordot(read_beam_columns(beam_dataset, start, end), weights,
+                                                                                axes=([2], [1])), -1, 2)
+
+                logger.info('Beam [%s] field integrals at %d block ends with shape [%s]',
+                            beam['name'], (len(weights) // 2), integral_dataset.shape)
+
+def generate_gap_scan(options, data, output_path, gaps, bfield_eval_points, rng_state, df_shim, memory_budget, layout, workers):
+    # Generate the lookups of a device at several gaps into one file, the lookup of each gap in its own group,
+    # gaps whose beams are only moved by whole Z steps share a single evaluation over Z padded eval points
+    if 'gap' not in data:
+        error_message = 'ID description has no gap to scan from'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    gap_groups = group_aligned_gaps(data, gaps)
+    logger.info('Scanning %d gaps [%s] in %d groups of gaps moved by whole Z steps', len(gaps), gaps, len(gap_groups))
+
+    num_s = bfield_eval_points.shape[3]
+    shape = (*bfield_eval_points.shape[1:], 3, 3)
+    output_csv_rows = []
+
+    try:
+
+        with h5py.File(output_path, 'w') as outfile:
+
+            outfile.attrs['gaps'] = gaps
+            for g, gap in enumerate(gaps):
+                outfile.create_group(f'gap-{g}').attrs['gap'] = gap
+
+            # Sample the random and shim offsets for every beam in the same order of RNG calls as a single gap build,
+            # the same magnets and shims are placed in the device at every gap
+            beam_geometries = []
+            for b, beam in enumerate(data['beams']):
+
+                offsets = generate_magnet_offsets(options, b, beam, rng_state, df_shim)
+
+                for a, offset in enumerate(offsets):
+                    output_csv_rows += [{
+                        'beam': beam['name'],
+                        'slot': a,
+                        'x': float(offset[0]), 'z': float(offset[1]), 's': float(offset[2])
+                    }]
+
+                positions          = np.array([mag['position'] for mag in beam['mags']], dtype=np.float64)
+                dimensions         = np.array([mag['dimensions'] for mag in beam['mags']], dtype=np.float64)
+                direction_matrices = np.array([mag['direction_matrix'] for mag in beam['mags']], dtype=np.float64)
+
+                positions += offsets.astype(np.float32)
+
+                side = beam_gap_side(positions, dimensions)
+                if side == 0:
+                    error_message = f'Beam [{beam["name"]}] is not entirely above or below the axis and cannot be moved with the gap'
+                    logger.error(error_message)
+                    raise Exception(error_message)
+
+                beam_geometries += [(positions, dimensions, direction_matrices, side, offsets)]
+
+                for g in range(len(gaps)):
+                    beam_dataset = create_beam_dataset(outfile[f'gap-{g}'], beam['name'], shape, len(beam['mags']), layout,
+                                                       tile_size=calculate_tile_size(bfield_eval_points, memory_budget))
+                    beam_dataset.attrs['offsets'] = offsets
+
+            for group, z_steps in gap_groups:
+                for b, (beam, (positions, dimensions, direction_matrices, side, offsets)) in enumerate(zip(data['beams'], beam_geometries)):
+
+                    # Move the beam to the smallest gap of the group
+                    gap_positions = positions.copy()
+                    gap_positions[:, 1] += side * ((gaps[group[0]] - data['gap']) / 2)
+
+                    padded_eval_points, gap_slice = generate_gap_eval_points(data, bfield_eval_points, side, np.max(z_steps))
+
+                    logger.info('Beam %d [%s] gaps [%s] evaluated once over %d Z steps instead of %d',
+                                b, beam['name'], gaps[group], padded_eval_points.shape[2], (len(group) * bfield_eval_points.shape[2]))
+
+                    tile_size  = calculate_tile_size(padded_eval_points, memory_budget)
+                    chunk_size = calculate_chunk_size(padded_eval_points[..., :tile_size], memory_budget)
+                    num_magnets = len(positions)
+
+                    tasks = [(start, min(start + chunk_size, num_magnets), s_start, min((s_start + tile_size), num_s), beam['name'],
+                              gap_positions[start:min(start + chunk_size, num_magnets)], dimensions[start:min(start + chunk_size, num_magnets)],
+                              direction_matrices[start:min(start + chunk_size, num_magnets)])
+                             for start in range(0, num_magnets, chunk_size)
+                             for s_start in range(0, num_s, tile_size)]
+
+                    gap_datasets = [(outfile[f'gap-{g}'][beam['name']], gap_slice(z_step)) for g, z_step in zip(group, z_steps)]
+
+                    # Chunks are calculated by a pool of worker processes sharing the padded eval points of this beam
+                    pool = None
+                    if workers > 1:
+                        pool = multiprocessing.Pool(workers, initializer=initialise_worker, initargs=(data, padded_eval_points))
+                    else:
+                        initialise_worker(data, padded_eval_points)
+
+                    try:
+                        chunks = pool.imap_unordered(generate_beam_bfield_chunk_task, tasks) if (pool is not None) else \
+                                 map(generate_beam_bfield_chunk_task, tasks)
+
+                        # Every gap in the group takes its own window of the padded Z axis from each chunk
+                        for start, end, s_start, s_end, per_magnet_bfield in chunks:
+                            for beam_dataset, z_slice in gap_datasets:
+                                write_beam_columns(beam_dataset, start, end, per_magnet_bfield[:, z_slice], steps=slice(s_start, s_end))
+
+                            logger.debug('Beam %d [%s] Magnets %3d to %3d S steps %4d to %4d bfield with shape [%s]',
+                                         b, beam['name'], start, end, s_start, s_end, shape)
+
+                    finally:
+                        if pool is not None:
+                            pool.terminate()
+                            pool.join()
+
+            if hasattr(options, 'output_shim_csv') and (options.output_shim_csv is not None):
+                df_output_shim = pd.DataFrame(output_csv_rows)
+                df_output_shim.to_csv(options.output_shim_csv, index=False)
+
+    except Exception as ex:
+        logger.error('Failed to save gap scan lookup to [%s]', output_path, exc_info=ex)
+        raise ex
+
+def hash_lazy_lookup(data, beam, bfield_eval_points):
+    # Hash of everything that determines the columns of a beam on a set of eval points
+    config = { 'type' : data['type'], 'clampcut' : data.get('clampcut', None), 'beam' : beam }
+    hasher = hashlib.sha256(json.dumps(config, sort_keys=True).encode())
+    hasher.update(np.ascontiguousarray(bfield_eval_points, dtype=np.float64).tobytes())
+    return hasher.hexdigest()
+
+
+class LazyLookup(object):
+    '''
+    Lookup table for a single beam on a subset of the eval points, whose columns are only calculated when they are
+    first contracted. Calculated columns are written to an HDF5 cache keyed on the beam geometry and the eval points,
+    so later runs reuse them and optimisation can start without waiting for a full lookup build.
+    '''
+
+    def __init__(self, data, beam, bfield_eval_points, cache_path=None, transverse=False, read_only=False, memory_budget=8):
+        self.data               = data
+        self.beam               = beam
+        self.bfield_eval_points = bfield_eval_points
+        self.cache_path         = cache_path
+        self.read_only          = read_only
+        self.memory_budget      = memory_budget
+
+        self.positions          = np.array([mag['position'] for mag in beam['mags']], dtype=np.float64)
+        self.dimensions         = np.array([mag['dimensions'] for mag in beam['mags']], dtype=np.float64)
+        self.direction_matrices = np.array([mag['direction_matrix'] for mag in beam['mags']], dtype=np.float64)
+
+        # Transverse lookups only hold the rows of the X and Z field components, the cache always holds all three
+        self.rows  = 2 if transverse else 3
+        self.shape = (*bfield_eval_points.shape[1:], self.rows, 3, len(beam['mags']))
+
+        self.lookup     = np.zeros(self.shape)
+        self.calculated = np.zeros(len(beam['mags']), dtype=bool)
+
+        # Each set of eval points of a beam has its own group in the cache
+        self.cache_group = f'{beam["name"]}/{hash_lazy_lookup(data, beam, bfield_eval_points)[:16]}'
+
+        if (cache_path is not None) and os.path.exists(cache_path):
+            with h5py.File(cache_path, 'r') as fp:
+                if self.cache_group in fp:
+                    self.calculated[...] = fp[self.cache_group]['calculated'][...]
+                    self.lookup[..., self.calculated] = fp[self.cache_group]['columns'][..., :self.rows, :, :][..., self.calculated]
+
+        logger.info('Beam [%s] lazy lookup with shape [%s] has %d of %d columns cached',
+                    beam['name'], self.shape, np.count_nonzero(self.calculated), len(beam['mags']))
+
+    def calculate(self, columns=slice(None)):
+        # Calculate the bfields of the given columns that are not calculated yet, in chunks within the memory budget
+        missing = np.flatnonzero(~self.calculated)
+        missing = np.intersect1d(missing, np.arange(len(self.calculated))[columns])
+        if len(missing) == 0: return
+
+        logger.debug('Beam [%s] calculating %d lazy lookup columns', self.beam['name'], len(missing))
+
+        bfields    = np.zeros((*self.shape[:3], 3, 3, len(missing)))
+        chunk_size = calculate_chunk_size(self.bfield_eval_points, self.memory_budget)
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:(start + chunk_size)]
+            bfields[..., start:(start + len(chunk))] = generate_beam_bfield_chunk(self.data, self.beam['name'], self.bfield_eval_points,
+                                                                                  self.positions[chunk], self.dimensions[chunk],
+                                                                                  self.direction_matrices[chunk])
+
+        self.lookup[..., missing] = bfields[..., :self.rows, :, :]
+        self.calculated[missing]  = True
+
+        if (self.cache_path is not None) and (not self.read_only):
+            with h5py.File(self.cache_path, 'a') as fp:
+                group   = fp.require_group(self.cache_group)
+                columns = group.require_dataset('columns', shape=(*self.shape[:3], 3, 3, self.shape[5]), dtype=np.float64)
+                group.require_dataset('calculated', shape=self.calculated.shape, dtype=bool)
+
+                # Missing columns are in increasing order as HDF5 selections require
+                columns[..., missing] = bfields
+                group['calculated'][...] = self.calculated
+
+    def contract_columns(self, columns, difference):
+        self.calculate(columns)
+        return np.tensordot(self.lookup[..., columns], difference, axes=([4, 5], [0, 1]))
+
+    def contract(self, beam_array):
+        self.calculate()
+        return np.tensordot(self.lookup, beam_array, axes=([4, 5], [0, 1]))
+
+    def project(self, i, j, stride):
+        # Dense lookup (1, 1, s / stride, 3, 3, n) of a single eval line sub-sampled along S
+        self.calculate()
+        return np.ascontiguousarray(self.lookup[i:(i + 1), j:(j + 1), ::stride])
+
+    def transverse(self):
+        return LazyLookup(self.data, self.beam, self.bfield_eval_points, cache_path=self.cache_path, transverse=True,
+                          read_only=self.read_only, memory_budget=self.memory_budget)
+
+
+def load_lazy_lookup(cache_path, data, x_indices=None, z_indices=None, central_line=False, transverse=False, read_only=False):
+    # Lazy lookups of every beam in the device on the eval points of the given X and Z indices, all of them by default,
+    # or the central eval line that the trajectory loss is calculated on
+    bfield_eval_points = generate_bfield_eval_points(data)
+    if central_line:
+        x_indices = [((bfield_eval_points.shape[1] + 1) // 2) - 1]
+        z_indices = [((bfield_eval_points.shape[2] + 1) // 2) - 1]
+
+    if x_indices is not None:
+        bfield_eval_points = bfield_eval_points[:, x_indices]
+    if z_indices is not None:
+        bfield_eval_points = bfield_eval_points[:, :, z_indices]
+
+    return { beam['name'] : LazyLookup(data, beam, np.ascontiguousarray(bfield_eval_points), cache_path=cache_path,
+                                       transverse=transverse, read_only=read_only)
+             for beam in data['beams'] }
+
 def process(options, args):
 
     if hasattr(options, 'verbose'):
@@ -140,7 +842,15 @@ def process(options, args):
     df_shim = None
     if hasattr(options, 'shim_csv') and (options.shim_csv is not None):
         logger.info('Loading shimming data from CSV file: [%s]', options.shim_csv)
-        df_shim = pd.read_csv(options.shim_csv)
+        df_shim = pd.read_csv(options.shim_csv).set_index(['beam', 'slot'])
+
+        # Slots listed more than once use their first row in the file
+        duplicated = df_shim.index.duplicated(keep='first')
+        if np.any(duplicated):
+            logger.warning('Shim CSV lists %d slots more than once, using the first row for each of them', np.count_nonzero(duplicated))
+            df_shim = df_shim[~duplicated]
+
+        df_shim = df_shim.sort_index()
 
     # TODO refactor arguments to accept json file as named parameter
     with open(args[0], 'r') as fp:
@@ -148,11 +858,7 @@ def process(options, args):
 
     output_path = args[1]
 
-    #meshgrid modified 18/02/19 ZP+MB to calculate no of points in each direction properly (avoid floating point errors)
-    # TODO refactor to use np.linspace for step creation
-    bfield_eval_points = np.mgrid[data['xmin']:data['xmax']-(data['xstep']/100.0):data['xstep'],
-                                  data['zmin']:data['zmax']-(data['zstep']/100.0):data['zstep'],
-                                  data['smin']:data['smax']-(data['sstep']/100.0):data['sstep']]
+    bfield_eval_points = generate_bfield_eval_points(data)
 
     logger.info('Evaluation points with shape [%s]', bfield_eval_points.shape)
 
@@ -165,94 +871,380 @@ def process(options, args):
     logger.debug('Evaluation points S-axis | Requested min [%f] max [%f] | Observed min [%f] max [%f]',
                  data['smin'], data['smax'], np.min(bfield_eval_points[2]), np.max(bfield_eval_points[2]))
 
+    update = hasattr(options, 'update') and options.update
+    if update:
+        logger.info('Updating the magnets with changed offsets in the existing lookup [%s]', output_path)
+
     rng_state = np.random.RandomState(seed=(options.seed if (hasattr(options, 'seed') and
                                             (options.seed is None or options.seed > 0)) else None))
 
-    output_csv_rows = []
-
-    try:
-
-        with h5py.File(output_path, 'w') as outfile:
+    memory_budget = options.memory_budget if (hasattr(options, 'memory_budget') and (options.memory_budget > 0)) else 8
+    logger.info('Calculating magnets in chunks using at most %g MB', memory_budget)
+
+    # Split the S axis into tiles when even a single magnet does not fit in the memory budget
+    num_s     = bfield_eval_points.shape[3]
+    tile_size = calculate_tile_size(bfield_eval_points, memory_budget)
+    tiles     = [(s_start, min((s_start + tile_size), num_s)) for s_start in range(0, num_s, tile_size)]
+    if len(tiles) > 1:
+        logger.info('Calculating the S axis in %d tiles of %d steps', len(tiles), tile_size)
+
+    # Optionally skip blocks of magnets that are further than the influence window from a tile, leaving them zero
+    influence_window = options.influence_window if (hasattr(options, 'influence_window') and
+                                                    (options.influence_window > 0)) else None
+    if influence_window is not None:
+        logger.info('Skipping magnets further than %f mm along S from each tile', influence_window)
+
+    layout = options.layout if (hasattr(options, 'layout') and (options.layout is not None)) else 'point-major'
+    if layout not in ('point-major', 'magnet-major'):
+        error_message = f'Unknown lookup layout [{layout}]'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    # Only the changed magnets are evaluated when updating, always exactly
+    templates = hasattr(options, 'templates') and options.templates and (not update)
+    if templates:
+        logger.info('Filling magnets that are translated by whole S steps from shared templates')
+
+    mirror_beams = hasattr(options, 'mirror_beams') and options.mirror_beams and (not update)
+    if mirror_beams:
+        logger.info('Deriving beams that mirror a previously generated beam from it')
+
+    # Resumable builds record which blocks of (magnet, S tile) are complete so an interrupted build can continue
+    resume = hasattr(options, 'resume') and options.resume
+    if resume and update:
+        error_message = 'Cannot resume and update a lookup at the same time'
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    resuming    = resume and os.path.exists(output_path)
+    config_hash = hash_lookup_config(data, influence_window)
+
+    # Geometry of the beams generated so far that later beams may mirror
+    beam_geometries = {}
+
+    workers = options.workers if (hasattr(options, 'workers') and (options.workers > 1)) else 1
+    logger.info('Calculating magnets using %d worker processes', workers)
+
+    # Field integrals of the completed lookup are pre-summed into a companion file
+    integrals_filename = options.integrals_filename if hasattr(options, 'integrals_filename') else None
+    integral_blocks = options.integral_blocks if (hasattr(options, 'integral_blocks') and (options.integral_blocks > 0)) else 16
+
+    # Gap scans write the lookups of several gaps into one file and are generated separately
+    if hasattr(options, 'gaps') and (options.gaps is not None):
+
+        if resume or update or templates or mirror_beams or (influence_window is not None) or (hasattr(options, 'mpi') and options.mpi):
+            error_message = 'Cannot scan gaps with resume, update, translation templates, mirror beams, influence window, or MPI'
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        generate_gap_scan(options, data, output_path, parse_gaps(options.gaps), bfield_eval_points,
+                          rng_state, df_shim, memory_budget, layout, workers)
+
+        if integrals_filename is not None:
+            logger.info('Writing field integrals at the ends of %d blocks of the S axis to [%s]', integral_blocks, integrals_filename)
+            generate_integral_lookup(output_path, integrals_filename, data, integral_blocks, memory_budget)
+
+        logger.debug('Halting')
+        return
+
+    # Partition the blocks of every beam across MPI ranks, every rank builds the same list of blocks in the same order
+    comm, comm_rank, comm_size, parallel_hdf5 = None, 0, 1, False
+    if hasattr(options, 'mpi') and options.mpi:
+        # Imported here so that MPI is only initialised when it is used, before any worker processes could be forked
+        from mpi4py import MPI
+        comm, comm_rank, comm_size = MPI.COMM_WORLD, MPI.COMM_WORLD.rank, MPI.COMM_WORLD.size
+        parallel_hdf5 = h5py.get_config().mpi
+
+        if resume or update or templates or mirror_beams or (workers > 1):
+            error_message = 'Cannot use MPI with resume, update, translation templates, mirror beams, or worker processes'
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        logger.info('Node %3d of %3d writing the lookup %s', comm_rank, comm_size,
+                    'collectively with parallel HDF5' if parallel_hdf5 else 'through node 0 as h5py was built without MPI support')
 
-            for b, beam in enumerate(data['beams']):
+    output_csv_rows = []
 
-                # Make a dataset in the output h5 file for this beams per magnet bfield data
-                num_magnets  = len(beam['mags'])
-                shape        = (*bfield_eval_points.shape[1:], 3, 3)
-                beam_dataset = outfile.create_dataset(beam['name'], shape=(*shape, num_magnets), chunks=(*shape, 1), dtype=np.float64)
+    # Chunks are calculated by a pool of worker processes and written to the output file by this process only
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=initialise_worker, initargs=(data, bfield_eval_points))
+    else:
+        initialise_worker(data, bfield_eval_points)
 
-                logger.info('Beam %d [%s] with %d magnets and lookup shape [%s]', b, beam['name'], num_magnets, beam_dataset.shape)
+    try:
 
-                for a, mag in enumerate(beam['mags']):
+        # Without parallel HDF5 only rank 0 opens the lookup, every other rank sends its blocks to it
+        if parallel_hdf5:
+            lookup_file = h5py.File(output_path, 'w', driver='mpio', comm=comm)
+        elif comm_rank == 0:
+            lookup_file = h5py.File(output_path, ('r+' if (update or resuming) else 'w'))
+        else:
+            lookup_file = contextlib.nullcontext()
 
-                    # Extract magnet data
-                    position, dimensions = np.array(mag['position']), np.array(mag['dimensions'])
+        with lookup_file as outfile:
 
-                    rpx, rpz, rps = 0, 0, 0
+            # Updates and resumed builds only recalculate some of the magnets so the rest must be from the same configuration
+            if (update or resuming) and (outfile is not None):
 
-                    if hasattr(options, 'rsx') and (options.rsx > 0):
+                if 'config_hash' not in outfile.attrs:
+                    error_message = f'Lookup [{output_path}] has no configuration hash to compare against, regenerate it in full'
+                    logger.error(error_message)
+                    raise Exception(error_message)
 
-                        rpx = rng_state.uniform(low=-options.rsx, high=options.rsx)
-                        logger.debug('Beam %d [%s] Magnet %3d random X shim [%f]', b, beam['name'], a, rpx)
+                if outfile.attrs['config_hash'] != config_hash:
+                    error_message = f'Lookup [{output_path}] was generated from a different configuration and cannot be ' \
+                                    f'{"updated" if update else "resumed"}'
+                    logger.error(error_message)
+                    raise Exception(error_message)
 
-                    if hasattr(options, 'rsz') and (options.rsz > 0):
+            elif outfile is not None:
+                outfile.attrs['config_hash'] = config_hash
 
-                        rpz = rng_state.uniform(low=-options.rsz, high=options.rsz)
-                        logger.debug('Beam %d [%s] Magnet %3d random Z shim [%f]', b, beam['name'], a, rpz)
+            if resuming:
 
-                    if hasattr(options, 'rss') and (options.rss > 0):
+                if 'tile_size' not in outfile.attrs:
+                    error_message = f'Lookup [{output_path}] was not generated with resume enabled and cannot be resumed'
+                    logger.error(error_message)
+                    raise Exception(error_message)
 
-                        rps = rng_state.uniform(low=-options.rss, high=options.rss)
-                        logger.debug('Beam %d [%s] Magnet %3d random S shim [%f]', b, beam['name'], a, rps)
+                if 'progress' not in outfile:
+                    logger.info('Lookup [%s] is already complete', output_path)
 
-                    if df_shim is not None:
-                        rpx += df_shim.loc[(df_shim['beam'] == beam['name']) & (df_shim['slot'] == a), 'x'].iloc[0]
-                        rpz += df_shim.loc[(df_shim['beam'] == beam['name']) & (df_shim['slot'] == a), 'z'].iloc[0]
-                        rps += df_shim.loc[(df_shim['beam'] == beam['name']) & (df_shim['slot'] == a), 's'].iloc[0]
+                # Continue with the same S tiles that the completed blocks were recorded for
+                elif int(outfile.attrs['tile_size']) != tile_size:
+                    tile_size = int(outfile.attrs['tile_size'])
+                    tiles     = [(s_start, min((s_start + tile_size), num_s)) for s_start in range(0, num_s, tile_size)]
+                    logger.info('Resuming with the recorded S tiles of %d steps', tile_size)
 
-                    output_csv_rows += [{
-                        'beam': beam['name'],
-                        'slot': a,
-                        'x': float(rpx), 'z': float(rpz), 's': float(rps)
-                    }]
+            elif resume:
 
-                    logger.debug('Beam %d [%s] Magnet %3d [%s]', b, beam['name'], a, output_csv_rows[-1])
+                # Progress of every beam is recorded up front, so a beam without progress is complete
+                outfile.attrs['tile_size'] = tile_size
+                for beam in data['beams']:
+                    outfile.create_dataset(f'progress/{beam["name"]}', shape=(len(beam['mags']), len(tiles)), dtype=bool)
 
-                    position += np.array([rpx, rpz, rps], dtype=np.float32)
+            tile_indices = { s_start : tile_index for tile_index, (s_start, s_end) in enumerate(tiles) }
 
-                    # Calculate the ideal bfield contribution of a perfect magnet in this position
-                    per_magnet_bfield = generate_bfield(bfield_eval_points, dimensions, position)
+            for b, beam in enumerate(data['beams']):
 
-                    # APPLE Symmetric devices have clampcut corners to facilitate holding them in the device
-                    # we need to compensate for the field strengths contributed by the regions that would be removed
-                    if data['type'] == 'APPLE_Symmetric':
+                # Make a dataset in the output h5 file for this beams per magnet bfield data
+                num_magnets  = len(beam['mags'])
+                shape        = (*bfield_eval_points.shape[1:], 3, 3)
+                if outfile is None:
+                    beam_dataset = None
+                elif update or (resuming and (beam['name'] in outfile)):
+                    beam_dataset = open_beam_dataset(outfile, beam['name'], (*shape, num_magnets))
+                else:
+                    beam_dataset = create_beam_dataset(outfile, beam['name'], shape, num_magnets, layout, tile_size=tile_size)
 
-                        # Find the size of the region that would be cut out of each magnet
-                        clampcut = data['clampcut']
-                        clampcut_dimensions = np.array([clampcut, clampcut, dimensions[2]])
+                if beam_dataset is not None:
+                    logger.info('Beam %d [%s] with %d magnets and %s lookup shape [%s]',
+                                b, beam['name'], num_magnets, beam_dataset_layout(beam_dataset), beam_dataset.shape)
 
-                        # Place clampcut regions over the current magnet depending on what beam it is in
-                        if beam['name'] in ['Q2 Beam', 'Q4 Beam']:
-                            position_c1 = position
-                            position_c2 = position + np.array([dimensions[0] - clampcut, dimensions[1] - clampcut, 0])
-                        elif beam['name'] in ['Q1 Beam', 'Q3 Beam']:
-                            position_c1 = position + np.array([dimensions[0] - clampcut, 0, 0])
-                            position_c2 = position + np.array([0, dimensions[1] - clampcut, 0])
+                # Sample the random and shim offsets for every magnet in the beam before calculating any bfields
+                offsets = generate_magnet_offsets(options, b, beam, rng_state, df_shim)
 
-                        # Calculate the ideal bfield contribution of the clamp region of a perfect magnet
-                        bfield_c1 = generate_bfield(bfield_eval_points, clampcut_dimensions, position_c1)
-                        bfield_c2 = generate_bfield(bfield_eval_points, clampcut_dimensions, position_c2)
+                # Every rank calculates its blocks with the offsets sampled on rank 0, the same ones a serial build uses
+                if comm is not None:
+                    offsets = comm.bcast(offsets, root=0)
 
-                        # Bfield of clampcut magnets is the bfield of an uncut magnet minus bfield of the regions to be cut out
-                        per_magnet_bfield -= (bfield_c1 + bfield_c2)
+                for a, offset in enumerate(offsets):
 
-                    # Rotate the calculated bfield for this magnet into the coordinate system the magnet is placed in
-                    per_magnet_bfield = np.dot(per_magnet_bfield, np.array(mag['direction_matrix']))
-                    beam_dataset[..., a] = per_magnet_bfield
+                    output_csv_rows += [{
+                        'beam': beam['name'],
+                        'slot': a,
+                        'x': float(offset[0]), 'z': float(offset[1]), 's': float(offset[2])
+                    }]
 
-                    logger.debug('Beam %d [%s] Magnet %3d bfield with shape [%s]', b, beam['name'], a, per_magnet_bfield.shape)
+                    logger.debug('Beam %d [%s] Magnet %3d [%s]', b, beam['name'], a, output_csv_rows[-1])
 
-            if hasattr(options, 'output_shim_csv') and (options.output_shim_csv is not None):
+                # Extract magnet data
+                positions          = np.array([mag['position'] for mag in beam['mags']], dtype=np.float64)
+                dimensions         = np.array([mag['dimensions'] for mag in beam['mags']], dtype=np.float64)
+                direction_matrices = np.array([mag['direction_matrix'] for mag in beam['mags']], dtype=np.float64)
+
+                positions += offsets.astype(np.float32)
+
+                # Blocks of (magnet, S tile) that are already complete, always none unless the build is being resumed
+                progress = np.zeros((num_magnets, len(tiles)), dtype=bool)
+                progress_dataset = None
+                if resume:
+                    # Beams without recorded progress in a resumed lookup are complete
+                    progress_dataset = outfile.get(f'progress/{beam["name"]}', None)
+                    progress = progress_dataset[...] if (progress_dataset is not None) else ~progress
+
+                    # Completed columns are only valid for the per slot offsets they were calculated with
+                    if np.any(progress) and np.any(beam_dataset.attrs['offsets'] != offsets):
+                        error_message = f'Lookup [{output_path}] beam [{beam["name"]}] was generated with different offsets and cannot be resumed'
+                        logger.error(error_message)
+                        raise Exception(error_message)
+
+                    beam_dataset.attrs['offsets'] = offsets
+
+                    if np.all(progress):
+                        logger.info('Beam %d [%s] is already complete', b, beam['name'])
+                        beam_geometries[beam['name']] = (positions, dimensions, offsets, direction_matrices)
+                        continue
+
+                    logger.info('Beam %d [%s] resuming with %d of %d magnets complete',
+                                b, beam['name'], np.count_nonzero(np.all(progress, axis=1)), num_magnets)
+
+                def record_progress(start, end, tile_index=slice(None)):
+                    # Flush the completed block to disk before recording it so an interruption can never skip it
+                    progress[start:end, tile_index] = True
+                    if progress_dataset is not None:
+                        outfile.flush()
+                        progress_dataset[start:end, tile_index] = True
+                        outfile.flush()
+
+                # Derive the whole beam from a previously generated beam if it is an exact mirror image of it
+                if mirror_beams:
+                    mirrored_beam = find_mirrored_beam(data, beam['name'], bfield_eval_points,
+                                                       positions, dimensions, offsets, beam_geometries)
+                    if mirrored_beam is not None:
+                        source_name, axis = mirrored_beam
+                        source_direction_matrices = beam_geometries[source_name][3]
+                        chunk_size = calculate_chunk_size(bfield_eval_points, memory_budget)
+
+                        # Check the derived bfield against the exact one for a magnet in the middle of the beam
+                        sample = num_magnets // 2
+                        exact_bfield = generate_beam_bfield_chunk(data, beam['name'], bfield_eval_points,
+                                                                  positions[sample:(sample + 1)], dimensions[sample:(sample + 1)],
+                                                                  direction_matrices[sample:(sample + 1)])
+                        mirror_bfield = generate_mirrored_bfield_chunk(read_beam_columns(outfile[source_name], sample, (sample + 1)), axis,
+                                                                       source_direction_matrices[sample:(sample + 1)],
+                                                                       direction_matrices[sample:(sample + 1)])
+                        mirror_error = np.max(np.abs(mirror_bfield - exact_bfield))
+
+                        if mirror_error <= (1e-9 * max(1, np.max(np.abs(exact_bfield)))):
+                            logger.info('Beam %d [%s] mirrors beam [%s] in axis %d with sampled error %1.8E',
+                                        b, beam['name'], source_name, axis, mirror_error)
+
+                            for start in range(0, num_magnets, chunk_size):
+                                end = min(start + chunk_size, num_magnets)
+                                write_beam_columns(beam_dataset, start, end, generate_mirrored_bfield_chunk(
+                                    read_beam_columns(outfile[source_name], start, end), axis,
+                                    source_direction_matrices[start:end], direction_matrices[start:end]))
+
+                            record_progress(0, num_magnets)
+                            beam_dataset.attrs['offsets'] = offsets
+                            beam_geometries[beam['name']] = (positions, dimensions, offsets, direction_matrices)
+                            continue
+
+                        logger.warning('Beam %d [%s] mirrors beam [%s] in axis %d but sampled error %1.8E is too large, '
+                                       'evaluating it exactly', b, beam['name'], source_name, axis, mirror_error)
+
+                # Magnets whose bfield is a shifted copy of a shared template, every other magnet is evaluated exactly
+                translated_magnets = set()
+
+                if templates:
+                    translation_groups = group_translated_magnets(data, positions, dimensions, offsets)
+                    translation_error  = 0
+
+                    for magnets, shifts in translation_groups:
+
+                        translated_bfield = generate_translation_template(data, beam['name'], bfield_eval_points,
+                                                                          positions[magnets[0]], dimensions[magnets[0]], shifts)
+
+                        # Measure the error of the template against the exact bfield of a few magnets spread across the group
+                        samples = np.unique(np.linspace(1, len(magnets) - 1, min(3, len(magnets) - 1)).astype(np.int64))
+                        exact_bfield = generate_beam_bfield_chunk(data, beam['name'], bfield_eval_points,
+                                                                  positions[magnets[samples]], dimensions[magnets[samples]],
+                                                                  np.tile(np.eye(3), (len(samples), 1, 1)))
+                        for sample_index, sample in enumerate(samples):
+                            translation_error = max(translation_error, np.max(np.abs(
+                                translated_bfield(shifts[sample]) - exact_bfield[..., sample_index])))
+
+                        # Rotate the shifted template into the coordinate system each magnet is placed in
+                        for a, shift in zip(magnets, shifts):
+                            if not np.all(progress[a]):
+                                write_beam_columns(beam_dataset, a, (a + 1), np.dot(translated_bfield(shift), direction_matrices[a])[..., np.newaxis])
+                                record_progress(a, (a + 1))
+
+                        translated_magnets.update(magnets.tolist())
+
+                    logger.info('Beam %d [%s] %d of %d magnets filled from %d translation templates with max sampled error %1.8E',
+                                b, beam['name'], len(translated_magnets), num_magnets, len(translation_groups), translation_error)
+
+                exact_magnets = sorted(set(range(num_magnets)) - translated_magnets)
+
+                # Compare against the offsets each column was calculated with and only recalculate the ones that moved
+                if update:
+                    exact_magnets = np.flatnonzero(np.any((beam_dataset.attrs['offsets'] != offsets), axis=1)).tolist()
+                    logger.info('Beam %d [%s] %d of %d magnets have changed offsets', b, beam['name'], len(exact_magnets), num_magnets)
+
+                # Calculate the bfields for chunks of magnets at once over a tile of the S axis, as many as fit in the memory budget
+                chunk_size = calculate_chunk_size(bfield_eval_points[..., :tile_size], memory_budget)
+
+                tasks = [(start, min(start + chunk_size, run_end), s_start, s_end, beam['name'],
+                          positions[start:min(start + chunk_size, run_end)], dimensions[start:min(start + chunk_size, run_end)],
+                          direction_matrices[start:min(start + chunk_size, run_end)])
+                         for run_start, run_end in contiguous_runs(exact_magnets)
+                         for start in range(run_start, run_end, chunk_size)
+                         for s_start, s_end in tiles
+                         if not np.all(progress[start:min(start + chunk_size, run_end), tile_indices[s_start]])]
+
+                # Blocks outside the influence window are left as zeros, which have to be written when updating existing values
+                if influence_window is not None:
+                    skipped_tasks = [task for task in tasks
+                                     if calculate_tile_distance(bfield_eval_points, *task[2:4], *task[5:7]) > influence_window]
+                    tasks = [task for task in tasks
+                             if calculate_tile_distance(bfield_eval_points, *task[2:4], *task[5:7]) <= influence_window]
+
+                    logger.info('Beam %d [%s] skipping %d of %d blocks outside the influence window',
+                                b, beam['name'], len(skipped_tasks), (len(tasks) + len(skipped_tasks)))
+
+                    for start, end, s_start, s_end, *_ in skipped_tasks:
+                        if update or resuming:
+                            write_beam_columns(beam_dataset, start, end, np.zeros((*shape[:2], (s_end - s_start), *shape[3:], (end - start))),
+                                               steps=slice(s_start, s_end))
+                        record_progress(start, end, tile_indices[s_start])
+
+                # Write chunks in whatever order the workers complete them, each one fills its own range of magnets and S steps
+                if comm is not None:
+                    logger.info('Node %3d of %3d Beam %d [%s] calculating %d of %d blocks',
+                                comm_rank, comm_size, b, beam['name'], len(tasks[comm_rank::comm_size]), len(tasks))
+                    chunks = generate_rank_chunks(comm, tasks, parallel_hdf5)
+                elif pool is not None:
+                    chunks = pool.imap_unordered(generate_beam_bfield_chunk_task, tasks)
+                else:
+                    chunks = map(generate_beam_bfield_chunk_task, tasks)
+
+                # Report progress and throughput at most every few seconds
+                start_time = last_report = time.monotonic()
+                num_blocks = np.count_nonzero(~progress)
+
+                def report_progress():
+                    blocks_done = num_blocks - np.count_nonzero(~progress)
+                    logger.info('Beam %d [%s] %d of %d magnets complete, %1.2f magnets per second',
+                                b, beam['name'], np.count_nonzero(np.all(progress, axis=1)), num_magnets,
+                                (blocks_done / len(tiles)) / max((time.monotonic() - start_time), 1e-9))
+
+                for start, end, s_start, s_end, per_magnet_bfield in chunks:
+                    write_beam_columns(beam_dataset, start, end, per_magnet_bfield, steps=slice(s_start, s_end))
+                    record_progress(start, end, tile_indices[s_start])
+
+                    logger.debug('Beam %d [%s] Magnets %3d to %3d S steps %4d to %4d bfield with shape [%s]',
+                                 b, beam['name'], start, end, s_start, s_end, shape)
+
+                    if (time.monotonic() - last_report) > 10:
+                        report_progress()
+                        last_report = time.monotonic()
+
+                if (len(tasks) > 0) and (beam_dataset is not None):
+                    report_progress()
+
+                # Record the offsets every column was calculated with so later shim changes can be applied incrementally
+                if beam_dataset is not None:
+                    beam_dataset.attrs['offsets'] = offsets
+                beam_geometries[beam['name']] = (positions, dimensions, offsets, direction_matrices)
+
+            # The lookup is complete so it no longer needs its progress
+            if resume and ('progress' in outfile):
+                del outfile['progress']
+
+            if hasattr(options, 'output_shim_csv') and (options.output_shim_csv is not None) and (comm_rank == 0):
                 df_output_shim = pd.DataFrame(output_csv_rows)
                 df_output_shim.to_csv(options.output_shim_csv, index=False)
 
@@ -261,6 +1253,19 @@ def process(options, args):
         logger.error('Failed to save lookup to [%s]', output_path, exc_info=ex)
         raise ex
 
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # Every rank has written its blocks before rank 0 reads the lookup back
+    if comm is not None:
+        comm.Barrier()
+
+    if (integrals_filename is not None) and (comm_rank == 0):
+        logger.info('Writing field integrals at the ends of %d blocks of the S axis to [%s]', integral_blocks, integrals_filename)
+        generate_integral_lookup(output_path, integrals_filename, data, integral_blocks, memory_budget)
+
     logger.debug('Halting')
 
 if __name__ == "__main__":
@@ -274,6 +1279,42 @@ if __name__ == "__main__":
     parser.add_option('--output-shim-csv', dest='output_shim_csv', help='Output a CSV file containing per slot shim offsets in XZS',
                       default=None, type=str)
 
+    parser.add_option('--resume', dest='resume', help='Record completed magnets so an interrupted build continues from where it stopped when run again',
+                      action='store_true', default=False)
+
+    parser.add_option('--update', dest='update', help='Recalculate only the magnets whose offsets changed in an existing lookup',
+                      action='store_true', default=False)
+
+    parser.add_option('--layout', dest='layout', help='Layout of the lookup on disk [point-major, magnet-major]',
+                      default='point-major', type='string')
+
+    parser.add_option('--memory-budget', dest='memory_budget', help='Memory in MB used to calculate chunks of magnets at once, small enough to stay in cache is fastest',
+                      default=8, type='float')
+
+    parser.add_option('--influence-window', dest='influence_window', help='Skip magnets further than this distance in mm along S from a tile of the S axis, leaving their lookup values zero (0 evaluates every magnet)',
+                      default=0, type='float')
+
+    parser.add_option('--integrals', dest='integrals_filename', help='Output a companion lookup of the first and second field integrals of every magnet',
+                      default=None, type=str)
+
+    parser.add_option('--integral-blocks', dest='integral_blocks', help='Number of blocks of the S axis with field integrals at their ends in the companion lookup',
+                      default=16, type='int')
+
+    parser.add_option('--gaps', dest='gaps', help='Comma separated list of gaps in mm to generate lookups for into one file, '
+                      'gaps that are a multiple of two Z steps apart share their evaluation', default=None, type='string')
+
+    parser.add_option('--mpi', dest='mpi', help='Partition the magnets across MPI ranks that write into the same lookup, run with mpirun',
+                      action='store_true', default=False)
+
+    parser.add_option('--workers', dest='workers', help='Number of worker processes used to calculate magnets in parallel',
+                      default=1, type='int')
+
+    parser.add_option('--translation-templates', dest='templates', help='Fill magnets translated by whole S steps from shared templates',
+                      action='store_true', default=False)
+
+    parser.add_option('--mirror-beams', dest='mirror_beams', help='Derive beams that mirror a previously generated beam from it',
+                      action='store_true', default=False)
+
     parser.add_option('--rand-seed', dest='seed', help='Random seed', default=None, type='int')
 
     parser.add_option('--rand-scale-x', dest='rsx', help='Random scale in X in mm', default=0, type='float')
@@ -234,7 +234,7 @@ class MagLists():
         return np.dot(field_vector, flip_vector) if (magnet[1] < 0) else field_vector
 
     # TODO benchmark severity of logger.debug() on the hot path
-    def mutate(self, num_mutations, available=None, flip_prob=0.5):
+    def sample_mutations(self, num_mutations, available=None, flip_prob=0.5):
         # If no availability is given then use the full set of magnet lists
         if available is None:
             logger.debug('No availability lists provides, using full set')
@@ -244,7 +244,8 @@ class MagLists():
 
         logger.debug('Available magnet lists [%s]', set_keys)
 
-        # Perform a set of mutations using the same availability criteria
+        # Sample a set of mutations using the same availability criteria in the format used by mutate_from_list
+        mutation_list = []
         for mutation_index in range(num_mutations):
             # Sample a random magnet set
             set_name = random.choice(set_keys)
@@ -259,10 +260,7 @@ class MagLists():
                     mag_a, mag_b = random.choice(available[set_name]), \
                                    random.choice(available[set_name])
 
-                self.swap(set_name, mag_a, mag_b)
-
-                logger.debug('%03d of %03d : [%s] Swapping magnets [%s] and [%s]',
-                             mutation_index, num_mutations, set_name, mag_a, mag_b)
+                mutation_list.append(('S', set_name, mag_a, mag_b))
 
             else:
                 # Flip one random magnet from the magnet list
@@ -271,10 +269,14 @@ class MagLists():
                 else:
                     mag = random.choice(available[set_name])
 
-                self.flip(set_name, (mag,))
+                mutation_list.append(('F', set_name, mag))
 
-                logger.debug('%03d of %03d : [%s] Flipping magnet [%s]',
-                             mutation_index, num_mutations, set_name, mag)
+        return mutation_list
+
+
+    def mutate(self, num_mutations, available=None, flip_prob=0.5):
+        # Sampling only depends on the list lengths so it can be done before applying any of the mutations
+        self.mutate_from_list(self.sample_mutations(num_mutations, available=available, flip_prob=flip_prob))
 
 
     # TODO benchmark severity of logger.debug() on the hot path
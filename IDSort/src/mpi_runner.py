@@ -46,11 +46,20 @@ import socket
 from mpi4py import MPI
 
 from .magnets import Magnets, MagLists
-from .genome_tools import ID_BCell
+from .genome_tools import ID_BCell, ID_BCell_Codec, BfieldResync, ResolutionSchedule
 
-from .field_generator import generate_reference_magnets,   \
-                             generate_bfield,              \
-                             calculate_bfield_phase_error
+from .field_generator import generate_reference_magnets,       \
+                             generate_bfield,                  \
+                             calculate_bfield_phase_error,     \
+                             calculate_trajectories,           \
+                             calculate_cached_trajectory_loss, \
+                             decimate_lookup,                  \
+                             TrajectorySurrogate,              \
+                             IntegralSurrogate,                \
+                             load_integral_block_ends,         \
+                             load_lookup
+
+from .lookup_generator import load_lazy_lookup
 
 from .logging_utils import logging, getLogger, setLoggerLevel
 logger = getLogger(__name__)
@@ -73,6 +82,9 @@ def process(options, args):
 
     output_path = args[0]
 
+    # Genomes every node received in the last exchange, these can be used as bases for delta encoded children
+    shared_genomes = {}
+
     if options.singlethreaded:
         # Who am I within the set of compute nodes
         comm_rank, comm_size, comm_ip = (0, 1, 'localhost')
@@ -82,8 +94,8 @@ def process(options, args):
             pass
 
         # No exchange needed in single node case
-        def exchange_genomes(local_population):
-            return local_population
+        def start_exchange(local_population):
+            return (lambda : local_population)
 
     else:
         # Who am I within the set of compute nodes
@@ -94,10 +106,65 @@ def process(options, args):
         def barrier():
             MPI.COMM_WORLD.Barrier()
 
-        # TODO need test case that uses multiple MPI nodes to test this communication works properly
-        # Exchange local population of genomes between compute nodes so that every node has the global population
-        def exchange_genomes(local_population):
-            return list(itertools.chain.from_iterable(MPI.COMM_WORLD.alltoall([local_population] * comm_size)))
+        # Start exchanging the local population of genomes between compute nodes so that every node has the global population,
+        # returns a function that waits for the exchange to complete and returns the global population
+        def start_exchange(local_population):
+            # Encode the local population as a compact int64 buffer of genome references, deltas, and snapshots
+            send_buffer = genome_codec.encode(local_population, shared_genomes)
+
+            # Send the buffer size followed by as much of the buffer as fits in a fixed size block, so the gather can start
+            # without first waiting for every node to report its buffer size, and the caller can keep computing while in flight
+            capacity   = exchange_capacity
+            send_block = np.zeros((capacity + 1), dtype=np.int64)
+            send_block[0] = len(send_buffer)
+            send_block[1:(1 + min(len(send_buffer), capacity))] = send_buffer[:capacity]
+
+            recv_blocks = np.zeros((comm_size, (capacity + 1)), dtype=np.int64)
+            request = MPI.COMM_WORLD.Iallgather(send_block, recv_blocks)
+
+            def wait_exchange():
+                nonlocal exchange_capacity
+                request.Wait()
+
+                counts = recv_blocks[:, 0]
+                buffers = [recv_blocks[rank, 1:(1 + min(counts[rank], capacity))] for rank in range(comm_size)]
+
+                # Gather the rest of any buffers that did not fit and grow the block so they fit in later exchanges
+                overflows = np.maximum((counts - capacity), 0)
+                if np.any(overflows > 0):
+                    displacements = np.concatenate([[0], np.cumsum(overflows)[:-1]]).astype(np.int64)
+                    recv_overflow = np.zeros(np.sum(overflows), dtype=np.int64)
+                    MPI.COMM_WORLD.Allgatherv(np.ascontiguousarray(send_buffer[capacity:]),
+                                              [recv_overflow, overflows, displacements, MPI.INT64_T])
+
+                    buffers = [np.concatenate([buffer, recv_overflow[displacement:(displacement + overflow)]])
+                               for buffer, displacement, overflow in zip(buffers, displacements, overflows)]
+
+                    exchange_capacity = max(exchange_capacity, (2 * int(np.max(counts))))
+                    logger.info('Node %3d of %3d exchanged %d words in a block of %d words, growing the block to %d words',
+                                comm_rank, comm_size, int(np.max(counts)), capacity, exchange_capacity)
+
+                logger.debug('Node %3d of %3d exchanged %d genomes in %d bytes, received %d bytes',
+                             comm_rank, comm_size, len(local_population), send_buffer.nbytes, sum(buffer.nbytes for buffer in buffers))
+
+                # Concatenate in rank order so every node sees the same global population, our own genomes are used as is
+                global_population = []
+                for rank in range(comm_size):
+                    if rank == comm_rank:
+                        global_population += local_population
+                    else:
+                        global_population += genome_codec.decode(buffers[rank], shared_genomes)
+
+                shared_genomes.clear()
+                shared_genomes.update({ genome.uid : genome for genome in global_population })
+
+                return global_population
+
+            return wait_exchange
+
+    # Exchange genomes between compute nodes and block until every node has the global population
+    def exchange_genomes(local_population):
+        return start_exchange(local_population)()
 
     logger.info('Node %3d of %3d @ [%s]', comm_rank, comm_size, comm_ip)
 
@@ -119,18 +186,53 @@ def process(options, args):
     try:
         logger.info('Loading ID lookup table [%s]', options.lookup_filename)
 
-        if options.singlethreaded:
-            worker_lookup = options.lookup_filename
+        # Point-major lookups can be transposed in memory so that per magnet gathers read contiguous rows
+        magnet_major = hasattr(options, 'magnet_major') and options.magnet_major
+
+        # Optimisation only uses the X and Z field components so the rows of the S component are not loaded
+        transverse = not (hasattr(options, 'full_lookup') and options.full_lookup)
+        gap = options.gap if hasattr(options, 'gap') else None
+
+        # The periodic interior of each beam can be evaluated as a convolution along S with FFTs
+        convolution = hasattr(options, 'convolution') and options.convolution
+
+        if hasattr(options, 'lazy_lookup') and options.lazy_lookup:
+
+            if (gap is not None) or convolution:
+                error_message = 'Cannot select a gap or evaluate by convolution with a lazy lookup'
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            # Columns are cached in their own file so a lookup table is never modified by a sort
+            lazy_cache = options.lazy_cache if hasattr(options, 'lazy_cache') else None
+            if (lazy_cache is not None) and (os.path.realpath(lazy_cache) == os.path.realpath(options.lookup_filename)):
+                error_message = f'Cannot cache lazy lookup columns in the lookup table [{options.lookup_filename}]'
+                logger.error(error_message)
+                raise Exception(error_message)
+
+            # The loss only uses the central eval line so only its columns are calculated, and cached when a cache is given,
+            # rank 0 calculates the columns that are not cached yet before the other ranks read them
+            if comm_rank == 0:
+                if lazy_cache is not None:
+                    logger.info('Caching lazy lookup columns in [%s]', lazy_cache)
+                lookup = load_lazy_lookup(lazy_cache, info, central_line=True, transverse=transverse)
+                for beam_lookup in lookup.values():
+                    beam_lookup.calculate()
+
+            barrier()
+
+            if comm_rank != 0:
+                lookup = load_lazy_lookup(lazy_cache, info, central_line=True, transverse=transverse, read_only=True)
+
         else:
-            worker_lookup = f'{options.lookup_filename}.worker-{comm_rank}'
-            shutil.copy(options.lookup_filename, worker_lookup)
 
-        with h5py.File(worker_lookup, 'r') as fp:
-            lookup = {}
-            for beam in info['beams']:
-                lookup[beam['name']] = fp[beam['name']][...]
-                logger.debug('Loaded beam [%s] with shape [%s]', beam['name'], lookup[beam['name']].shape)
+            if options.singlethreaded:
+                worker_lookup = options.lookup_filename
+            else:
+                worker_lookup = f'{options.lookup_filename}.worker-{comm_rank}'
+                shutil.copy(options.lookup_filename, worker_lookup)
 
+            lookup = load_lookup(worker_lookup, info, magnet_major=magnet_major, transverse=transverse, gap=gap, convolution=convolution)
 
     except Exception as ex:
         logger.error('Failed to load ID lookup table [%s]', options.lookup_filename, exc_info=ex)
@@ -146,6 +248,14 @@ def process(options, args):
         logger.error('Failed to load ID info from json [%s]', options.magnets_filename, exc_info=ex)
         raise ex
 
+    # Genomes are sent between nodes as int64 buffers that index into the loaded magnet sets
+    genome_codec = ID_BCell_Codec(magnet_sets)
+
+    # Number of words every node sends in the fixed size non-blocking gather of an exchange, large enough for every genome
+    # a node keeps between generations sent in full, and doubled past the largest buffer whenever a node sends more so
+    # later exchanges stay non-blocking, every node sees the same buffer sizes so it stays the same on every node
+    exchange_capacity = options.setup * genome_codec.snapshot_record_size()
+
     # From loaded data construct a perfect magnet array that the loss will be computed with respect to
     logger.info('Constructing perfect reference magnets to shadow real magnets and ideal bfield')
     ref_magnet_sets  = generate_reference_magnets(magnet_sets)
@@ -159,10 +269,96 @@ def process(options, args):
     # ref_strx, ref_strz = calculate_trajectory_straightness(info, ref_trajectories)
     # logger.debug('Perfect bfield trajectory straightness [%s] [%s]', ref_strx, ref_strz)
 
+    # Field integrals hold the same field components as the lookup so they can be applied to the same bfields
+    integral_lookup = None
+    if hasattr(options, 'integrals_filename') and (options.integrals_filename is not None):
+
+        # Field integrals are pre-summed at the block ends of the full resolution S axis
+        if hasattr(options, 'coarse_strides') and (options.coarse_strides is not None):
+            error_message = 'Cannot pre-screen children using field integrals when evaluating on coarse S grids'
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        integral_lookup     = load_lookup(options.integrals_filename, info, transverse=transverse, gap=gap)
+        integral_block_ends = load_integral_block_ends(options.integrals_filename, info, gap=gap)
+
+    # Optionally pre-screen children with a cheap surrogate loss so only the most promising are evaluated exactly,
+    # a random calibration sample of children measures the surrogate's rank correlation and suspends pre-screening if too low
+    surrogate_calibration     = options.surrogate_calibration if hasattr(options, 'surrogate_calibration') else 0.1
+    surrogate_min_correlation = options.surrogate_min_correlation if hasattr(options, 'surrogate_min_correlation') else None
+
+    def create_surrogate(eval_info, eval_lookup, eval_ref_bfield):
+        if integral_lookup is not None:
+            logger.info('Pre-screening children using the field integrals in [%s] keeping the best %0.2f',
+                        options.integrals_filename, options.surrogate_fraction)
+            return IntegralSurrogate(eval_info, integral_lookup, integral_block_ends, eval_ref_bfield,
+                                     fraction=options.surrogate_fraction, calibration=surrogate_calibration,
+                                     min_correlation=surrogate_min_correlation)
+
+        if hasattr(options, 'surrogate_stride') and (options.surrogate_stride > 0):
+            logger.info('Pre-screening children using every %d S-axis samples of the central line keeping the best %0.2f',
+                        options.surrogate_stride, options.surrogate_fraction)
+            return TrajectorySurrogate(eval_info, eval_lookup, eval_ref_bfield,
+                                       stride=options.surrogate_stride, fraction=options.surrogate_fraction,
+                                       calibration=surrogate_calibration, min_correlation=surrogate_min_correlation)
+
+        return None
+
+    # Optionally evaluate early generations on every Nth S sample and move to finer S grids as the sort progresses
+    schedule = None
+    if hasattr(options, 'coarse_strides') and (options.coarse_strides is not None):
+        coarse_iterations = options.coarse_iterations if hasattr(options, 'coarse_iterations') else 0
+        coarse_patience   = options.coarse_patience if hasattr(options, 'coarse_patience') else 0
+        schedule = ResolutionSchedule([int(stride) for stride in str(options.coarse_strides).split(',') if stride.strip() != ''],
+                                      iterations=coarse_iterations, patience=coarse_patience)
+        logger.info('Evaluating on every %s S samples, moving to the next after %d iterations or %d without improvement',
+                    schedule.strides, coarse_iterations, coarse_patience)
+
+    # Device info, lookup, and reference bfield and trajectories that evaluate genomes on every stride'th S sample,
+    # the trapezium integration along the decimated S axis uses a proportionally larger step size
+    def create_resolution(stride):
+        if stride == 1:
+            return info, lookup, ref_bfield, ref_trajectories
+
+        stride_info       = dict(info, sstep=(info['sstep'] * stride))
+        stride_lookup     = { beam : decimate_lookup(beam_lookup, stride) for beam, beam_lookup in lookup.items() }
+        stride_ref_bfield = ref_bfield[:, :, ::stride]
+        return stride_info, stride_lookup, stride_ref_bfield, calculate_trajectories(stride_info, stride_ref_bfield)
+
+    eval_info, eval_lookup, eval_ref_bfield, eval_ref_trajectories = create_resolution(schedule.stride if (schedule is not None) else 1)
+    surrogate = create_surrogate(eval_info, eval_lookup, eval_ref_bfield)
+
+    # Move to the next finer S grid and re-score the population on it, fitness values from different grids are not comparable
+    def switch_resolution(population, stride):
+        nonlocal eval_info, eval_lookup, eval_ref_bfield, eval_ref_trajectories, surrogate
+
+        logger.info('Node %3d of %3d evaluating on every %d S samples', comm_rank, comm_size, stride)
+
+        eval_info, eval_lookup, eval_ref_bfield, eval_ref_trajectories = create_resolution(stride)
+        surrogate = create_surrogate(eval_info, eval_lookup, eval_ref_bfield)
+
+        for genome in population:
+            _, genome.fitness = calculate_cached_trajectory_loss(eval_info, eval_lookup, magnet_sets, genome.genome, eval_ref_trajectories)
+            genome.bfield, genome.bfield_updates = None, 0
+
+        # Genomes received from other nodes are decoded from these shared bases, drop their bfields from the previous grid
+        # so they are recomputed on the new one instead of being copied into the decoded genomes
+        for genome in shared_genomes.values():
+            genome.bfield, genome.bfield_updates = None, 0
+
+        return population
+
+    # Optionally cache each genome's bfield and update it from its children's differences instead of recomputing it every generation
+    bfield_resync = None
+    if hasattr(options, 'bfield_resync') and (options.bfield_resync > 0):
+        logger.info('Caching genome bfields and recomputing them every %d generations or when drift exceeds %1.8E',
+                    options.bfield_resync, options.bfield_tolerance)
+        bfield_resync = BfieldResync(options.bfield_resync, tolerance=options.bfield_tolerance)
+
     barrier()
 
     # Filter the population for unique fitness values keeping the oldest genome when there are genomes with the same fitness
-    def filter_genomes(population):
+    def rank_genomes(population):
         genomes = {}
         for genome in population:
             # TODO remove dependency on filename scientific notation encoding
@@ -177,7 +373,11 @@ def process(options, args):
         population = filter((lambda genome : (genome.age < options.max_age)), genomes.values())
 
         # Sort the population so that the first one is the best genome
-        population = sorted(population, key=(lambda genome : genome.fitness))
+        return sorted(population, key=(lambda genome : genome.fitness))
+
+    # Filter the global population and take the slice of it that belongs to this node
+    def filter_genomes(population):
+        population = rank_genomes(population)
 
         # TODO this places all the best genomes on node with rank 0, consider replacing with strided distribution
         #  so all nodes get some of the best and some of the worse genomes
@@ -186,16 +386,27 @@ def process(options, args):
 
         return population
 
+    # When overlapping, each generation breeds from its own local survivors while the previous generation is being exchanged,
+    # the migrants it receives are merged into the following selection step
+    overlap_exchange = hasattr(options, 'overlap_exchange') and options.overlap_exchange
+
     # Synchronize nodes sequentially to print diagnostics about local genome populations
     def log_genomes(population):
         # Early return if logger is not set to at least output INFO messages
         if not logger.isEnabledFor(logging.INFO): return
 
-        # Synchronize nodes sequentially to print diagnostics about local genome populations
+        # Synchronize nodes sequentially to print diagnostics about local genome populations, unless exchanges are overlapped
+        # with compute where synchronizing would stall every node on the slowest one
         for rank in range(comm_size):
-            barrier()
+            if not overlap_exchange:
+                barrier()
             if rank != comm_rank: continue
 
+            # Nodes past the end of the initial population have no genomes until they receive children
+            if len(population) == 0:
+                logger.info('Node %3d of %3d has 0 genomes', comm_rank, comm_size)
+                continue
+
             # Compute the min, max, and average for the fitness, age, and mutations for each genome in the local population
             fitness_stats, age_stats, mutation_stats = [(np.min(data), np.max(data), np.mean(data))
                                                         for data in zip(*[(genome.fitness, genome.age, genome.mutations)
@@ -252,8 +463,8 @@ def process(options, args):
                 num_children  = options.setup - len(population)
                 num_mutations = 20
                 logger.info('Sampling the remaining %d genomes from the best genome using %d mutations each', num_children, num_mutations)
-                population   += population[0].generate_children(num_children, num_mutations, info, lookup,
-                                                                magnet_sets, ref_trajectories)
+                population   += population[0].generate_children(num_children, num_mutations, eval_info, eval_lookup,
+                                                                magnet_sets, eval_ref_trajectories)
 
         else:
             # If starting a new sort then generate a population of randomly initialized genomes
@@ -266,7 +477,7 @@ def process(options, args):
                 magnet_lists = MagLists(magnet_sets)
                 magnet_lists.shuffle_all()
                 genome = ID_BCell()
-                genome.create(info, lookup, magnet_sets, magnet_lists, ref_trajectories)
+                genome.create(eval_info, eval_lookup, magnet_sets, magnet_lists, eval_ref_trajectories)
                 population.append(genome)
 
         logger.debug('Initial population created')
@@ -286,27 +497,15 @@ def process(options, args):
             logger.error('Failed to save best genome to [%s]', output_path, exc_info=ex)
             raise ex
 
-    # Perform multiple iterations of mutations and communications
-    for iteration in range(options.iterations):
-        barrier()
-        if comm_rank == 0:
-            logger.info('Iteration %d', iteration)
+    # Best fitness in the global population, the same on every node
+    best_fitness = None
 
-        new_population = []
+    # Take this node's slice of a freshly exchanged global population and update estar, checkpoints, and diagnostics
+    def update_population(global_population):
+        nonlocal estar, best_fitness
 
-        # Apply mutations to each genome in the local population
-        for genome_index, genome in enumerate(population):
-
-            # For each genome we will generate multiple children by applying randomized numbers of random mutations to the current genome
-            num_children  = options.setup
-            num_mutations = mutations(options.c, estar, genome.fitness, options.scale)
-
-            # The new population will include the current genome and the random children of the current genome
-            new_population += [genome] + genome.generate_children(num_children, num_mutations, info, lookup,
-                                                                  magnet_sets, ref_trajectories)
-
-        # Exchange the genomes between compute nodes filter them, and redistribute them fairly between nodes for the next iteration
-        population = filter_genomes(exchange_genomes(new_population))
+        best_fitness = min(genome.fitness for genome in global_population)
+        population   = filter_genomes(global_population)
 
         estar = population[0].fitness * 0.99
         logger.info('Node %3d of %3d updated estar %0.8f', comm_rank, comm_size, estar)
@@ -326,6 +525,77 @@ def process(options, args):
                 raise ex
 
         log_genomes(population)
+        return population
+
+    # Exchange of the previous generation that is still in flight when overlapping
+    pending_exchange = None
+
+    # Perform multiple iterations of mutations and communications
+    for iteration in range(options.iterations):
+        # Synchronizing here would stall every node on the slowest one and defeat the overlap
+        if not overlap_exchange:
+            barrier()
+        if comm_rank == 0:
+            logger.info('Iteration %d', iteration)
+
+        new_population = []
+
+        # Apply mutations to each genome in the local population
+        for genome_index, genome in enumerate(population):
+
+            # For each genome we will generate multiple children by applying randomized numbers of random mutations to the current genome
+            num_children  = options.setup
+            num_mutations = mutations(options.c, estar, genome.fitness, options.scale)
+
+            # The new population will include the current genome and the random children of the current genome
+            new_population += [genome] + genome.generate_children(num_children, num_mutations, eval_info, eval_lookup,
+                                                                  magnet_sets, eval_ref_trajectories, surrogate=surrogate,
+                                                                  bfield_resync=bfield_resync)
+
+        # Report how well the surrogate ranking agrees with the exact fitness so the selected fraction can be tuned
+        if surrogate is not None:
+            correlation, num_samples = surrogate.rank_correlation()
+            logger.info('Node %3d of %3d surrogate rank correlation %0.4f over a calibration sample of %d children',
+                        comm_rank, comm_size, correlation, num_samples)
+
+        # Report how far the cached bfields drifted from the ones recomputed in full this generation
+        if bfield_resync is not None:
+            drift_min, drift_max, drift_avg, num_drifts = bfield_resync.drift_statistics()
+            logger.info('Node %3d of %3d cached bfield drift (min %1.8E, max %1.8E, avg %1.8E) over %d recomputes',
+                        comm_rank, comm_size, drift_min, drift_max, drift_avg, num_drifts)
+
+        # Merge in this node's slice of the previous generation's exchange now that it has had this generation's compute to complete
+        if pending_exchange is not None:
+            new_population += update_population(pending_exchange())
+            pending_exchange = None
+
+        # Only the best local genomes can survive the global filter, so drop the rest before they are encoded and sent
+        new_population = rank_genomes(new_population)[:(options.setup * comm_size)]
+
+        if overlap_exchange:
+            # Start the exchange and breed the next generation from the best local genomes while it is in flight
+            pending_exchange = start_exchange(new_population)
+            population = new_population[:options.setup]
+
+        else:
+            # Exchange the genomes between compute nodes filter them, and redistribute them fairly between nodes for the next iteration
+            population = update_population(exchange_genomes(new_population))
+
+        # Every node sees the same global best fitness so they all move to the next S grid together
+        if (schedule is not None) and schedule.update(best_fitness):
+            if pending_exchange is not None:
+                population += update_population(pending_exchange())
+                pending_exchange = None
+
+            population = update_population(exchange_genomes(switch_resolution(population, schedule.next_level())))
+
+    # Complete the final exchange so the best genome of the last generation is checkpointed
+    if pending_exchange is not None:
+        population = update_population(pending_exchange())
+
+    # Re-score the final population at full resolution so the checkpointed fitness is the exact one
+    if (schedule is not None) and (schedule.stride != 1):
+        population = update_population(exchange_genomes(switch_resolution(population, schedule.finish())))
 
     barrier()
 
@@ -351,6 +621,23 @@ if __name__ == "__main__":
     parser.add_option("--singlethreaded", dest="singlethreaded", help="Set the program to run as singlethreaded", action="store_true", default=False)
     parser.add_option("--seed", dest="seed", help="Seed the random number generator or not", action="store_true", default=False)
     parser.add_option("--seed_value", dest="seed_value", help="Seed value for the random number generator")
+    parser.add_option("--surrogate-stride", dest="surrogate_stride", help="Pre-screen children using every Nth S-axis sample of the central line (0 disables)", default=0, type='int')
+    parser.add_option("--integrals", dest="integrals_filename", help="Pre-screen children using a field integral companion lookup from lookup_generator (not with --coarse-strides)", default=None, type='string')
+    parser.add_option("--surrogate-fraction", dest="surrogate_fraction", help="Fraction of pre-screened children to evaluate exactly", default=0.2, type='float')
+    parser.add_option("--surrogate-calibration", dest="surrogate_calibration", help="Fraction of pre-screened children sampled at random and evaluated exactly to measure the surrogate's rank correlation", default=0.1, type='float')
+    parser.add_option("--surrogate-min-correlation", dest="surrogate_min_correlation", help="Evaluate every child exactly while the surrogate's rank correlation is below this", default=None, type='float')
+    parser.add_option("--coarse-strides", dest="coarse_strides", help="Comma separated strides of the S samples early generations are evaluated on, from coarsest to finest", default=None, type='string')
+    parser.add_option("--coarse-iterations", dest="coarse_iterations", help="Move to the next finer S grid after this many iterations (0 only moves when improvements stall)", default=0, type='int')
+    parser.add_option("--coarse-patience", dest="coarse_patience", help="Move to the next finer S grid after this many iterations without improving the best fitness (0 disables)", default=3, type='int')
+    parser.add_option("--overlap-exchange", dest="overlap_exchange", help="Breed each generation from local survivors while the previous generation is exchanged between nodes", action="store_true", default=False)
+    parser.add_option("--bfield-resync", dest="bfield_resync", help="Cache genome bfields and recompute them in full every N generations (0 recomputes every generation)", default=0, type='int')
+    parser.add_option("--bfield-tolerance", dest="bfield_tolerance", help="Cached bfield drift that halves the resync interval", default=1e-9, type='float')
+    parser.add_option("--magnet-major", dest="magnet_major", help="Hold the lookup in memory magnet-major as an (N*3, points*3) matrix", action="store_true", default=False)
+    parser.add_option("--gap", dest="gap", help="Gap in mm to select or interpolate from a gap scan lookup", default=None, type="float")
+    parser.add_option("--lazy-lookup", dest="lazy_lookup", help="Calculate the lookup columns of the central eval line on demand instead of loading the lookup table", action="store_true", default=False)
+    parser.add_option("--lazy-cache", dest="lazy_cache", help="Set the path to an HDF5 file that caches lazy lookup columns between runs", default=None, type="string")
+    parser.add_option("--convolution", dest="convolution", help="Evaluate the periodic interior of each beam as a convolution along S with FFTs", action="store_true", default=False)
+    parser.add_option("--full-lookup", dest="full_lookup", help="Load the S field component rows of the lookup that optimisation does not use", action="store_true", default=False)
 
     (options, args) = parser.parse_args()
 
@@ -31,12 +31,13 @@ from mpi4py import MPI
 from .magnets import Magnets, MagLists
 from .genome_tools import ID_Shim_BCell, ID_BCell
 
-from .field_generator import generate_reference_magnets, \
-                             generate_per_magnet_array,  \
-                             generate_availability,      \
-                             generate_bfield,            \
-                             compare_magnet_arrays,      \
-                             calculate_bfield_phase_error
+from .field_generator import generate_reference_magnets,   \
+                             generate_per_magnet_array,    \
+                             generate_availability,        \
+                             generate_bfield,              \
+                             compare_magnet_arrays,        \
+                             calculate_bfield_phase_error, \
+                             load_lookup
 
 from .logging_utils import logging, getLogger, setLoggerLevel #
 logger = getLogger(__name__)
@@ -147,11 +148,19 @@ def process(options, args):
             worker_lookup = f'{options.lookup_filename}.worker-{comm_rank}'
             shutil.copy(options.lookup_filename, worker_lookup)
 
-        with h5py.File(worker_lookup, 'r') as fp:
-            lookup = {}
-            for beam in info['beams']:
-                lookup[beam['name']] = fp[beam['name']][...]
-                logger.debug('Loaded beam [%s] with shape [%s]', beam['name'], lookup[beam['name']].shape)
+        # Point-major lookups can be transposed in memory so that per magnet gathers read contiguous rows
+        magnet_major = hasattr(options, 'magnet_major') and options.magnet_major
+
+        # Optimisation only uses the X and Z field components so the rows of the S component are not loaded
+        transverse = not (hasattr(options, 'full_lookup') and options.full_lookup)
+        gap = options.gap if hasattr(options, 'gap') else None
+        lookup = load_lookup(worker_lookup, info, magnet_major=magnet_major, transverse=transverse, gap=gap)
+
+        # The bfields saved for analysis need every field component, only the master node saves them so it alone loads
+        # the full lookup once for the whole sort
+        analysis_lookup = lookup
+        if transverse and (comm_rank == 0):
+            analysis_lookup = load_lookup(worker_lookup, info, magnet_major=magnet_major, gap=gap)
 
     except Exception as ex:
         logger.error('Failed to load ID lookup table [%s]', options.lookup_filename, exc_info=ex)
@@ -166,6 +175,9 @@ def process(options, args):
             real_bfield = fp['id_Bfield'][...]
             logger.debug('Loaded measured bfield with shape [%s]', real_bfield.shape)
 
+        # Shim updates computed from a transverse lookup only apply to the X and Z field components
+        optimisation_bfield = real_bfield[..., :2] if transverse else real_bfield
+
     except Exception as ex:
         logger.error('Failed to load ID measured bfield [%s]', options.bfield_filename, exc_info=ex)
         raise ex
@@ -286,7 +298,7 @@ def process(options, args):
         # Create a new random genome and add it to the population
         shim_genome = ID_Shim_BCell(available=available)
         shim_genome.create(info, lookup, magnet_sets, initial_genome.genome, ref_trajectories,
-                           options.number_of_changes, real_bfield)
+                           options.number_of_changes, optimisation_bfield)
         population.append(shim_genome)
 
     barrier()
@@ -323,7 +335,7 @@ def process(options, args):
 
             # The new population will include the current genome and the random children of the current genome
             new_population += [genome] + genome.generate_children(num_children, num_mutations, info, lookup,
-                                                                  magnet_sets, ref_trajectories, real_bfield=real_bfield)
+                                                                  magnet_sets, ref_trajectories, real_bfield=optimisation_bfield)
 
         # Exchange the genomes between compute nodes filter them, and redistribute them fairly between nodes for the next iteration
         population = filter_genomes(exchange_genomes(new_population))
@@ -351,11 +363,14 @@ def process(options, args):
             initial_genome.fitness = best_shim_genome.fitness
             initial_genome.uid = f'A{best_shim_genome.uid}'
             initial_genome.save(output_path)
-            saveh5(output_path, initial_genome, ref_genome, info, magnet_sets, real_bfield, lookup)
+
+            saveh5(output_path, initial_genome, ref_genome, info, magnet_sets, real_bfield, analysis_lookup)
+
             initial_genome.load(options.genome_filename)
 
         log_genomes(population)
 
+    del analysis_lookup
     barrier()
 
     # Checkpoint best genome with lowest fitness from the master node
@@ -399,6 +414,9 @@ if __name__ == "__main__":
     parser.add_option("--singlethreaded", dest="singlethreaded", help="Set the program to run as singlethreaded", action="store_true", default=False)
     parser.add_option("--seed", dest="seed", help="Seed the random number generator or not", action="store_true", default=False)
     parser.add_option("--seed_value", dest="seed_value", help="Seed value for the random number generator")
+    parser.add_option("--magnet-major", dest="magnet_major", help="Hold the lookup in memory magnet-major as an (N*3, points*3) matrix", action="store_true", default=False)
+    parser.add_option("--gap", dest="gap", help="Gap in mm to select or interpolate from a gap scan lookup", default=None, type="float")
+    parser.add_option("--full-lookup", dest="full_lookup", help="Load the S field component rows of the lookup that optimisation does not use", action="store_true", default=False)
 
     parser.add_option("--available", dest="available", default=None, type="str",
                       help="A dictionary '{ \"TOP\": [2, [4, 8], 10], \"BTM\": [[4, 8]] }' "
@@ -13,6 +13,8 @@ from definitions import ROOT_DIR
 from IDSort.src import id_setup, magnets, lookup_generator, mpi_runner, \
         mpi_runner_for_shim_opt, process_genome, compare
 
+from .stage_cache import hash_stage, run_cached_stage
+
 from .logging_utils import logging, getLogger, setLoggerLevel
 logger = getLogger(__name__)
 
@@ -333,7 +335,8 @@ if __name__ == "__main__":
     from optparse import OptionParser
     usage = "%prog [options] ConfigFile OutputDataDir"
     parser = OptionParser(usage=usage)
-    parser.add_option("--force-generate", dest="force_generate", help="Force the generation of ID .json, .mag, and .h5 files even if they exist.", action="store_true", default=False)
+    parser.add_option("--force-generate", dest="force_generate", help="Force the generation of ID .json, .mag, and .h5 files even if their inputs have not changed.", action="store_true", default=False)
+    parser.add_option("--cache-dir", dest="cache_dir", help="Directory of generated .json, .mag, and .h5 files shared between runs, keyed by the hash of their inputs", default=None, type="string")
     parser.add_option("--sort", dest="sort", help="Run a sort job", action="store_true", default=False)
     parser.add_option("--restart-sort", dest="restart_sort", help="Run a sort job with an initial population of genomes", action="store_true", default=False)
     parser.add_option("--shim", dest="shim", help="Run a shim job", action="store_true", default=False)
@@ -380,20 +383,21 @@ if __name__ == "__main__":
     if not options.restart_sort and not options.generate_report and not options.compare_shim:
         logger.info(f'Running lookup generation...')
 
-        if options.force_generate or not os.path.exists(json_filepath):
-            run_id_setup(config['id_setup'], [json_filepath])
-        else:
-            logger.info(f'Using cached .json')
-
-        if options.force_generate or not os.path.exists(mag_filepath):
-            run_magnets(config['magnets'], [mag_filepath])
-        else:
-            logger.info(f'Using cached .mag')
-
-        if options.force_generate or not os.path.exists(h5_filepath):
-            run_lookup_generator(config['lookup_generator'], [json_filepath, h5_filepath])
-        else:
-            logger.info(f'Using cached .h5')
+        # Each stage is hashed from its config section, the files it reads, and the hashes of the stages it depends on
+        json_hash = hash_stage(config['id_setup'])
+        run_cached_stage('.json', json_filepath, json_hash,
+                         lambda: run_id_setup(config['id_setup'], [json_filepath]),
+                         cache_dir=options.cache_dir, force_generate=options.force_generate)
+
+        mag_hash = hash_stage(config['magnets'], file_options=('hmags', 'hemags', 'htmags', 'vmags', 'vemags'))
+        run_cached_stage('.mag', mag_filepath, mag_hash,
+                         lambda: run_magnets(config['magnets'], [mag_filepath]),
+                         cache_dir=options.cache_dir, force_generate=options.force_generate)
+
+        h5_hash = hash_stage(config['lookup_generator'], file_options=('shim_csv',), upstream_hashes=(json_hash,))
+        run_cached_stage('.h5', h5_filepath, h5_hash,
+                         lambda: run_lookup_generator(config['lookup_generator'], [json_filepath, h5_filepath]),
+                         cache_dir=options.cache_dir, force_generate=options.force_generate)
 
     # both a sort and shim's use of process_genome.py need the json, mag, h5
     # filepaths
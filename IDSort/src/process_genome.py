@@ -206,7 +206,10 @@ def process(options, args):
 
             analysis_path = os.path.join(options.output_dir, os.path.split(genome_path)[1] + '.h5')
             logger.info('Output path [%s]', analysis_path)
-            write_bfields(analysis_path, options.id_filename, options.id_template, options.magnets_filename, maglists)
+            memory_budget = options.memory_budget if (hasattr(options, 'memory_budget') and (options.memory_budget > 0)) else None
+            gap = options.gap if hasattr(options, 'gap') else None
+            write_bfields(analysis_path, options.id_filename, options.id_template, options.magnets_filename, maglists,
+                          memory_budget=memory_budget, gap=gap)
 
     logger.debug('Halting')
 
@@ -234,6 +237,12 @@ if __name__ == '__main__':
     parser.add_option('-t', '--template', dest='id_template',
                       help='Set the path to the magnet description file', type='string')
 
+    parser.add_option('--memory-budget', dest='memory_budget', default=0, type='int',
+                      help='Evaluate the lookup from disk in tiles using at most this many MB (0 loads it into memory)')
+
+    parser.add_option('--gap', dest='gap', default=None, type='float',
+                      help='Gap in mm to select or interpolate from a gap scan lookup')
+
     parser.add_option('-o', '--output-dir', dest='output_dir',
                       help='Set the path of the directory that the output files are written to')
 
@@ -0,0 +1,85 @@
+'''
+Content addressed reuse of the artefacts generated by the stages of the optid pipeline. Each artefact has a .sha256
+file next to it holding the hash of everything the stage read to generate it, and artefacts can be shared between run
+directories through a cache store directory keyed on that hash.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+
+from .logging_utils import logging, getLogger
+logger = getLogger(__name__)
+
+# Options that change how a stage runs but not the artefact it generates
+UNHASHED_OPTIONS = ('verbose', 'workers', 'memory_budget')
+
+def hash_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_stage(options, file_options=(), upstream_hashes=()):
+    # Hash everything a pipeline stage depends on, options naming input files are hashed by the contents of the file
+    # so that artefacts stay valid when inputs are moved and become stale when inputs are edited in place
+    hashed_options = { key : value for key, value in dict(options).items() if key not in UNHASHED_OPTIONS }
+    for key in file_options:
+        if hashed_options.get(key, None) is not None:
+            hashed_options[key] = hash_file(hashed_options[key])
+
+    digest = hashlib.sha256(json.dumps(hashed_options, sort_keys=True, default=str).encode())
+    for upstream_hash in upstream_hashes:
+        digest.update(upstream_hash.encode())
+    return digest.hexdigest()
+
+def read_stage_hash(filepath):
+    hash_filepath = filepath + '.sha256'
+    if not (os.path.exists(filepath) and os.path.exists(hash_filepath)):
+        return None
+    with open(hash_filepath, 'r') as fp:
+        return fp.read().strip()
+
+def write_stage_hash(filepath, stage_hash):
+    with open(filepath + '.sha256', 'w') as fp:
+        fp.write(stage_hash)
+
+def run_cached_stage(name, filepath, stage_hash, run_stage, cache_dir=None, force_generate=False):
+    # Reuse the artefact if it was made from exactly the same inputs, otherwise fetch it from the cache store
+    # shared between run directories, or run the stage and add its artefact to the cache store
+    if not force_generate and (read_stage_hash(filepath) == stage_hash):
+        logger.info(f'Using cached {name} [{filepath}] with hash [{stage_hash}]')
+        return
+
+    # Artefacts generated before they were hashed are adopted as they are, the same as they were reused before
+    hash_filepath = filepath + '.sha256'
+    if not force_generate and os.path.exists(filepath) and not os.path.exists(hash_filepath):
+        logger.warning(f'Adopting existing {name} [{filepath}] without a hash as hash [{stage_hash}], '
+                       f'use --force-generate to regenerate it if its inputs have changed')
+        write_stage_hash(filepath, stage_hash)
+        return
+
+    # Mark the artefact as incomplete first so an interrupted stage can never leave an artefact that looks valid,
+    # or one that looks like it was generated before artefacts were hashed
+    write_stage_hash(filepath, 'incomplete')
+
+    cache_filepath = None
+    if cache_dir is not None:
+        cache_filepath = os.path.join(cache_dir, stage_hash + os.path.splitext(filepath)[1])
+
+    if not force_generate and (cache_filepath is not None) and os.path.exists(cache_filepath):
+        logger.info(f'Copying {name} with hash [{stage_hash}] from cache store [{cache_filepath}]')
+        shutil.copyfile(cache_filepath, filepath)
+
+    else:
+        run_stage()
+
+        if cache_filepath is not None:
+            logger.info(f'Adding {name} with hash [{stage_hash}] to cache store [{cache_filepath}]')
+            os.makedirs(cache_dir, exist_ok=True)
+            shutil.copyfile(filepath, cache_filepath + '.tmp')
+            os.replace(cache_filepath + '.tmp', cache_filepath)
+
+    write_stage_hash(filepath, stage_hash)
@@ -0,0 +1,473 @@
+import unittest, os
+import copy
+import random
+
+import json
+import numpy as np
+from scipy.stats import spearmanr
+
+from ..src.magnets import Magnets, MagLists
+from ..src.field_generator import load_lookup, calculate_cached_trajectory_loss, calculate_bfield_phase_error, \
+                                  generate_reference_magnets, generate_bfield, generate_per_magnet_array, \
+                                  generate_magnet_slots, generate_per_magnet_array_differences, \
+                                  compare_magnet_differences, compare_magnet_arrays, TrajectorySurrogate
+from ..src.genome_tools import ID_BCell, ID_BCell_Codec, BfieldResync, ResolutionSchedule
+
+
+class ResolutionScheduleTest(unittest.TestCase):
+
+    def test_strides(self):
+
+        # Strides are ordered coarsest first, duplicates and full resolution strides are dropped, and it always ends at 1
+        schedule = ResolutionSchedule([2, 4, 1, 4])
+        assert schedule.strides == [4, 2, 1]
+        assert schedule.stride == 4
+
+        schedule = ResolutionSchedule([])
+        assert schedule.strides == [1]
+        assert schedule.stride == 1
+
+    def test_update_iterations(self):
+
+        schedule = ResolutionSchedule([4, 2], iterations=2)
+
+        # Move to the next level after the set number of iterations even while the fitness improves
+        assert not schedule.update(3.0)
+        assert schedule.update(2.0)
+        assert schedule.next_level() == 2
+
+        # Counters are reset on the new level
+        assert schedule.level_iterations == 0
+        assert schedule.best_fitness is None
+
+        assert not schedule.update(1.0)
+        assert schedule.update(0.5)
+        assert schedule.next_level() == 1
+
+        # Full resolution is never left
+        assert not schedule.update(0.25)
+        assert not schedule.update(0.25)
+        assert schedule.next_level() == 1
+
+    def test_update_patience(self):
+
+        schedule = ResolutionSchedule([4], patience=2)
+
+        # Only iterations without an improvement of the best fitness count towards the patience
+        assert not schedule.update(3.0)
+        assert not schedule.update(2.0)
+        assert not schedule.update(2.0)
+        assert not schedule.update(1.0)
+        assert not schedule.update(1.5)
+        assert schedule.update(1.0)
+        assert schedule.next_level() == 1
+
+    def test_update_disabled(self):
+
+        # Without iterations or patience the schedule never moves on its own
+        schedule = ResolutionSchedule([4])
+        for _ in range(10):
+            assert not schedule.update(1.0)
+        assert schedule.stride == 4
+
+    def test_finish(self):
+
+        schedule = ResolutionSchedule([8, 4, 2], iterations=1, patience=1)
+        assert schedule.update(1.0)
+        assert schedule.next_level() == 4
+
+        # Skips any remaining coarse levels
+        assert schedule.finish() == 1
+        assert schedule.stride == 1
+        assert schedule.level_iterations == 0
+        assert not schedule.update(1.0)
+
+
+class BfieldResyncTest(unittest.TestCase):
+
+    def test_needs_resync(self):
+
+        resync = BfieldResync(4)
+        genome = ID_BCell()
+
+        # Genomes without a cached bfield always need a full evaluation
+        assert resync.needs_resync(genome)
+
+        genome.bfield, genome.bfield_updates = np.zeros((1, 1, 4, 3)), 3
+        assert not resync.needs_resync(genome)
+
+        genome.bfield_updates = 4
+        assert resync.needs_resync(genome)
+
+    def test_add_drift(self):
+
+        resync = BfieldResync(8, tolerance=1e-9)
+        bfield = np.zeros((3, 3, 16, 3))
+
+        # Drift within the tolerance keeps the interval
+        resync.add_drift((bfield + 1e-10), bfield, 8)
+        assert resync.interval == 8
+
+        # Drift over the tolerance halves the interval down to recomputing every generation
+        for interval in [4, 2, 1, 1]:
+            drifted = bfield.copy()
+            drifted[1, 1, 5, 0] = -1e-8
+            resync.add_drift(drifted, bfield, interval)
+            assert resync.interval == interval
+
+    def test_drift_statistics(self):
+
+        resync = BfieldResync(8, tolerance=1.0)
+        bfield = np.zeros((3, 3, 16, 3))
+
+        assert resync.drift_statistics() == (0.0, 0.0, 0.0, 0)
+
+        for drift in [1e-12, 3e-12, -2e-12]:
+            resync.add_drift((bfield + drift), bfield, 8)
+
+        # Statistics are of the maximum absolute drift of each recompute, reset after reading unless asked not to
+        assert np.allclose(resync.drift_statistics(reset=False), (1e-12, 3e-12, 2e-12, 3), rtol=1e-9, atol=0)
+        assert np.allclose(resync.drift_statistics(), (1e-12, 3e-12, 2e-12, 3), rtol=1e-9, atol=0)
+        assert resync.drift_statistics() == (0.0, 0.0, 0.0, 0)
+
+
+class IDBCellCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        inp_path = 'IDSort/test/data/mpi_runner_test/test_process/inputs'
+
+        self.magnets = Magnets()
+        self.magnets.load(os.path.join(inp_path, 'test_cpmu.mag'))
+        self.codec = ID_BCell_Codec(self.magnets)
+
+        random.seed(0)
+
+        # Materialised genome with a shuffled and partly flipped magnet list
+        self.base = ID_BCell()
+        self.base.genome = MagLists(self.magnets)
+        self.base.genome.shuffle_all()
+        self.base.genome.mutate(20)
+        self.base.fitness, self.base.age, self.base.mutations = 1.25e-4, 3, 2
+
+    def create_child(self, parent, num_mutations, fitness):
+        # Lazy child as created by ID_BCell.generate_children, sampling only depends on the magnet list lengths so the
+        # base genome is used to leave lazy parents unmaterialised
+        child = ID_BCell()
+        child.parent        = parent
+        child.mutation_list = self.base.genome.sample_mutations(num_mutations)
+        child.fitness       = fitness
+        child.mutations     = num_mutations
+        return child
+
+    def assert_genomes_equal(self, decoded, genome):
+        assert decoded.uid == genome.uid
+        assert decoded.age == genome.age
+        assert decoded.mutations == genome.mutations
+        assert decoded.fitness == genome.fitness
+        assert decoded.genome.magnet_lists == genome.genome.magnet_lists
+
+    def test_snapshot(self):
+
+        # Genomes without a shared base are sent in full, uids are not limited to hex strings
+        self.base.uid = 'snapshot-genome-uid'
+        data = self.codec.encode([self.base], {})
+        assert data[1] == ID_BCell_Codec.SNAPSHOT
+
+        population = self.codec.decode(data, {})
+        assert len(population) == 1
+        assert population[0].parent is None
+        self.assert_genomes_equal(population[0], self.base)
+
+    def test_delta(self):
+
+        shared_genomes = { self.base.uid : self.base }
+        children = [self.create_child(self.base, num_mutations, (1e-4 * num_mutations)) for num_mutations in [1, 5]]
+
+        # Lazy children of a shared genome are sent as their parent's uid and their mutation list
+        data = self.codec.encode(children, shared_genomes)
+        assert all(child.parent is self.base for child in children)
+
+        population = self.codec.decode(data, shared_genomes)
+        assert len(population) == len(children)
+        for decoded, child in zip(population, children):
+            assert decoded.parent is self.base
+            assert decoded.mutation_list == child.mutation_list
+            self.assert_genomes_equal(decoded, child)
+
+        # Sending the materialised children in full takes more words
+        assert len(data) < len(self.codec.encode(children, {}))
+
+        # Materialising the decoded children never changes their shared parent
+        assert population[0].genome.magnet_lists != self.base.genome.magnet_lists
+
+    def test_delta_lazy_base(self):
+
+        # A shared base that is itself lazy is flattened so the decoded genome is one step from a materialised one
+        lazy_base = self.create_child(self.base, 3, 1e-4)
+        child     = self.create_child(lazy_base, 4, 2e-4)
+        shared_genomes = { self.base.uid : self.base, lazy_base.uid : lazy_base }
+
+        population = self.codec.decode(self.codec.encode([child], shared_genomes), shared_genomes)
+        assert population[0].parent is self.base
+        assert population[0].mutation_list == (lazy_base.mutation_list + child.mutation_list)
+
+        # Shared genomes are left lazy
+        assert lazy_base.parent is self.base
+
+        self.assert_genomes_equal(population[0], child)
+
+    def test_shared(self):
+
+        self.base.bfield, self.base.bfield_updates = np.ones((3, 3, 8, 3)), 2
+        shared_genomes = { self.base.uid : self.base }
+
+        # Genomes every node holds are sent by reference with their updated fitness and age
+        self.base.age += 1
+        data = self.codec.encode([self.base], shared_genomes)
+        assert data[1] == ID_BCell_Codec.SHARED
+
+        population = self.codec.decode(data, shared_genomes)
+        self.assert_genomes_equal(population[0], self.base)
+        assert population[0].genome is self.base.genome
+        assert population[0].bfield is self.base.bfield
+        assert population[0].bfield_updates == 2
+
+        # Once a resolution switch drops the bfields of the shared genomes, decoded genomes do not carry the bfield
+        # of the previous S grid
+        self.base.bfield, self.base.bfield_updates = None, 0
+        population = self.codec.decode(data, shared_genomes)
+        assert population[0].bfield is None
+        assert population[0].bfield_updates == 0
+
+    def test_unknown_base(self):
+
+        child = self.create_child(self.base, 2, 1e-4)
+        data  = self.codec.encode([self.base, child], { self.base.uid : self.base })
+
+        # Genomes sent by reference cannot be decoded by a node that does not hold their base
+        with self.assertRaises(Exception) as context:
+            self.codec.decode(data, {})
+
+        assert 'is not shared' in str(context.exception)
+
+
+class ExactSurrogate(TrajectorySurrogate):
+    # Surrogate that ranks children by their exact loss
+    def __init__(self, info, lookup, ref_trajectories, fraction=0.2, calibration=0.1, min_correlation=None):
+        self.init_selection(fraction, calibration, min_correlation)
+        self.info, self.lookup, self.ref_trajectories = info, lookup, ref_trajectories
+
+    def project_bfield(self, bfield):
+        return bfield
+
+
+class TopOnlySurrogate(ExactSurrogate):
+    # Surrogate that ranks children exactly up to a loss and in reverse above it
+    def __init__(self, info, lookup, ref_trajectories, threshold, **kargs):
+        super().__init__(info, lookup, ref_trajectories, **kargs)
+        self.threshold = threshold
+
+    def rank_loss(self, loss):
+        return loss if (loss <= self.threshold) else (self.threshold + (1.0 / loss))
+
+    def calculate_loss(self, parent_bfield, differences):
+        return self.rank_loss(super().calculate_loss(parent_bfield, differences))
+
+
+def eager_mutate(maglist, num_mutations, flip_prob=0.5):
+    # Reference of mutating a magnet list while sampling each mutation, drawing from the RNG in the same order
+    set_keys = list(maglist.magnet_lists.keys())
+    for mutation_index in range(num_mutations):
+        set_name = random.choice(set_keys)
+        if random.random() > flip_prob:
+            maglist.swap(set_name, random.randint(0, len(maglist.magnet_lists[set_name]) - 1),
+                                   random.randint(0, len(maglist.magnet_lists[set_name]) - 1))
+        else:
+            maglist.flip(set_name, (random.randint(0, len(maglist.magnet_lists[set_name]) - 1),))
+
+
+class IDBCellTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        inp_path = 'IDSort/test/data/mpi_runner_test/test_process/inputs'
+
+        with open(os.path.join(inp_path, 'test_cpmu.json'), 'r') as fp:
+            cls.info = json.load(fp)
+
+        cls.magnets = Magnets()
+        cls.magnets.load(os.path.join(inp_path, 'test_cpmu.mag'))
+
+        cls.lookup = load_lookup(os.path.join(inp_path, 'test_cpmu.h5'), cls.info)
+        ref_magnet_sets = generate_reference_magnets(cls.magnets)
+        cls.ref_bfield = generate_bfield(cls.info, MagLists(ref_magnet_sets), ref_magnet_sets, cls.lookup)
+        _, cls.ref_trajectories = calculate_bfield_phase_error(cls.info, cls.ref_bfield)
+
+    def create_parent(self):
+        random.seed(0)
+        maglist = MagLists(self.magnets)
+        maglist.shuffle_all()
+
+        parent = ID_BCell()
+        parent.create(self.info, self.lookup, self.magnets, maglist, self.ref_trajectories)
+        return parent
+
+    def generate_children(self, parent, number_of_children, seed, **kargs):
+        # Children of a copy of the parent so every call samples the same mutation lists for the same seed
+        random.seed(seed)
+        return parent.clone().generate_children(number_of_children, 3, self.info, self.lookup, self.magnets,
+                                                 self.ref_trajectories, **kargs)
+
+    def calculate_fitness(self, genome):
+        _, fitness = calculate_cached_trajectory_loss(self.info, self.lookup, self.magnets, genome.genome, self.ref_trajectories)
+        return fitness
+
+    def test_generate_children_surrogate(self):
+
+        parent = self.create_parent()
+
+        # Screening and calibrating on every child gives the surrogate and exact loss of each of them
+        calibration  = TrajectorySurrogate(self.info, self.lookup, self.ref_bfield, stride=4, fraction=1.0, calibration=1.0)
+        all_children = self.generate_children(parent, 12, 1, surrogate=calibration)
+        assert len(all_children) == 12
+
+        surrogate_losses = [surrogate_loss for surrogate_loss, _ in calibration.samples]
+        assert [exact_loss for _, exact_loss in calibration.samples] == [child.fitness for child in all_children]
+
+        # Only the fraction of children with the lowest surrogate losses are evaluated, in the order they were sampled
+        surrogate = TrajectorySurrogate(self.info, self.lookup, self.ref_bfield, stride=4, fraction=0.25, calibration=0.5)
+        children  = self.generate_children(parent, 12, 1, surrogate=surrogate)
+        assert len(children) == surrogate.num_selected(12) == 3
+
+        selected = sorted(np.argsort(surrogate_losses, kind='stable')[:3])
+        for child, index in zip(children, selected):
+            assert child.mutation_list == all_children[index].mutation_list
+
+        # Rank correlation is measured over a random sample of all the children, including ones that were not selected
+        assert len(surrogate.samples) == 6
+        calibrated = [int(np.argmin(np.abs(np.array(surrogate_losses) - surrogate_loss))) for surrogate_loss, _ in surrogate.samples]
+        assert len(set(calibrated)) == 6
+
+        for (surrogate_loss, exact_loss), index in zip(surrogate.samples, calibrated):
+            assert np.isclose(surrogate_loss, surrogate_losses[index], rtol=1e-9, atol=0)
+            assert np.isclose(exact_loss, all_children[index].fitness, rtol=1e-9, atol=0)
+
+        correlation, num_samples = surrogate.rank_correlation()
+        assert num_samples == 6
+        assert np.isclose(correlation, spearmanr([surrogate_losses[index] for index in calibrated],
+                                                 [all_children[index].fitness for index in calibrated])[0])
+        assert surrogate.samples == []
+
+        # The selected children are evaluated exactly
+        for child in children:
+            assert np.isclose(child.fitness, self.calculate_fitness(child), rtol=1e-9, atol=0)
+
+    def test_generate_children_surrogate_rejected(self):
+
+        parent = self.create_parent()
+
+        # Exact losses of every child to find the ones a surrogate keeping the best 0.2 should select
+        exact = ExactSurrogate(self.info, self.lookup, self.ref_trajectories, fraction=1.0, calibration=1.0)
+        all_children = self.generate_children(parent, 40, 5, surrogate=exact)
+        exact_losses = sorted(child.fitness for child in all_children)
+
+        # Surrogate that ranks the best children exactly but the rest in reverse
+        surrogate = TopOnlySurrogate(self.info, self.lookup, self.ref_trajectories, ((exact_losses[7] + exact_losses[8]) / 2),
+                                     fraction=0.2, calibration=0.5, min_correlation=0.5)
+        children = self.generate_children(parent, 40, 5, surrogate=surrogate)
+        assert np.allclose(sorted(child.fitness for child in children), exact_losses[:8], rtol=1e-9, atol=0)
+
+        # Over the selected children alone it would look perfect
+        assert np.isclose(spearmanr([surrogate.rank_loss(child.fitness) for child in children],
+                                    [child.fitness for child in children])[0], 1.0)
+
+        # Over the calibration sample of all children it is rejected, so every child is evaluated exactly
+        correlation, num_samples = surrogate.rank_correlation()
+        assert num_samples == 20
+        assert correlation < 0.5
+        assert not surrogate.trusted
+
+        children = self.generate_children(parent, 40, 5, surrogate=surrogate)
+        assert len(children) == 40
+
+    def test_generate_children_lazy(self):
+
+        parent   = self.create_parent()
+        children = self.generate_children(parent, 6, 2)
+
+        # Children only hold their parent and mutation list until their genome is needed
+        assert all((child.parent is not None) and (child._genome is None) for child in children)
+
+        # Materialising each child matches mutating a copy of the parent genome from the same RNG state
+        for mutate in [(lambda maglist : maglist.mutate(3)), (lambda maglist : eager_mutate(maglist, 3))]:
+            random.seed(2)
+            for child in children:
+                maglist = copy.deepcopy(parent.genome)
+                mutate(maglist)
+                assert child.clone().genome.magnet_lists == maglist.magnet_lists
+
+        # The fitness of each lazy child is that of its materialised genome
+        for child in children:
+            child.materialise()
+            assert (child.parent is None) and (child.mutation_list is None)
+            assert np.isclose(child.fitness, self.calculate_fitness(child), rtol=1e-9, atol=0)
+
+    def test_generate_children_bfield_resync(self):
+
+        resync = BfieldResync(3, tolerance=1e-9)
+        parent = self.create_parent()
+
+        # Follow the best child over several generations so the cached bfield is updated from the differences of each
+        random.seed(3)
+        for generation in range(7):
+            children = parent.generate_children(4, 3, self.info, self.lookup, self.magnets, self.ref_trajectories,
+                                                bfield_resync=resync)
+
+            for child in children:
+                assert child.bfield_updates == (parent.bfield_updates + 1)
+
+                # The cached child bfield matches recomputing it in full
+                bfield = generate_bfield(self.info, child.genome, self.magnets, self.lookup)
+                assert np.allclose(child.bfield, bfield, rtol=0, atol=(1e-12 * np.max(np.abs(bfield))))
+
+            parent = min(children, key=(lambda child : child.fitness))
+            assert parent.bfield_updates <= resync.interval
+
+        # Parents are recomputed in full every interval generations, measuring how far their cached bfield drifted
+        min_drift, max_drift, mean_drift, num_drifts = resync.drift_statistics()
+        assert num_drifts == 2
+        assert max_drift < resync.tolerance
+        assert resync.interval == 3
+
+    def test_per_magnet_array_differences(self):
+
+        parent = self.create_parent()
+        parent_per_magnet_array = generate_per_magnet_array(self.info, parent.genome, self.magnets)
+        slots = generate_magnet_slots(self.info)
+
+        random.seed(4)
+        for num_mutations in [1, 3, 10, 50]:
+            mutation_list = parent.genome.sample_mutations(num_mutations)
+
+            maglist = copy.deepcopy(parent.genome)
+            maglist.mutate_from_list(mutation_list)
+            child_per_magnet_array = generate_per_magnet_array(self.info, maglist, self.magnets)
+
+            # Only the columns changed by the mutations are gathered, matching the difference of the full magnet arrays
+            differences = generate_per_magnet_array_differences(parent.genome, self.magnets, mutation_list,
+                                                                parent_per_magnet_array, slots)
+            for beam, beam_array in parent_per_magnet_array.items():
+                columns, difference = differences[beam]
+                full_difference = beam_array - child_per_magnet_array[beam]
+                assert np.array_equal(columns, np.flatnonzero(np.sum(np.abs(full_difference), axis=0) > 0))
+                assert np.array_equal(difference, full_difference[:, columns])
+
+            # Both give the same bfield updates, which match recomputing the child bfield in full
+            per_beam_bfield_updates = compare_magnet_differences(differences, self.lookup)
+            exp_per_beam_bfield_updates = compare_magnet_arrays(parent_per_magnet_array, child_per_magnet_array, self.lookup)
+            for beam, bfield_update in per_beam_bfield_updates.items():
+                assert np.array_equal(bfield_update, exp_per_beam_bfield_updates[beam])
+
+            bfield = generate_bfield(self.info, maglist, self.magnets, self.lookup)
+            child_bfield = parent.bfield - sum(per_beam_bfield_updates.values())
+            assert np.allclose(child_bfield, bfield, rtol=0, atol=(1e-12 * np.max(np.abs(bfield))))
@@ -0,0 +1,188 @@
+import unittest, os, shutil
+from collections import namedtuple
+
+import h5py
+import numpy as np
+
+from ..src.lookup_generator import process as lookup_process
+from ..src.lookup_converter import process
+from ..src.field_generator import read_lookup, BandedLookup
+
+
+class LookupConverterTest(unittest.TestCase):
+
+    def test_process(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_converter_test/test_process'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_dense_h5_path  = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_banded_h5_path = os.path.join(obs_path, 'test_cpmu_banded.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            # Generate the dense lookup to be converted
+            options = {
+                'verbose' : 4,
+            }
+            options_named = namedtuple("options", options.keys())(*options.values())
+            lookup_process(options_named, [inp_json_path, obs_dense_h5_path])
+
+            # Prepare parameters for process function
+            options = {
+                'verbose'   : 4,
+                'format'    : 'banded',
+                'tolerance' : 1e-3,
+            }
+            options_named = namedtuple("options", options.keys())(*options.values())
+            args = [
+                obs_dense_h5_path,
+                obs_banded_h5_path
+            ]
+
+            # Execute the function under test
+            process(options_named, args)
+
+            # Contracting the banded lookup must match the dense one to within the reported error bound
+            rng = np.random.default_rng(0)
+            with h5py.File(obs_dense_h5_path, 'r') as dense_h5_file, \
+                 h5py.File(obs_banded_h5_path, 'r') as banded_h5_file:
+
+                assert sorted(list(dense_h5_file.keys())) == sorted(list(banded_h5_file.keys()))
+
+                for beam in dense_h5_file.keys():
+
+                    dense  = dense_h5_file.get(beam)[()]
+                    banded = read_lookup(banded_h5_file.get(beam))
+
+                    assert banded.shape == dense.shape
+                    assert banded.data.size < dense.size
+
+                    magnets = rng.uniform(-1, 1, (3, dense.shape[5]))
+                    exp_bfield = np.sum(np.sum((dense * magnets), axis=4), axis=4)
+                    obs_bfield = banded.contract(magnets)
+
+                    assert np.max(np.abs(exp_bfield - obs_bfield)) <= banded.truncation_bound
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_banded_zero_column(self):
+
+        # Lookup (x, z, s, 3, 3, n) with a narrow window per column and one column that contributes nothing
+        rng = np.random.default_rng(0)
+        dense = np.zeros((2, 3, 40, 3, 3, 6))
+        for m in range(dense.shape[5]):
+            dense[:, :, (5 * m):((5 * m) + 4), ..., m] = rng.uniform(-1, 1, (2, 3, 4, 3, 3))
+        dense[..., 2] = 0
+
+        banded = BandedLookup.from_dense(dense, 1e-3)
+
+        # The zero column is stored with an empty window instead of widening every other column to the full S axis
+        assert banded.widths[2] == 0
+        assert banded.data.size == ((dense.size // dense.shape[5]) * 4 * (dense.shape[5] - 1)) // dense.shape[2]
+        assert banded.data.size < dense.size
+
+        magnets = rng.uniform(-1, 1, (3, dense.shape[5]))
+        exp_bfield = np.sum(np.sum((dense * magnets), axis=4), axis=4)
+
+        assert np.allclose(banded.contract(magnets), exp_bfield, rtol=1e-9, atol=0)
+        assert np.allclose(banded.contract_columns(np.array([1, 2]), magnets[:, [1, 2]]),
+                           np.sum(np.sum((dense[..., [1, 2]] * magnets[:, [1, 2]]), axis=4), axis=4), rtol=1e-9, atol=0)
+        assert np.allclose(banded.project(1, 2, 3), dense[1:2, 2:3, ::3], rtol=1e-9, atol=0)
+        assert banded.transverse().shape == (*dense.shape[:3], 2, *dense.shape[4:])
+
+    def test_process_low_rank(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_converter_test/test_process_low_rank'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_dense_h5_path    = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_low_rank_h5_path = os.path.join(obs_path, 'test_cpmu_low_rank.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            # Generate the dense lookup to be converted
+            options = {
+                'verbose' : 4,
+            }
+            options_named = namedtuple("options", options.keys())(*options.values())
+            lookup_process(options_named, [inp_json_path, obs_dense_h5_path])
+
+            # Prepare parameters for process function
+            options = {
+                'verbose'   : 4,
+                'format'    : 'low-rank',
+                'tolerance' : 1e-2,
+            }
+            options_named = namedtuple("options", options.keys())(*options.values())
+            args = [
+                obs_dense_h5_path,
+                obs_low_rank_h5_path
+            ]
+
+            # Execute the function under test
+            process(options_named, args)
+
+            # Contracting the low rank lookup must match the dense one to within the reported error bound
+            rng = np.random.default_rng(0)
+            with h5py.File(obs_dense_h5_path, 'r') as dense_h5_file, \
+                 h5py.File(obs_low_rank_h5_path, 'r') as low_rank_h5_file:
+
+                assert sorted(list(dense_h5_file.keys())) == sorted(list(low_rank_h5_file.keys()))
+
+                for beam in dense_h5_file.keys():
+
+                    dense    = dense_h5_file.get(beam)[()]
+                    low_rank = read_lookup(low_rank_h5_file.get(beam))
+
+                    assert low_rank.shape == dense.shape
+                    assert low_rank.rank < (3 * dense.shape[5])
+
+                    magnets = rng.uniform(-1, 1, (3, dense.shape[5]))
+                    exp_bfield = np.sum(np.sum((dense * magnets), axis=4), axis=4)
+                    obs_bfield = low_rank.contract(magnets)
+
+                    assert np.max(np.abs(exp_bfield - obs_bfield)) <= low_rank.approximation_bound
+
+                    # Delta evaluation of a few columns must agree with the full contraction
+                    columns = np.array([0, (dense.shape[5] // 2), (dense.shape[5] - 1)])
+                    exp_bfield = np.sum(np.sum((dense[..., columns] * magnets[:, columns]), axis=4), axis=4)
+                    obs_bfield = low_rank.contract_columns(columns, magnets[:, columns])
+
+                    assert np.max(np.abs(exp_bfield - obs_bfield)) <= low_rank.approximation_bound
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
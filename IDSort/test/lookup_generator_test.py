@@ -1,12 +1,18 @@
-import unittest, os, shutil
+import unittest, os, sys, shutil, filecmp
+from unittest import mock
 from collections import namedtuple
 
 import subprocess
+import json
 
 import h5py
 import numpy as np
+import pandas as pd
 
-from ..src.lookup_generator import process
+from ..src import lookup_generator
+from ..src.lookup_generator import process, generate_bfield, generate_bfield_fused, generate_bfield_eval_points, load_lazy_lookup
+from ..src.field_generator import load_lookup, load_integral_block_ends, calculate_trajectories, calculate_trajectory_loss, \
+                                  integrals_to_trajectories, IntegralSurrogate
 
 
 class LookupGeneratorTest(unittest.TestCase):
@@ -255,3 +261,1055 @@ class LookupGeneratorTest(unittest.TestCase):
         # Remove the extracted expected file so it is not captured by version control
         os.remove(exp_h5_path)
         assert not os.path.exists(exp_h5_path)
+
+    def test_process_workers(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_workers'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_shim_csv_path            = os.path.join(obs_path, 'test_cpmu_shim.csv')
+        obs_serial_h5_path           = os.path.join(obs_path, 'test_cpmu_serial.h5')
+        obs_serial_output_csv_path   = os.path.join(obs_path, 'test_cpmu_serial.csv')
+        obs_parallel_h5_path         = os.path.join(obs_path, 'test_cpmu_parallel.h5')
+        obs_parallel_output_csv_path = os.path.join(obs_path, 'test_cpmu_parallel.csv')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Write per slot shim offsets for every magnet in the device
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        rng_state = np.random.RandomState(seed=0)
+        pd.DataFrame([{ 'beam' : beam['name'], 'slot' : slot,
+                        'x' : rng_state.uniform(-0.1, 0.1), 'z' : rng_state.uniform(-0.1, 0.1), 's' : rng_state.uniform(-0.1, 0.1) }
+                      for beam in data['beams'] for slot in range(len(beam['mags']))]).to_csv(obs_shim_csv_path, index=False)
+
+        try:
+
+            for workers, obs_h5_path, obs_output_csv_path in [(1, obs_serial_h5_path,   obs_serial_output_csv_path),
+                                                              (2, obs_parallel_h5_path, obs_parallel_output_csv_path)]:
+
+                # Prepare parameters for process function, small memory budget so each beam is split into many chunks
+                options = {
+                    'verbose'         : 4,
+                    'workers'         : workers,
+                    'memory_budget'   : 1,
+                    'shim_csv'        : obs_shim_csv_path,
+                    'output_shim_csv' : obs_output_csv_path,
+                    'seed'            : 30,
+                    'rsx'             : 0.05,
+                    'rsz'             : 0.05,
+                    'rss'             : 0.05,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    obs_h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the parallel output file to the serial one, they should be exactly equal
+            with h5py.File(obs_serial_h5_path, 'r') as serial_h5_file, \
+                 h5py.File(obs_parallel_h5_path, 'r') as parallel_h5_file:
+
+                assert sorted(list(serial_h5_file.keys())) == sorted(list(parallel_h5_file.keys()))
+
+                for dataset in serial_h5_file.keys():
+
+                    serial_data   = serial_h5_file.get(dataset)[()]
+                    parallel_data = parallel_h5_file.get(dataset)[()]
+                    assert np.array_equal(serial_data, parallel_data)
+
+            # Compare the per slot offsets that were applied
+            with open(obs_serial_output_csv_path, 'r') as serial_csv_file, \
+                 open(obs_parallel_output_csv_path, 'r') as parallel_csv_file:
+
+                assert serial_csv_file.read() == parallel_csv_file.read()
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_mpi(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_mpi'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_serial_h5_path         = os.path.join(obs_path, 'test_cpmu_serial.h5')
+        obs_serial_output_csv_path = os.path.join(obs_path, 'test_cpmu_serial.csv')
+        obs_mpi_h5_path            = os.path.join(obs_path, 'test_cpmu_mpi.h5')
+        obs_mpi_output_csv_path    = os.path.join(obs_path, 'test_cpmu_mpi.csv')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            for mpi, obs_h5_path, obs_output_csv_path in [(False, obs_serial_h5_path, obs_serial_output_csv_path),
+                                                          (True,  obs_mpi_h5_path,    obs_mpi_output_csv_path)]:
+
+                # Prepare parameters for process function, small memory budget so each beam is split into many blocks
+                options = {
+                    'verbose'         : 4,
+                    'mpi'             : mpi,
+                    'memory_budget'   : 0.05,
+                    'output_shim_csv' : obs_output_csv_path,
+                    'seed'            : 30,
+                    'rsx'             : 0.05,
+                    'rsz'             : 0.05,
+                    'rss'             : 0.05,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    obs_h5_path
+                ]
+
+                # Execute the function under test, as many ranks as the test is launched with
+                process(options_named, args)
+
+            # Compare the MPI output file to the serial one, they should be exactly equal
+            with h5py.File(obs_serial_h5_path, 'r') as serial_h5_file, \
+                 h5py.File(obs_mpi_h5_path, 'r') as mpi_h5_file:
+
+                assert sorted(list(serial_h5_file.keys())) == sorted(list(mpi_h5_file.keys()))
+
+                for dataset in serial_h5_file.keys():
+
+                    serial_data = serial_h5_file.get(dataset)[()]
+                    mpi_data    = mpi_h5_file.get(dataset)[()]
+                    assert np.array_equal(serial_data, mpi_data)
+                    assert np.array_equal(serial_h5_file.get(dataset).attrs['offsets'], mpi_h5_file.get(dataset).attrs['offsets'])
+
+            # Compare the per slot offsets that were applied
+            with open(obs_serial_output_csv_path, 'r') as serial_csv_file, \
+                 open(obs_mpi_output_csv_path, 'r') as mpi_csv_file:
+
+                assert serial_csv_file.read() == mpi_csv_file.read()
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    @unittest.skipIf(shutil.which('mpirun') is None, 'mpirun is not installed')
+    def test_process_mpi_ranks(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_mpi_ranks'
+        inp_path  = 'IDSort/test/data/lookup_generator_test/test_process_mpi/inputs'
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_serial_h5_path         = os.path.join(obs_path, 'test_cpmu_serial.h5')
+        obs_serial_output_csv_path = os.path.join(obs_path, 'test_cpmu_serial.csv')
+        obs_mpi_h5_path            = os.path.join(obs_path, 'test_cpmu_mpi.h5')
+        obs_mpi_output_csv_path    = os.path.join(obs_path, 'test_cpmu_mpi.csv')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Small memory budget so each beam is split into many blocks, more blocks than ranks
+        options = ['--memory-budget', '0.05', '--rand-seed', '30',
+                   '--rand-scale-x', '0.05', '--rand-scale-z', '0.05', '--rand-scale-s', '0.05']
+
+        # Allow running as root and with more ranks than cores inside test containers
+        env = dict(os.environ, OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+                   OMPI_MCA_rmaps_base_oversubscribe='1')
+
+        try:
+
+            # Execute the function under test on a single process and partitioned across three ranks
+            command = [sys.executable, '-m', 'IDSort.src.lookup_generator'] + options
+            result  = subprocess.run(command + ['--output-shim-csv', obs_serial_output_csv_path,
+                                                inp_json_path, obs_serial_h5_path],
+                                     env=env, timeout=300, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            assert result.returncode == 0, result.stdout.decode()
+
+            result = subprocess.run(['mpirun', '-np', '3'] + command + ['--mpi', '--output-shim-csv', obs_mpi_output_csv_path,
+                                                                        inp_json_path, obs_mpi_h5_path],
+                                    env=env, timeout=300, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            assert result.returncode == 0, result.stdout.decode()
+
+            # The lookup and the per slot offsets written by the ranks should be byte for byte the same as the serial ones
+            assert os.path.exists(obs_mpi_h5_path), result.stdout.decode()
+            assert filecmp.cmp(obs_serial_h5_path, obs_mpi_h5_path, shallow=False)
+            assert filecmp.cmp(obs_serial_output_csv_path, obs_mpi_output_csv_path, shallow=False)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_layouts(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_layouts'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_point_major_h5_path  = os.path.join(obs_path, 'test_cpmu_point_major.h5')
+        obs_magnet_major_h5_path = os.path.join(obs_path, 'test_cpmu_magnet_major.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            for layout, obs_h5_path in [('point-major',  obs_point_major_h5_path),
+                                        ('magnet-major', obs_magnet_major_h5_path)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'verbose' : 4,
+                    'layout'  : layout,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    obs_h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the magnet-major output file to the point-major one, they should hold exactly the same values
+            with h5py.File(obs_point_major_h5_path, 'r') as point_major_h5_file, \
+                 h5py.File(obs_magnet_major_h5_path, 'r') as magnet_major_h5_file:
+
+                assert sorted(list(point_major_h5_file.keys())) == sorted(list(magnet_major_h5_file.keys()))
+
+                for dataset in point_major_h5_file.keys():
+
+                    point_major_data  = point_major_h5_file.get(dataset)[()]
+                    magnet_major_data = magnet_major_h5_file.get(dataset)[()]
+                    assert np.array_equal(point_major_data, np.transpose(magnet_major_data, (2, 3, 4, 5, 1, 0)))
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_tiles(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_tiles'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_h5_path       = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_tiled_h5_path = os.path.join(obs_path, 'test_cpmu_tiled.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            # A small memory budget splits the S axis into many tiles as not even a single magnet fits
+            for memory_budget, h5_path in [(8, obs_h5_path), (0.05, obs_tiled_h5_path)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'verbose'       : 4,
+                    'memory_budget' : memory_budget,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the tiled output file to the one calculated over the whole S axis at once
+            with h5py.File(obs_h5_path, 'r') as obs_h5_file, \
+                 h5py.File(obs_tiled_h5_path, 'r') as tiled_h5_file:
+
+                assert sorted(list(obs_h5_file.keys())) == sorted(list(tiled_h5_file.keys()))
+
+                for dataset in obs_h5_file.keys():
+
+                    obs_data   = obs_h5_file.get(dataset)[()]
+                    tiled_data = tiled_h5_file.get(dataset)[()]
+                    assert np.allclose(obs_data, tiled_data)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_resume(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_resume'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_h5_path         = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_resumed_h5_path = os.path.join(obs_path, 'test_cpmu_resumed.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Interrupt the build part of the way through as if it hit a walltime limit
+        generate_beam_bfield_chunk_task = lookup_generator.generate_beam_bfield_chunk_task
+        num_tasks = [0]
+
+        def interrupted_task(task):
+            num_tasks[0] += 1
+            if num_tasks[0] > 100:
+                raise RuntimeError('Interrupted')
+            return generate_beam_bfield_chunk_task(task)
+
+        try:
+
+            for resume, h5_path, task in [(False, obs_h5_path,         generate_beam_bfield_chunk_task),
+                                          (True,  obs_resumed_h5_path, interrupted_task),
+                                          (True,  obs_resumed_h5_path, generate_beam_bfield_chunk_task)]:
+
+                # Prepare parameters for process function, small memory budget so each magnet is split into S tiles
+                options = {
+                    'verbose'       : 4,
+                    'resume'        : resume,
+                    'memory_budget' : 0.05,
+                    'seed'          : 30,
+                    'rsx'           : 0.05,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    h5_path
+                ]
+
+                # Execute the function under test
+                with mock.patch.object(lookup_generator, 'generate_beam_bfield_chunk_task', task):
+                    try:
+                        process(options_named, args)
+                    except RuntimeError:
+                        with h5py.File(h5_path, 'r') as resumed_h5_file:
+                            assert np.count_nonzero([progress[()] for progress in resumed_h5_file['progress'].values()]) == 100
+
+            # Compare the resumed output file to the one generated in a single run, they should be exactly equal
+            with h5py.File(obs_h5_path, 'r') as obs_h5_file, \
+                 h5py.File(obs_resumed_h5_path, 'r') as resumed_h5_file:
+
+                assert sorted(list(obs_h5_file.keys())) == sorted(list(resumed_h5_file.keys()))
+
+                for dataset in obs_h5_file.keys():
+
+                    obs_data     = obs_h5_file.get(dataset)[()]
+                    resumed_data = resumed_h5_file.get(dataset)[()]
+                    assert np.array_equal(obs_data, resumed_data)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_gap_scan(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_gap_scan'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_scan_h5_path = os.path.join(obs_path, 'test_cpmu_scan.h5')
+        obs_gap_json_path = os.path.join(obs_path, 'test_cpmu_gap.json')
+        obs_gap_h5_path   = os.path.join(obs_path, 'test_cpmu_gap.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Gaps 5.1, 5.3, and 5.5 move the beams by whole Z steps and share an evaluation, gap 5.4 is evaluated on its own
+        gaps = [5.1, 5.3, 5.4, 5.5]
+
+        # Move the beams of the device to each gap the same way id_setup places them
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        try:
+
+            # Prepare parameters for process function
+            options = {
+                'verbose' : 4,
+                'gaps'    : ','.join(map(str, gaps)),
+                'seed'    : 30,
+                'rsx'     : 0.05,
+                'rsz'     : 0.05,
+            }
+            options_named = namedtuple("options", options.keys())(*options.values())
+            args = [
+                inp_json_path,
+                obs_scan_h5_path
+            ]
+
+            # Execute the function under test
+            process(options_named, args)
+
+            with h5py.File(obs_scan_h5_path, 'r') as scan_h5_file:
+                assert np.allclose(scan_h5_file.attrs['gaps'], gaps)
+
+            for g, gap in enumerate(gaps):
+
+                gap_data = json.loads(json.dumps(data))
+                gap_data['gap'] = gap
+                for beam in gap_data['beams']:
+                    for mag in beam['mags']:
+                        mag['position'][1] += np.sign(mag['position'][1]) * ((gap - data['gap']) / 2)
+
+                with open(obs_gap_json_path, 'w') as fp:
+                    json.dump(gap_data, fp)
+
+                # Generate the lookup at this gap on its own with the same random offsets
+                options = {
+                    'verbose' : 4,
+                    'seed'    : 30,
+                    'rsx'     : 0.05,
+                    'rsz'     : 0.05,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                process(options_named, [obs_gap_json_path, obs_gap_h5_path])
+
+                # Compare the lookup of this gap in the scan to the one generated on its own
+                with h5py.File(obs_gap_h5_path, 'r') as gap_h5_file, \
+                     h5py.File(obs_scan_h5_path, 'r') as scan_h5_file:
+
+                    assert sorted(list(gap_h5_file.keys())) == sorted(list(scan_h5_file[f'gap-{g}'].keys()))
+
+                    for dataset in gap_h5_file.keys():
+
+                        gap_data_set  = gap_h5_file.get(dataset)
+                        scan_data_set = scan_h5_file[f'gap-{g}'].get(dataset)
+                        assert np.allclose(gap_data_set[()], scan_data_set[()], rtol=0, atol=1e-12)
+                        assert np.array_equal(gap_data_set.attrs['offsets'], scan_data_set.attrs['offsets'])
+
+            # Scanned gaps are selected exactly and gaps between them are interpolated
+            lookup_5_1 = load_lookup(obs_scan_h5_path, data, gap=5.1)
+            lookup_5_3 = load_lookup(obs_scan_h5_path, data, gap=5.3)
+            lookup_5_2 = load_lookup(obs_scan_h5_path, data, gap=5.2)
+
+            for beam in data['beams']:
+                assert np.allclose(lookup_5_2[beam['name']], (lookup_5_1[beam['name']] + lookup_5_3[beam['name']]) / 2)
+
+            for gap in [None, 5.0, 5.6]:
+                with self.assertRaises(Exception):
+                    load_lookup(obs_scan_h5_path, data, gap=gap)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_integrals(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_integrals'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_h5_path           = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_integrals_h5_path = os.path.join(obs_path, 'test_cpmu_integrals.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Prepare parameters for process function, small memory budget so the integrals are summed in many chunks
+        options = {
+            'verbose'            : 4,
+            'memory_budget'      : 1,
+            'integrals_filename' : obs_integrals_h5_path,
+            'integral_blocks'    : 8,
+        }
+        options_named = namedtuple("options", options.keys())(*options.values())
+        args = [
+            inp_json_path,
+            obs_h5_path
+        ]
+
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        try:
+
+            # Execute the function under test
+            process(options_named, args)
+
+            lookup          = load_lookup(obs_h5_path, data)
+            integral_lookup = load_lookup(obs_integrals_h5_path, data)
+
+            # Trajectories at the block ends from the field integrals of random magnet values should match the full ones
+            rng_state = np.random.RandomState(seed=0)
+            bfield    = 0
+            integrals = 0
+            for beam in data['beams']:
+                beam_array = rng_state.uniform(-1, 1, size=(3, len(beam['mags'])))
+                bfield    += np.sum(np.sum(lookup[beam['name']] * beam_array, axis=-1), axis=-1)
+                integrals += np.sum(np.sum(integral_lookup[beam['name']] * beam_array, axis=-1), axis=-1)
+
+            block_ends = load_integral_block_ends(obs_integrals_h5_path, data)
+
+            assert len(block_ends) == 8
+            assert block_ends[-1] == (bfield.shape[2] - 1)
+
+            trajectories = calculate_trajectories(data, bfield)
+            assert np.allclose(integrals_to_trajectories(integrals), trajectories[:, :, block_ends],
+                               rtol=0, atol=(1e-12 * np.max(np.abs(trajectories))))
+
+            # The surrogate sums a bfield up to the same block ends the field integrals were stored at
+            surrogate = IntegralSurrogate(data, integral_lookup, block_ends, bfield)
+            assert np.allclose(surrogate.project_bfield(bfield), integrals, rtol=0, atol=(1e-12 * np.max(np.abs(integrals))))
+            assert calculate_trajectory_loss(integrals_to_trajectories(integrals), surrogate.ref_trajectories) < 1e-20
+
+            # Field integrals summed over a different S axis or up to different block ends are rejected
+            with self.assertRaises(Exception):
+                IntegralSurrogate(data, integral_lookup, block_ends, bfield[:, :, :-1])
+
+            with self.assertRaises(Exception):
+                IntegralSurrogate(data, integral_lookup, block_ends[1:], bfield)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_convolution(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_convolution'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_h5_path = os.path.join(obs_path, 'test_cpmu.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Prepare parameters for process function
+        options = {
+            'verbose' : 4,
+        }
+        options_named = namedtuple("options", options.keys())(*options.values())
+        args = [
+            inp_json_path,
+            obs_h5_path
+        ]
+
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        try:
+
+            # Execute the function under test
+            process(options_named, args)
+
+            lookup             = load_lookup(obs_h5_path, data, transverse=True)
+            convolution_lookup = load_lookup(obs_h5_path, data, transverse=True, convolution=True)
+
+            # Bfields of random magnet values evaluated by convolution should match the dense lookup
+            rng_state = np.random.RandomState(seed=0)
+            for beam in data['beams']:
+                dense       = lookup[beam['name']]
+                convolution = convolution_lookup[beam['name']]
+
+                # Only the ends of the device should be left as explicit columns
+                assert len(convolution.kernels) > 0
+                assert len(convolution.explicit_magnets) < (len(beam['mags']) // 10)
+
+                beam_array = rng_state.uniform(-1, 1, size=(3, len(beam['mags'])))
+                exp_bfield = np.sum(np.sum(dense * beam_array, axis=-1), axis=-1)
+                assert np.allclose(convolution.contract(beam_array), exp_bfield, rtol=0, atol=(1e-9 * np.max(np.abs(exp_bfield))))
+
+                columns    = np.array([0, (len(beam['mags']) // 2), (len(beam['mags']) - 1)])
+                exp_bfield = np.sum(np.sum(dense[..., columns] * beam_array[:, columns], axis=-1), axis=-1)
+                assert np.allclose(convolution.contract_columns(columns, beam_array[:, columns]), exp_bfield,
+                                   rtol=0, atol=(1e-9 * np.max(np.abs(exp_bfield))))
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_lazy(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_lazy'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_h5_path       = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_cache_h5_path = os.path.join(obs_path, 'test_cpmu_lazy.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Prepare parameters for process function
+        options = {
+            'verbose' : 4,
+        }
+        options_named = namedtuple("options", options.keys())(*options.values())
+        args = [
+            inp_json_path,
+            obs_h5_path
+        ]
+
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        try:
+
+            # Generate the full lookup to compare the lazy lookup of the central eval line against
+            process(options_named, args)
+            lookup = load_lookup(obs_h5_path, data)
+
+            rng_state = np.random.RandomState(seed=0)
+            lazy_lookup = load_lazy_lookup(obs_cache_h5_path, data, central_line=True)
+            for beam in data['beams']:
+                dense = lookup[beam['name']]
+                i, j  = (((dense.shape[0] + 1) // 2) - 1), (((dense.shape[1] + 1) // 2) - 1)
+                dense = dense[i:(i + 1), j:(j + 1)]
+
+                beam_array = rng_state.uniform(-1, 1, size=(3, len(beam['mags'])))
+
+                # Delta evaluations only calculate the columns they touch
+                columns    = np.array([0, (len(beam['mags']) // 2), (len(beam['mags']) - 1)])
+                exp_bfield = np.sum(np.sum(dense[..., columns] * beam_array[:, columns], axis=-1), axis=-1)
+                assert np.allclose(lazy_lookup[beam['name']].contract_columns(columns, beam_array[:, columns]), exp_bfield,
+                                   rtol=0, atol=(1e-12 * np.max(np.abs(exp_bfield))))
+                assert np.count_nonzero(lazy_lookup[beam['name']].calculated) == len(columns)
+
+                exp_bfield = np.sum(np.sum(dense * beam_array, axis=-1), axis=-1)
+                assert np.allclose(lazy_lookup[beam['name']].contract(beam_array), exp_bfield,
+                                   rtol=0, atol=(1e-12 * np.max(np.abs(exp_bfield))))
+
+            # A later run reads every column from the cache without calculating any of them
+            with mock.patch.object(lookup_generator, 'generate_beam_bfield_chunk', side_effect=AssertionError):
+                cached_lookup = load_lazy_lookup(obs_cache_h5_path, data, central_line=True, transverse=True)
+                for beam in data['beams']:
+                    assert np.all(cached_lookup[beam['name']].calculated)
+
+                    beam_array = rng_state.uniform(-1, 1, size=(3, len(beam['mags'])))
+                    exp_bfield = lazy_lookup[beam['name']].contract(beam_array)[..., :2]
+                    assert np.allclose(cached_lookup[beam['name']].contract(beam_array), exp_bfield,
+                                       rtol=0, atol=(1e-12 * np.max(np.abs(exp_bfield))))
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_update(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_update'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_shim_csv_path         = os.path.join(obs_path, 'test_cpmu_shim.csv')
+        obs_changed_shim_csv_path = os.path.join(obs_path, 'test_cpmu_changed_shim.csv')
+        obs_updated_h5_path       = os.path.join(obs_path, 'test_cpmu_updated.h5')
+        obs_full_h5_path          = os.path.join(obs_path, 'test_cpmu_full.h5')
+        obs_changed_json_path     = os.path.join(obs_path, 'test_cpmu_changed.json')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Write per slot shim offsets for every magnet in the device, then move a few of the slots
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        rng_state = np.random.RandomState(seed=0)
+        df_shim = pd.DataFrame([{ 'beam' : beam['name'], 'slot' : slot,
+                                  'x' : rng_state.uniform(-0.1, 0.1), 'z' : rng_state.uniform(-0.1, 0.1), 's' : rng_state.uniform(-0.1, 0.1) }
+                                for beam in data['beams'] for slot in range(len(beam['mags']))])
+        df_shim.to_csv(obs_shim_csv_path, index=False)
+
+        df_shim.loc[[3, 4, 100, 300], 'z'] += 0.05
+        df_shim.to_csv(obs_changed_shim_csv_path, index=False)
+
+        try:
+
+            for shim_csv_path, obs_h5_path, update in [(obs_shim_csv_path,         obs_updated_h5_path, False),
+                                                       (obs_changed_shim_csv_path, obs_updated_h5_path, True),
+                                                       (obs_changed_shim_csv_path, obs_full_h5_path,    False)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'verbose'  : 4,
+                    'update'   : update,
+                    'shim_csv' : shim_csv_path,
+                    'seed'     : 30,
+                    'rsx'      : 0.05,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    obs_h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the updated output file to the one generated in full, they should be exactly equal
+            with h5py.File(obs_updated_h5_path, 'r') as updated_h5_file, \
+                 h5py.File(obs_full_h5_path, 'r') as full_h5_file:
+
+                assert sorted(list(updated_h5_file.keys())) == sorted(list(full_h5_file.keys()))
+
+                for dataset in updated_h5_file.keys():
+
+                    updated_data = updated_h5_file.get(dataset)[()]
+                    full_data    = full_h5_file.get(dataset)[()]
+                    assert np.array_equal(updated_data, full_data)
+                    assert np.array_equal(updated_h5_file.get(dataset).attrs['offsets'],
+                                          full_h5_file.get(dataset).attrs['offsets'])
+
+            # Updating a lookup for a device with a different configuration only recalculates some of the magnets,
+            # which would leave the rest of the lookup stale, so it is rejected
+            data['beams'][0]['mags'][0]['dimensions'][0] += 1.0
+            with open(obs_changed_json_path, 'w') as fp:
+                json.dump(data, fp)
+
+            options = {
+                'verbose'  : 4,
+                'update'   : True,
+                'shim_csv' : obs_changed_shim_csv_path,
+                'seed'     : 30,
+                'rsx'      : 0.05,
+            }
+            options_named = namedtuple("options", options.keys())(*options.values())
+
+            with self.assertRaises(Exception) as context:
+                process(options_named, [obs_changed_json_path, obs_updated_h5_path])
+
+            assert 'different configuration' in str(context.exception)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_shim_csv_duplicates(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_shim_csv_duplicates'
+        inp_path  = 'IDSort/test/data/lookup_generator_test/test_process_update/inputs'
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_shim_csv_path            = os.path.join(obs_path, 'test_cpmu_shim.csv')
+        obs_duplicate_shim_csv_path  = os.path.join(obs_path, 'test_cpmu_duplicate_shim.csv')
+        obs_h5_path                  = os.path.join(obs_path, 'test_cpmu.h5')
+        obs_duplicate_h5_path        = os.path.join(obs_path, 'test_cpmu_duplicate.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Write per slot shim offsets for every magnet in the device, then list a few of the slots again with other offsets
+        with open(inp_json_path, 'r') as fp:
+            data = json.load(fp)
+
+        rng_state = np.random.RandomState(seed=0)
+        df_shim = pd.DataFrame([{ 'beam' : beam['name'], 'slot' : slot,
+                                  'x' : rng_state.uniform(-0.1, 0.1), 'z' : rng_state.uniform(-0.1, 0.1), 's' : rng_state.uniform(-0.1, 0.1) }
+                                for beam in data['beams'] for slot in range(len(beam['mags']))])
+        df_shim.to_csv(obs_shim_csv_path, index=False)
+
+        df_duplicate = df_shim.loc[[3, 4, 100, 300]].copy()
+        df_duplicate['z'] += 0.05
+        pd.concat([df_shim, df_duplicate]).to_csv(obs_duplicate_shim_csv_path, index=False)
+
+        try:
+
+            for shim_csv_path, h5_path in [(obs_shim_csv_path, obs_h5_path), (obs_duplicate_shim_csv_path, obs_duplicate_h5_path)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'verbose'  : 4,
+                    'shim_csv' : shim_csv_path,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Slots listed more than once use the offsets of their first row
+            with h5py.File(obs_h5_path, 'r') as obs_h5_file, \
+                 h5py.File(obs_duplicate_h5_path, 'r') as duplicate_h5_file:
+
+                assert sorted(list(obs_h5_file.keys())) == sorted(list(duplicate_h5_file.keys()))
+
+                for dataset in obs_h5_file.keys():
+                    assert np.array_equal(obs_h5_file.get(dataset)[()], duplicate_h5_file.get(dataset)[()])
+                    assert np.array_equal(obs_h5_file.get(dataset).attrs['offsets'],
+                                          duplicate_h5_file.get(dataset).attrs['offsets'])
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_templates(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_templates'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_exact_h5_path    = os.path.join(obs_path, 'test_cpmu_exact.h5')
+        obs_template_h5_path = os.path.join(obs_path, 'test_cpmu_template.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            for templates, obs_h5_path in [(False, obs_exact_h5_path), (True, obs_template_h5_path)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'verbose'   : 4,
+                    'templates' : templates,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    obs_h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the output file filled from templates to the exactly evaluated one
+            with h5py.File(obs_exact_h5_path, 'r') as exact_h5_file, \
+                 h5py.File(obs_template_h5_path, 'r') as template_h5_file:
+
+                assert sorted(list(exact_h5_file.keys())) == sorted(list(template_h5_file.keys()))
+
+                for dataset in exact_h5_file.keys():
+
+                    exact_data    = exact_h5_file.get(dataset)[()]
+                    template_data = template_h5_file.get(dataset)[()]
+                    assert np.allclose(exact_data, template_data)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_mirror_beams(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/lookup_generator_test/test_process_mirror_beams'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path = os.path.join(inp_path, 'test_cpmu.json')
+
+        # Prepare observed output file paths
+        obs_exact_h5_path    = os.path.join(obs_path, 'test_cpmu_exact.h5')
+        obs_mirror_h5_path   = os.path.join(obs_path, 'test_cpmu_mirror.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        try:
+
+            for mirror_beams, obs_h5_path in [(False, obs_exact_h5_path), (True, obs_mirror_h5_path)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'verbose'   : 4,
+                    'mirror_beams' : mirror_beams,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_json_path,
+                    obs_h5_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the output file with mirrored beams to the exactly evaluated one
+            with h5py.File(obs_exact_h5_path, 'r') as exact_h5_file, \
+                 h5py.File(obs_mirror_h5_path, 'r') as mirror_h5_file:
+
+                assert sorted(list(exact_h5_file.keys())) == sorted(list(mirror_h5_file.keys()))
+
+                for dataset in exact_h5_file.keys():
+
+                    exact_data    = exact_h5_file.get(dataset)[()]
+                    mirror_data = mirror_h5_file.get(dataset)[()]
+                    assert np.allclose(exact_data, mirror_data)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_generate_bfield_fused(self):
+
+        # Eval points and magnets spread around them with the same spacing as the test devices
+        bfield_eval_points = np.mgrid[-2.0:2.1:2.5, 0.0:0.1:0.1, -100.0:100.0:4.4]
+        rng_state  = np.random.RandomState(seed=0)
+        positions  = np.stack([rng_state.uniform(-60, 10, 8), rng_state.uniform(-40, 10, 8), rng_state.uniform(-100, 100, 8)], axis=-1)
+        dimensions = np.tile([50.0, 30.0, 5.76], (8, 1))
+
+        # Compare the fused kernel to the reference one for a single magnet and for a batch of magnets
+        assert np.allclose(generate_bfield(bfield_eval_points, dimensions[0], positions[0]),
+                           generate_bfield_fused(bfield_eval_points, dimensions[0], positions[0]), rtol=0, atol=1e-12)
+
+        assert np.allclose(generate_bfield(bfield_eval_points, dimensions, positions),
+                           generate_bfield_fused(bfield_eval_points, dimensions, positions), rtol=0, atol=1e-12)
+
+    def test_generate_bfield_batch(self):
+
+        with open('IDSort/test/data/lookup_generator_test/test_process_hybrid_symmetric/inputs/test_cpmu.json', 'r') as fp:
+            data = json.load(fp)
+
+        bfield_eval_points = generate_bfield_eval_points(data)
+
+        # Evaluating a chunk of the device's magnets at once matches evaluating each of them on its own
+        mags       = data['beams'][0]['mags'][:16]
+        positions  = np.array([mag['position'] for mag in mags])
+        dimensions = np.array([mag['dimensions'] for mag in mags])
+
+        batch_bfield = generate_bfield(bfield_eval_points, dimensions, positions)
+        assert batch_bfield.shape == (len(mags), *bfield_eval_points.shape[1:], 3, 3)
+
+        for m in range(len(mags)):
+            assert np.array_equal(batch_bfield[m], generate_bfield(bfield_eval_points, dimensions[m], positions[m]))
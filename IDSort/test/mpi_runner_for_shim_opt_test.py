@@ -319,3 +319,113 @@ class MpiRunnerForShimOptTest(unittest.TestCase):
             # Clear any observed output files after running successful test
             shutil.rmtree(obs_path, ignore_errors=True)
             os.makedirs(obs_path)
+
+    def test_process_transverse(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/mpi_runner_for_shim_opt_test/test_process_transverse'
+        inp_path  = 'IDSort/test/data/mpi_runner_for_shim_opt_test/test_process/inputs'
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path   = os.path.join(inp_path, 'test_cpmu_shim.json')
+        inp_mag_path    = os.path.join(inp_path, 'test_cpmu.mag')
+        inp_h5_path     = os.path.join(inp_path, 'test_cpmu_shim.h5')
+        inp_genome_path = os.path.join(inp_path, '1.0_000_test_genome.genome') # Renamed from 1.12875826e-08_000_7c51ecd01f73.genome
+        inp_bfield_path = os.path.join(inp_path, '1.12875826e-08_000_7c51ecd01f73.genome.h5')
+
+        # Prepare observed output file paths for the sorts using the full and the transverse lookup
+        obs_full_path       = os.path.join(obs_path, 'full')
+        obs_transverse_path = os.path.join(obs_path, 'transverse')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_full_path)
+        os.makedirs(obs_transverse_path)
+
+        # Prepare parameters for process function
+        options = {
+            'available'           : None,
+            'iterations'          : 3,
+            'number_of_mutations' : 5,
+            'id_filename'         : inp_json_path,
+            'magnets_filename'    : inp_mag_path,
+            'lookup_filename'     : inp_h5_path,
+            'bfield_filename'     : inp_bfield_path,
+            'genome_filename'     : inp_genome_path,
+            'setup'               : 24,
+            'number_of_changes'   : 2,
+            'mutations'           : 5,
+            'c'                   : 2,
+            'e'                   : 0.0,
+            'restart'             : False,
+            'max_age'             : 10,
+            'scale'               : 10.0,
+            'singlethreaded'      : True,
+            'seed'                : True,
+            'seed_value'          : 30,
+            'full_lookup'         : True,
+            'verbose'             : 4,
+        }
+        options_named = namedtuple("options", options.keys())(*options.values())
+
+        # Genome files and analysis files of a sort ordered on the age and fitness of the genomes, as uids are random
+        # and the last digit of the fitness in the file names can differ between runs as threaded sums are not reproducible
+        def find_outputs(path):
+            genomes, h5s = [], []
+            for file_name in os.listdir(path):
+                if not file_name.endswith('.genome'): continue
+
+                fitness, age, uid = os.path.splitext(file_name)[0].split('_')
+                genomes.append((int(age), uid.startswith('A'), float(fitness), os.path.join(path, file_name)))
+
+                h5_names = [h5_name for h5_name in os.listdir(path) if h5_name.endswith(f'-{uid}.h5')]
+                if len(h5_names) > 0:
+                    h5s.append((int(age), float(fitness), os.path.join(path, h5_names[0])))
+
+            return sorted(genomes), sorted(h5s)
+
+        try:
+
+            # Execute the function under test with the full lookup and with the default transverse lookup
+            process(options_named, [obs_full_path])
+            process(options_named._replace(full_lookup=False), [obs_transverse_path])
+
+            full_genomes, full_h5s = find_outputs(obs_full_path)
+            transverse_genomes, transverse_h5s = find_outputs(obs_transverse_path)
+
+            # The transverse sort must find the same genomes with the same fitness
+            assert len(full_genomes) > 0
+            assert len(full_genomes) == len(transverse_genomes)
+
+            for (full_age, full_flag, full_fitness, full_genome_path), \
+                (transverse_age, transverse_flag, transverse_fitness, transverse_genome_path) in zip(full_genomes, transverse_genomes):
+                assert (full_age, full_flag) == (transverse_age, transverse_flag)
+                assert np.isclose(full_fitness, transverse_fitness, rtol=1e-7, atol=0)
+
+                with open(full_genome_path, 'rb') as full_genome_file, \
+                     open(transverse_genome_path, 'rb') as transverse_genome_file:
+                    assert pickle.load(full_genome_file) == pickle.load(transverse_genome_file)
+
+            # The bfields saved for analysis still hold every field component
+            assert len(full_h5s) > 0
+            assert len(full_h5s) == len(transverse_h5s)
+
+            for (full_age, full_fitness, full_h5_path), (transverse_age, transverse_fitness, transverse_h5_path) in zip(full_h5s, transverse_h5s):
+                assert full_age == transverse_age
+                assert np.isclose(full_fitness, transverse_fitness, rtol=1e-7, atol=0)
+
+                with h5py.File(full_h5_path, 'r') as full_fp, h5py.File(transverse_h5_path, 'r') as transverse_fp:
+                    assert full_fp.keys() == transverse_fp.keys()
+                    for dataset in full_fp.keys():
+                        exp_data = full_fp[dataset][...]
+                        assert np.allclose(transverse_fp[dataset][...], exp_data, rtol=0, atol=(1e-12 * np.max(np.abs(exp_data))))
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
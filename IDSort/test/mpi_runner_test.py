@@ -1,12 +1,31 @@
-import unittest, os, shutil
+import unittest, os, sys, shutil, subprocess
 from collections import namedtuple
 
+import json
 import pickle
 
-from ..src.magnets import MagLists
+from ..src.magnets import Magnets, MagLists
+from ..src.field_generator import load_lookup, calculate_cached_trajectory_loss, calculate_bfield_phase_error, \
+                                  generate_reference_magnets, generate_bfield
 from ..src.mpi_runner import process
 
 
+def run_mpi_process(num_ranks, options, args, timeout=300):
+    # Run mpi_runner::process on multiple MPI ranks in a subprocess, a deadlocked exchange fails on the timeout
+    script = ('import sys, ast\n'
+              'from collections import namedtuple\n'
+              'from IDSort.src.mpi_runner import process\n'
+              'options = ast.literal_eval(sys.argv[1])\n'
+              'process(namedtuple("options", options.keys())(*options.values()), ast.literal_eval(sys.argv[2]))\n')
+
+    # Allow running as root and with more ranks than cores inside test containers
+    env = dict(os.environ, OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+               OMPI_MCA_rmaps_base_oversubscribe='1')
+
+    return subprocess.run(['mpirun', '-np', str(num_ranks), sys.executable, '-c', script, repr(options), repr(args)],
+                          env=env, timeout=timeout, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
 class MpiRunnerTest(unittest.TestCase):
 
     def test_process(self):
@@ -209,3 +228,270 @@ class MpiRunnerTest(unittest.TestCase):
             shutil.rmtree(obs_path, ignore_errors=True)
             os.makedirs(obs_path)
 
+
+    @unittest.skipIf(shutil.which('mpirun') is None, 'mpirun is not available')
+    def test_process_mpi_coarse_strides(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/mpi_runner_test/test_process_mpi_coarse_strides'
+        inp_path  = 'IDSort/test/data/mpi_runner_test/test_process/inputs'
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path   = os.path.join(inp_path, 'test_cpmu.json')
+        inp_mag_path    = os.path.join(inp_path, 'test_cpmu.mag')
+        inp_h5_path     = os.path.join(inp_path, 'test_cpmu.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Genomes received from the other rank are decoded from shared genomes whose cached bfields were computed on
+        # the previous S grid, with this seed a decoded parent is bred from on the next grid
+        options = {
+            'iterations'        : 8,
+            'id_filename'       : inp_json_path,
+            'magnets_filename'  : inp_mag_path,
+            'lookup_filename'   : inp_h5_path,
+            'setup'             : 4,
+            'c'                 : 1,
+            'e'                 : 0.0,
+            'restart'           : False,
+            'max_age'           : 10,
+            'scale'             : 10.0,
+            'singlethreaded'    : False,
+            'seed'              : True,
+            'seed_value'        : 2,
+            'coarse_strides'    : '4,2',
+            'coarse_iterations' : 2,
+            'bfield_resync'     : 100,
+            'bfield_tolerance'  : 1e-9,
+            'verbose'           : 2,
+        }
+        args = [
+            obs_path
+        ]
+
+        try:
+
+            # Execute the function under test on two ranks
+            result = run_mpi_process(2, options, args)
+            assert result.returncode == 0, result.stdout.decode()
+
+            with open(inp_json_path, 'r') as fp:
+                info = json.load(fp)
+
+            magnet_sets = Magnets()
+            magnet_sets.load(inp_mag_path)
+
+            lookup = load_lookup(inp_h5_path, info)
+            ref_magnet_sets = generate_reference_magnets(magnet_sets)
+            ref_bfield = generate_bfield(info, MagLists(ref_magnet_sets), ref_magnet_sets, lookup)
+            _, ref_trajectories = calculate_bfield_phase_error(info, ref_bfield)
+
+            # The last checkpointed genome is saved after the final resolution switch so it must be scored at full resolution
+            obs_genome_names = os.listdir(obs_path)
+            assert len(obs_genome_names) > 0
+
+            obs_genome_name = max(obs_genome_names, key=(lambda name : os.path.getmtime(os.path.join(obs_path, name))))
+            with open(os.path.join(obs_path, obs_genome_name), 'rb') as obs_genome_file:
+                obs_maglist = pickle.load(obs_genome_file)
+
+            _, fitness = calculate_cached_trajectory_loss(info, lookup, magnet_sets, obs_maglist, ref_trajectories)
+            assert obs_genome_name.startswith(f'{fitness:010.8e}')
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    def test_process_integrals_coarse_strides(self):
+        # inp == Inputs
+
+        inp_path  = 'IDSort/test/data/mpi_runner_test/test_process/inputs'
+
+        # Prepare input file paths
+        inp_json_path   = os.path.join(inp_path, 'test_cpmu.json')
+        inp_mag_path    = os.path.join(inp_path, 'test_cpmu.mag')
+        inp_h5_path     = os.path.join(inp_path, 'test_cpmu.h5')
+
+        # Field integrals are summed at the block ends of the full resolution S axis so cannot screen coarse generations
+        options = {
+            'iterations'         : 1,
+            'id_filename'        : inp_json_path,
+            'magnets_filename'   : inp_mag_path,
+            'lookup_filename'    : inp_h5_path,
+            'integrals_filename' : os.path.join(inp_path, 'test_cpmu_integrals.h5'),
+            'surrogate_fraction' : 0.2,
+            'coarse_strides'     : '4,2',
+            'setup'              : 4,
+            'c'                  : 1,
+            'e'                  : 0.0,
+            'restart'            : False,
+            'max_age'            : 10,
+            'scale'              : 10.0,
+            'singlethreaded'     : True,
+            'seed'               : True,
+            'seed_value'         : 30,
+            'verbose'            : 4,
+        }
+        options_named = namedtuple("options", options.keys())(*options.values())
+
+        with self.assertRaises(Exception) as context:
+            process(options_named, ['IDSort/test/data/mpi_runner_test/test_process/observed_outputs'])
+
+        assert 'coarse S grids' in str(context.exception)
+
+    def test_process_lazy_cache(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/mpi_runner_test/test_process_lazy_cache'
+        inp_path  = 'IDSort/test/data/mpi_runner_test/test_process/inputs'
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path   = os.path.join(inp_path, 'test_cpmu.json')
+        inp_mag_path    = os.path.join(inp_path, 'test_cpmu.mag')
+        inp_h5_path     = os.path.join(inp_path, 'test_cpmu.h5')
+
+        # Prepare observed output file paths
+        obs_genome_path   = os.path.join(obs_path, 'genomes')
+        obs_cache_h5_path = os.path.join(obs_path, 'test_cpmu_lazy.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_genome_path)
+
+        # Prepare parameters for process function
+        options = {
+            'iterations'       : 1,
+            'id_filename'      : inp_json_path,
+            'magnets_filename' : inp_mag_path,
+            'lookup_filename'  : inp_h5_path,
+            'lazy_lookup'      : True,
+            'lazy_cache'       : obs_cache_h5_path,
+            'setup'            : 4,
+            'c'                : 1,
+            'e'                : 0.0,
+            'restart'          : False,
+            'max_age'          : 10,
+            'scale'            : 10.0,
+            'singlethreaded'   : True,
+            'seed'             : True,
+            'seed_value'       : 30,
+            'verbose'          : 4,
+        }
+        options_named = namedtuple("options", options.keys())(*options.values())
+        args = [
+            obs_genome_path
+        ]
+
+        try:
+            inp_h5_mtime = os.path.getmtime(inp_h5_path)
+
+            # Execute the function under test
+            process(options_named, args)
+
+            # Lazy lookup columns are cached in their own file and the lookup table is left untouched
+            assert os.path.exists(obs_cache_h5_path)
+            assert os.path.getmtime(inp_h5_path) == inp_h5_mtime
+            assert len(os.listdir(obs_genome_path)) > 0
+
+            # The lookup table is never used as the cache
+            options_named = options_named._replace(lazy_cache=inp_h5_path)
+            with self.assertRaises(Exception):
+                process(options_named, args)
+
+            assert os.path.getmtime(inp_h5_path) == inp_h5_mtime
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
+    @unittest.skipIf(shutil.which('mpirun') is None, 'mpirun is not available')
+    def test_process_mpi_overlap_exchange(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/mpi_runner_test/test_process_mpi_overlap_exchange'
+        inp_path  = 'IDSort/test/data/mpi_runner_test/test_process/inputs'
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Prepare input file paths
+        inp_json_path   = os.path.join(inp_path, 'test_cpmu.json')
+        inp_mag_path    = os.path.join(inp_path, 'test_cpmu.mag')
+        inp_h5_path     = os.path.join(inp_path, 'test_cpmu.h5')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_path)
+
+        # Prepare parameters for process function
+        options = {
+            'iterations'       : 6,
+            'id_filename'      : inp_json_path,
+            'magnets_filename' : inp_mag_path,
+            'lookup_filename'  : inp_h5_path,
+            'setup'            : 4,
+            'c'                : 1,
+            'e'                : 0.0,
+            'restart'          : False,
+            'max_age'          : 10,
+            'scale'            : 10.0,
+            'singlethreaded'   : False,
+            'seed'             : True,
+            'seed_value'       : 2,
+            'overlap_exchange' : True,
+            'verbose'          : 3,
+        }
+        args = [
+            obs_path
+        ]
+
+        try:
+
+            # Execute the function under test on three ranks
+            result = run_mpi_process(3, options, args)
+            assert result.returncode == 0, result.stdout.decode()
+
+            # The exchange block fits every buffer from the start so no exchange falls back to a blocking gather
+            assert 'growing the block' not in result.stdout.decode()
+
+            with open(inp_json_path, 'r') as fp:
+                info = json.load(fp)
+
+            magnet_sets = Magnets()
+            magnet_sets.load(inp_mag_path)
+
+            lookup = load_lookup(inp_h5_path, info)
+            ref_magnet_sets = generate_reference_magnets(magnet_sets)
+            ref_bfield = generate_bfield(info, MagLists(ref_magnet_sets), ref_magnet_sets, lookup)
+            _, ref_trajectories = calculate_bfield_phase_error(info, ref_bfield)
+
+            # Genomes that migrated between ranks must decode to the magnet lists their fitness was calculated for
+            obs_genome_names = os.listdir(obs_path)
+            assert len(obs_genome_names) > 1
+
+            for obs_genome_name in obs_genome_names:
+                with open(os.path.join(obs_path, obs_genome_name), 'rb') as obs_genome_file:
+                    obs_maglist = pickle.load(obs_genome_file)
+
+                _, fitness = calculate_cached_trajectory_loss(info, lookup, magnet_sets, obs_maglist, ref_trajectories)
+                assert obs_genome_name.startswith(f'{fitness:010.8e}')
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
@@ -92,6 +92,77 @@ class ProcessGenomeTest(unittest.TestCase):
             shutil.rmtree(obs_path, ignore_errors=True)
             os.makedirs(obs_path)
 
+    def test_process_memory_budget(self):
+        # inp == Inputs
+        # obs == Observed Outputs
+
+        data_path = 'IDSort/test/data/process_genome_test/test_process'
+        inp_path  = os.path.join(data_path, 'inputs')
+        obs_path  = os.path.join(data_path, 'observed_outputs')
+
+        # Base name for test genome file
+        base_genome_name = '1.12875826e-08_000_7c51ecd01f73.genome'
+
+        # Prepare input file paths
+        inp_json_path   = os.path.join(inp_path, 'test_cpmu.json')
+        inp_mag_path    = os.path.join(inp_path, 'test_cpmu.mag')
+        inp_h5_path     = os.path.join(inp_path, 'test_cpmu.h5')
+        inp_genome_path = os.path.join(inp_path, base_genome_name)
+
+        # Prepare observed output file paths
+        obs_memory_path = os.path.join(obs_path, 'memory')
+        obs_tiled_path  = os.path.join(obs_path, 'tiled')
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(obs_path, ignore_errors=True)
+        os.makedirs(obs_memory_path)
+        os.makedirs(obs_tiled_path)
+
+        try:
+
+            # Analyse the genome with the lookup in memory, then from disk in tiles of a few S steps
+            for output_dir, memory_budget in [(obs_memory_path, 0), (obs_tiled_path, 1)]:
+
+                # Prepare parameters for process function
+                options = {
+                    'analysis'         : True,
+                    'readable'         : False,
+                    'id_filename'      : inp_json_path,
+                    'magnets_filename' : inp_mag_path,
+                    'id_template'      : inp_h5_path,
+                    'create_genome'    : False,
+                    'output_dir'       : output_dir,
+                    'memory_budget'    : memory_budget,
+                    'verbose'          : 4,
+                }
+                options_named = namedtuple("options", options.keys())(*options.values())
+                args = [
+                    inp_genome_path
+                ]
+
+                # Execute the function under test
+                process(options_named, args)
+
+            # Compare the tiled output file to the in memory one
+            with h5py.File(os.path.join(obs_memory_path, base_genome_name + '.h5'), 'r') as memory_h5_file, \
+                 h5py.File(os.path.join(obs_tiled_path, base_genome_name + '.h5'), 'r') as tiled_h5_file:
+
+                assert sorted(list(memory_h5_file.keys())) == sorted(list(tiled_h5_file.keys()))
+
+                for dataset in memory_h5_file.keys():
+
+                    memory_data = memory_h5_file.get(dataset)[()]
+                    tiled_data  = tiled_h5_file.get(dataset)[()]
+                    assert np.allclose(memory_data, tiled_data)
+
+        # Use (except + else) instead of (finally) so that output files can be inspected if the test fails
+        except Exception as ex: raise ex
+        else:
+
+            # Clear any observed output files after running successful test
+            shutil.rmtree(obs_path, ignore_errors=True)
+            os.makedirs(obs_path)
+
     def test_process_create_genome(self):
         # inp == Inputs
         # exp == Expected Outputs
@@ -0,0 +1,134 @@
+import unittest, os, shutil
+
+from ..src.stage_cache import hash_stage, read_stage_hash, run_cached_stage
+
+
+class StageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # obs == Observed Outputs
+
+        self.obs_path = 'IDSort/test/data/stage_cache_test/observed_outputs'
+
+        # Always clear any observed output files before running test
+        shutil.rmtree(self.obs_path, ignore_errors=True)
+        os.makedirs(self.obs_path)
+
+        self.runs = []
+
+    def run_stage(self, filepath, contents):
+        # Stage that records it was run and writes its artefact
+        def stage():
+            self.runs.append(filepath)
+            with open(filepath, 'w') as fp:
+                fp.write(contents)
+        return stage
+
+    def test_hash_stage(self):
+
+        inp_path = os.path.join(self.obs_path, 'test.sim')
+        with open(inp_path, 'w') as fp:
+            fp.write('magnets')
+
+        stage_hash = hash_stage({ 'periods' : 5, 'hmags' : inp_path })
+
+        # Options that do not change the artefact are not hashed
+        assert hash_stage({ 'periods' : 5, 'hmags' : inp_path, 'workers' : 4, 'memory_budget' : 64 }) == stage_hash
+
+        # Options and upstream hashes are
+        assert hash_stage({ 'periods' : 6, 'hmags' : inp_path }) != stage_hash
+        assert hash_stage({ 'periods' : 5, 'hmags' : inp_path }, upstream_hashes=('a',)) != stage_hash
+
+        # Input files are hashed by their contents, not their path
+        assert hash_stage({ 'periods' : 5, 'hmags' : inp_path }, file_options=('hmags',)) != stage_hash
+
+        file_hash = hash_stage({ 'periods' : 5, 'hmags' : inp_path }, file_options=('hmags',))
+        with open(inp_path, 'w') as fp:
+            fp.write('changed magnets')
+        assert hash_stage({ 'periods' : 5, 'hmags' : inp_path }, file_options=('hmags',)) != file_hash
+
+        # Clear any observed output files after running successful test
+        shutil.rmtree(self.obs_path, ignore_errors=True)
+
+    def test_run_cached_stage(self):
+
+        obs_json_path = os.path.join(self.obs_path, 'test.json')
+
+        # Miss on an artefact that does not exist yet
+        run_cached_stage('.json', obs_json_path, 'a', self.run_stage(obs_json_path, 'first'))
+        assert self.runs == [obs_json_path]
+        assert read_stage_hash(obs_json_path) == 'a'
+
+        # Hit on the same hash
+        run_cached_stage('.json', obs_json_path, 'a', self.run_stage(obs_json_path, 'second'))
+        assert self.runs == [obs_json_path]
+
+        with open(obs_json_path, 'r') as fp:
+            assert fp.read() == 'first'
+
+        # Miss on a different hash
+        run_cached_stage('.json', obs_json_path, 'b', self.run_stage(obs_json_path, 'third'))
+        assert self.runs == [obs_json_path, obs_json_path]
+        assert read_stage_hash(obs_json_path) == 'b'
+
+        # Forced to run even on the same hash
+        run_cached_stage('.json', obs_json_path, 'b', self.run_stage(obs_json_path, 'fourth'), force_generate=True)
+        assert len(self.runs) == 3
+
+        # Clear any observed output files after running successful test
+        shutil.rmtree(self.obs_path, ignore_errors=True)
+
+    def test_run_cached_stage_adopt(self):
+
+        obs_json_path = os.path.join(self.obs_path, 'test.json')
+
+        # Artefacts generated before they were hashed are adopted instead of regenerated
+        with open(obs_json_path, 'w') as fp:
+            fp.write('existing')
+
+        run_cached_stage('.json', obs_json_path, 'a', self.run_stage(obs_json_path, 'first'))
+        assert self.runs == []
+        assert read_stage_hash(obs_json_path) == 'a'
+
+        # An interrupted stage is never adopted
+        def interrupted_stage():
+            with open(obs_json_path, 'w') as fp:
+                fp.write('partial')
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            run_cached_stage('.json', obs_json_path, 'b', interrupted_stage)
+
+        run_cached_stage('.json', obs_json_path, 'b', self.run_stage(obs_json_path, 'second'))
+        assert self.runs == [obs_json_path]
+        assert read_stage_hash(obs_json_path) == 'b'
+
+        # Clear any observed output files after running successful test
+        shutil.rmtree(self.obs_path, ignore_errors=True)
+
+    def test_run_cached_stage_cache_dir(self):
+
+        obs_cache_path  = os.path.join(self.obs_path, 'cache')
+        obs_run_a_path  = os.path.join(self.obs_path, 'run_a')
+        obs_run_b_path  = os.path.join(self.obs_path, 'run_b')
+        os.makedirs(obs_run_a_path)
+        os.makedirs(obs_run_b_path)
+
+        obs_h5_a_path = os.path.join(obs_run_a_path, 'test.h5')
+        obs_h5_b_path = os.path.join(obs_run_b_path, 'test.h5')
+
+        # The first run generates the artefact and adds it to the cache store
+        run_cached_stage('.h5', obs_h5_a_path, 'a', self.run_stage(obs_h5_a_path, 'lookup'), cache_dir=obs_cache_path)
+        assert self.runs == [obs_h5_a_path]
+        assert os.path.exists(os.path.join(obs_cache_path, 'a.h5'))
+
+        # Another run directory copies it from the cache store instead of generating it
+        run_cached_stage('.h5', obs_h5_b_path, 'a', self.run_stage(obs_h5_b_path, 'other lookup'), cache_dir=obs_cache_path)
+        assert self.runs == [obs_h5_a_path]
+        assert read_stage_hash(obs_h5_b_path) == 'a'
+
+        with open(obs_h5_b_path, 'r') as fp:
+            assert fp.read() == 'lookup'
+
+        # Clear any observed output files after running successful test
+        shutil.rmtree(self.obs_path, ignore_errors=True)